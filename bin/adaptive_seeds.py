@@ -0,0 +1,173 @@
+import numpy as np
+
+########################################################################
+#  ADAPTIVE_SEEDS: Adaptive refinement of the field line seed mesh
+########################################################################
+#        Predictive Science Inc.
+#        www.predsci.com
+#        San Diego, California, USA 92121
+########################################################################
+# Copyright 2024 Predictive Science Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+########################################################################
+#
+# The tracings are done on a fine (t, p) output mesh (e.g. twice the
+# map resolution), but most seeds fall where the traced quantities are
+# smooth.  trace_adaptive() traces every 2^levels-th point of the output
+# mesh first, and then for each level:
+#   - flags the cells (of the points traced so far) where the OFM
+#     changes (polarity or open/closed), log10 of the expansion factor
+#     changes by more than EXPFAC_JUMP, |slogQ| exceeds SLOGQ_MIN, or
+#     the footpoints of the corners are more than FOOTPOINT_JUMP times
+#     the cell size apart,
+#   - adds the midpoints of the flagged theta and phi intervals to the
+#     seed mesh, tracing only the new points (as two tensor-product
+#     meshes, new theta x all phi and old theta x new phi, since MAPFL
+#     traces mesh_file_t x mesh_file_p).
+# A CH boundary crosses most theta intervals somewhere in phi, so the
+# mesh is split into COLUMNS phi columns that are refined (and traced)
+# independently, each with its own theta mesh.
+# The points that were not traced are then interpolated from the traced
+# ones: linearly (log10 for the expansion factor, unit vectors for the
+# footpoints) and nearest-neighbour for the OFM.  Features smaller than
+# the coarse cells can be missed, so levels should stay small (1-2).
+#
+########################################################################
+
+EXPFAC_JUMP = 0.3
+SLOGQ_MIN = 2.0
+FOOTPOINT_JUMP = 3.0
+
+# Number of phi columns refined independently.
+COLUMNS = 16
+
+def coarse_indices(n, levels):
+  return np.union1d(np.arange(0, n, 2**levels), [n - 1])
+
+def cell_flags(fields, kinds, footpoints, tvec, pvec):
+  # Flags (np-1, nt-1) of the cells of the fields (np, nt) on the mesh
+  # (tvec, pvec) that need refinement.
+  def corners(f):
+    return np.stack([f[:-1, :-1], f[1:, :-1], f[:-1, 1:], f[1:, 1:]])
+  shape = (len(pvec) - 1, len(tvec) - 1)
+  flags = np.zeros(shape, dtype=bool)
+  for name, f in fields.items():
+    c = corners(np.asarray(f, dtype=np.float64))
+    if kinds.get(name) == 'ofm':
+      flags |= np.any(c != c[0], axis=0)
+    elif kinds.get(name) == 'expfac':
+      logf = np.log10(np.maximum(c, 1e-300))
+      flags |= (logf.max(axis=0) - logf.min(axis=0)) > EXPFAC_JUMP
+    elif kinds.get(name) == 'slogq':
+      flags |= np.abs(c).max(axis=0) > SLOGQ_MIN
+  if footpoints:
+    size = np.hypot(np.diff(tvec)[None, :], np.diff(pvec)[:, None]*np.sin(0.5*(tvec[1:] + tvec[:-1]))[None, :])
+    for tname, pname in footpoints:
+      x = unit_vectors(fields[tname], fields[pname])
+      c = [x[:, :-1, :-1], x[:, 1:, :-1], x[:, :-1, 1:], x[:, 1:, 1:]]
+      separation = np.max([np.linalg.norm(c[i] - c[j], axis=0) for i in range(4) for j in range(i + 1, 4)], axis=0)
+      flags |= separation > FOOTPOINT_JUMP*np.maximum(size, 1e-12)
+  return flags
+
+def refine(tidx, pidx, flags):
+  # Midpoint indices of the flagged theta and phi intervals that can
+  # still be split.
+  tgaps = np.any(flags, axis=0) & (np.diff(tidx) > 1)
+  pgaps = np.any(flags, axis=1) & (np.diff(pidx) > 1)
+  return (tidx[:-1][tgaps] + tidx[1:][tgaps])//2, (pidx[:-1][pgaps] + pidx[1:][pgaps])//2
+
+def axis_weights(known, n):
+  # Bracketing known indices and linear weights of the indices 0..n-1.
+  i = np.clip(np.searchsorted(known, np.arange(n), side='right') - 1, 0, len(known) - 2)
+  lo, hi = known[i], known[i + 1]
+  return i, (np.arange(n) - lo)/(hi - lo)
+
+def expand(f, tidx, pidx, nt, np_, nearest=False):
+  # Values (np_, nt) on the output mesh from f on the traced points.
+  it, wt = axis_weights(tidx, nt)
+  ip, wp = axis_weights(pidx, np_)
+  if nearest:
+    wt, wp = np.round(wt), np.round(wp)
+  f = f[:, it]*(1 - wt) + f[:, it + 1]*wt
+  return f[ip, :]*(1 - wp)[:, None] + f[ip + 1, :]*wp[:, None]
+
+def unit_vectors(t, p):
+  t, p = np.asarray(t, dtype=np.float64), np.asarray(p, dtype=np.float64)
+  return np.stack([np.sin(t)*np.cos(p), np.sin(t)*np.sin(p), np.cos(t)])
+
+def trace_adaptive(trace, tvec, pvec, levels, kinds, footpoints=(), columns=COLUMNS):
+  # Adaptively traced fields on the output mesh (tvec, pvec).  trace()
+  # traces a list of tensor meshes [(t, p)] and returns a list of
+  # {name: f (len(p), len(t))}.  kinds: {name: 'ofm' | 'expfac' |
+  # 'slogq' | 'linear'}, footpoints: [(theta name, phi name)] of the
+  # footpoint coordinate pairs.
+  nt, np_ = len(tvec), len(pvec)
+  tc, pc = coarse_indices(nt, levels), coarse_indices(np_, levels)
+  edges = np.linspace(0, len(pc) - 1, min(columns, len(pc) - 1) + 1).round().astype(int)
+  cols = [{'t': tc, 'p': pc[a:b+1]} for a, b in zip(edges[:-1], edges[1:]) if b > a]
+  full = {}
+  def run(requests):
+    # Trace the (t indices, p indices) tensor meshes of requests.
+    for (ti, pi), values in zip(requests, trace([(tvec[ti], pvec[pi]) for ti, pi in requests])):
+      for name, f in values.items():
+        full.setdefault(name, np.full((np_, nt), np.nan))[np.ix_(pi, ti)] = f
+  run([(col['t'], col['p']) for col in cols])
+  footpoints = [pair for pair in footpoints if pair[0] in full and pair[1] in full]
+
+  for level in range(levels):
+    requests = []
+    for col in cols:
+      fields = {name: f[np.ix_(col['p'], col['t'])] for name, f in full.items()}
+      tnew, pnew = refine(col['t'], col['p'], cell_flags(fields, kinds, footpoints, tvec[col['t']], pvec[col['p']]))
+      pall = np.union1d(col['p'], pnew)
+      if len(tnew):
+        requests.append((tnew, pall))
+      if len(pnew):
+        requests.append((col['t'], pnew))
+      col['t'], col['p'] = np.union1d(col['t'], tnew), pall
+    print(f'   Refinement {level + 1}/{levels}: {len(requests)} seed mesh(es).')
+    if not requests:
+      break
+    run(requests)
+  traced = np.count_nonzero(~np.isnan(next(iter(full.values()))))
+  print(f'   Traced {traced} of {nt*np_} seed points ({100.0*traced/(nt*np_):.0f}%).')
+
+  # Interpolate each column from its own traced points.
+  result = {name: np.empty((np_, nt)) for name in full}
+  paired = [name for pair in footpoints for name in pair]
+  for col in cols:
+    tidx, pidx = col['t'], col['p'] - col['p'][0]
+    rows = slice(col['p'][0], col['p'][-1] + 1)
+    n = len(range(np_)[rows])
+    for name, f in full.items():
+      if name in paired:
+        continue
+      known = f[np.ix_(col['p'], tidx)]
+      if kinds.get(name) == 'expfac':
+        # Zero (failed) expansion factors are kept as zero.
+        values = 10**expand(np.log10(np.maximum(known, 1e-300)), tidx, pidx, nt, n)
+        values[expand(known, tidx, pidx, nt, n, nearest=True) <= 0] = 0.0
+      else:
+        values = expand(known, tidx, pidx, nt, n, nearest=kinds.get(name) == 'ofm')
+      result[name][rows] = values
+    for tname, pname in footpoints:
+      x = unit_vectors(full[tname][np.ix_(col['p'], tidx)], full[pname][np.ix_(col['p'], tidx)])
+      x = np.stack([expand(c, tidx, pidx, nt, n) for c in x])
+      result[tname][rows] = np.arccos(np.clip(x[2]/np.maximum(np.linalg.norm(x, axis=0), 1e-300), -1, 1))
+      result[pname][rows] = np.mod(np.arctan2(x[1], x[0]), 2*np.pi)
+  # The traced points keep their traced values.
+  for name, f in full.items():
+    result[name] = np.where(np.isnan(f), result[name], f)
+  return result
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+import os
+import sys
+import csv
+import glob
+import argparse
+import numpy as np
+#
+import psi_io as ps
+import swig_stages as stages
+
+########################################################################
+#  BACKMAP: Footpoints and source quantities of points at r1
+########################################################################
+#        Predictive Science Inc.
+#        www.predsci.com
+#        San Diego, California, USA 92121
+########################################################################
+# Copyright 2024 Predictive Science Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+########################################################################
+#
+# Maps points (r, t, p) back to the photosphere with the tracings of an
+# existing SWiG run (kept with -retain all), without running MAPFL:
+#   cs/r1_rss_t/p.h5:   r1 -> rss footpoints of the CS field lines,
+#   pfss/rss_r0_t/p.h5: rss -> r0 footpoints of the PFSS field lines,
+#   pfss/expfac_rss_r0.h5, pfss/ofm_r0.h5, dchb_at_r1.h5.
+# load_index() reads them once into an index (cached in the run
+# directory as backmap_index.npz) holding the footpoints as unit vectors
+# (so that phi wraps around), log10 of the expansion factor, and the
+# phi-extended grids.  The maps are read in either layout (MAPFL writes
+# ofm_r0.h5 pt and the tracings tp, SWiG writes dchb_at_r1.h5 pt).
+# query() then answers a batch of points with two vectorized bilinear
+# lookups: the rss footpoint at r1, and the r0 footpoint and expansion
+# factor at that rss point.  It returns:
+#   r1:           radius of the tracings used,
+#   rss_t, rss_p: footpoint at rss,
+#   r0_t, r0_p:   footpoint at r0,
+#   polarity:     OFM at the r0 footpoint (nearest point),
+#   expfac:       expansion factor of the field line,
+#   dchb:         DCHB at r1.
+# Points above r1 are mapped radially down to it.  With several r1 radii
+# (swig.py -r1 21.5,30) each r1_<radius>/ tracing is in the index and a
+# point uses the largest radius at or below it.  Points below the lowest
+# radius get NaN.
+#
+########################################################################
+
+INDEX_NAME = 'backmap_index.npz'
+
+# Version of the index layout (older caches are rebuilt).
+INDEX_VERSION = 2
+
+# Files of a run directory the index is built from.
+INDEX_FILES = ['cs/r1_rss_t.h5', 'cs/r1_rss_p.h5', 'pfss/rss_r0_t.h5', 'pfss/rss_r0_p.h5',
+               'pfss/expfac_rss_r0.h5', 'pfss/ofm_r0.h5', 'dchb_at_r1.h5']
+
+OUTPUTS = ['r1', 'rss_t', 'rss_p', 'r0_t', 'r0_p', 'polarity', 'expfac', 'dchb']
+
+def argParsing():
+  parser = argparse.ArgumentParser(description='Map points (r, t, p) back to their footpoints, expansion factor, and DCHB with the tracings of a SWiG run.')
+
+  parser.add_argument('rundir',
+    help='Run directory of a map (with cs/, pfss/, and dchb_at_r1.h5, i.e. run with -retain all).',
+    type=str)
+
+  parser.add_argument('-csv',
+    help='CSV file of the points with columns r (Rs), t (colatitude), and p (longitude); other columns are copied to the output.',
+    dest='csv',
+    type=str,
+    required=True)
+
+  parser.add_argument('-o',
+    help='Output CSV file (default: <csv>_backmap.csv).',
+    dest='output',
+    type=str,
+    required=False)
+
+  parser.add_argument('-degrees',
+    help='t and p (input and output) are in degrees instead of radians.',
+    dest='degrees',
+    action='store_true',
+    default=False,
+    required=False)
+
+  parser.add_argument('-r1',
+    help='Radius of the tracings in rundir, if it cannot be found from the run (the CS outer boundary).',
+    dest='r1',
+    type=float,
+    required=False)
+
+  return parser.parse_args()
+
+def periodic_grid(t, p):
+  # The grid of a (np, nt) field, with the distinct phi points extended
+  # by -2pi and +2pi.
+  t = np.asarray(t, dtype=np.float64)
+  p = np.asarray(p, dtype=np.float64)
+  start, stop = 0, len(p)
+  if abs(p[-1] - p[0] - 2*np.pi) <= 1e-6:
+    start = 1
+  pd = p[start:stop]
+  return {'t': t, 'p_ext': np.concatenate([pd - 2*np.pi, pd, pd + 2*np.pi]), 'start': start, 'n': len(pd)}
+
+def locate(grid, t, p):
+  # Corner indices and bilinear weights of the points (t, p).
+  t_f, p_ext, n = grid['t'], grid['p_ext'], grid['n']
+  p = np.mod(p, 2*np.pi)
+  it = np.clip(np.searchsorted(t_f, t) - 1, 0, len(t_f) - 2)
+  ip = np.clip(np.searchsorted(p_ext, p) - 1, 0, len(p_ext) - 2)
+  wt = np.clip((t - t_f[it])/(t_f[it+1] - t_f[it]), 0, 1)
+  wp = (p - p_ext[ip])/(p_ext[ip+1] - p_ext[ip])
+  return (grid['start'] + ip % n, grid['start'] + (ip + 1) % n, it, it + 1, wp, wt)
+
+def bilinear(plan, f):
+  ip0, ip1, it0, it1, wp, wt = plan
+  return (f[..., ip0, it0]*(1 - wp)*(1 - wt) + f[..., ip1, it0]*wp*(1 - wt) +
+          f[..., ip0, it1]*(1 - wp)*wt + f[..., ip1, it1]*wp*wt)
+
+def unit_vectors(t, p):
+  t, p = np.asarray(t, dtype=np.float64), np.asarray(p, dtype=np.float64)
+  return np.stack([np.sin(t)*np.cos(p), np.sin(t)*np.sin(p), np.cos(t)])
+
+def to_angles(x):
+  norm = np.maximum(np.sqrt(np.sum(x*x, axis=0)), 1e-300)
+  return np.arccos(np.clip(x[2]/norm, -1, 1)), np.mod(np.arctan2(x[1], x[0]), 2*np.pi)
+
+def tracing_radius(directory, r1=None):
+  # r1 of the tracings of a run directory: its -r1 (cs_trace stage
+  # parameter), or the outer boundary of the CS solution.
+  params = stages.load_manifest(directory)['stages'].get('cs_trace', {}).get('params') or {}
+  if 'r1' in params:
+    return float(params['r1'])
+  if os.path.exists(os.path.join(directory, 'cs/br_cs.h5')):
+    return float(ps.rdhdf_scales(os.path.join(directory, 'cs/br_cs.h5'))[0][-1])
+  return r1
+
+def read_tp(directory, file):
+  # (t, p, f (np, nt)) of a map in either layout (pt if the first scale
+  # goes past pi).
+  xvec, yvec, f = ps.rdhdf_2d(os.path.join(directory, file))
+  xvec, yvec, f = np.asarray(xvec), np.asarray(yvec), np.asarray(f)
+  if np.max(xvec) > 3.5:
+    return yvec, xvec, np.transpose(f)
+  return xvec, yvec, f
+
+def build_level(directory, r1):
+  # The index arrays of the tracings of one run directory.
+  t_cs, p_cs, r1_rss_t = read_tp(directory, 'cs/r1_rss_t.h5')
+  r1_rss_p = read_tp(directory, 'cs/r1_rss_p.h5')[2]
+  t_pf, p_pf, rss_r0_t = read_tp(directory, 'pfss/rss_r0_t.h5')
+  rss_r0_p = read_tp(directory, 'pfss/rss_r0_p.h5')[2]
+  t_ef, p_ef, expfac = read_tp(directory, 'pfss/expfac_rss_r0.h5')
+  t_ofm, p_ofm, ofm = read_tp(directory, 'pfss/ofm_r0.h5')
+  t_d, p_d, dchb = read_tp(directory, 'dchb_at_r1.h5')
+  return {'r1': np.float64(r1),
+          't_cs': t_cs, 'p_cs': p_cs, 'x_rss': unit_vectors(r1_rss_t, r1_rss_p),
+          't_pf': t_pf, 'p_pf': p_pf, 'x_r0': unit_vectors(rss_r0_t, rss_r0_p),
+          't_ef': t_ef, 'p_ef': p_ef, 'log_expfac': np.log10(np.maximum(np.asarray(expfac, dtype=np.float64), 1e-300)),
+          't_ofm': t_ofm, 'p_ofm': p_ofm, 'ofm': ofm,
+          't_d': t_d, 'p_d': p_d, 'dchb': dchb}
+
+def level_directories(rundir):
+  # The run directory and its r1_<radius>/ directories with tracings.
+  return [d for d in [rundir] + sorted(glob.glob(os.path.join(rundir, 'r1_*')))
+          if os.path.exists(os.path.join(d, 'cs/r1_rss_t.h5'))]
+
+def load_index(rundir, r1=None):
+  # The index of rundir (rebuilt when its files are newer than the cache).
+  rundir = os.path.abspath(rundir)
+  directories = level_directories(rundir)
+  check_error_code(len(directories) == 0, 'ERROR: no tracings (cs/r1_rss_t.h5) in '+rundir+' (run with -retain all).')
+  sources = [os.path.join(d, f) for d in directories for f in INDEX_FILES]
+  missing = [f for f in sources if not os.path.exists(f)]
+  check_error_code(len(missing) > 0, 'ERROR: missing '+', '.join(missing)+' (run with -retain all).')
+  cache = os.path.join(rundir, INDEX_NAME)
+  flat = None
+  if os.path.exists(cache) and os.path.getmtime(cache) >= max(os.path.getmtime(f) for f in sources):
+    with np.load(cache) as data:
+      flat = dict(data)
+    if int(flat.get('version', 1)) != INDEX_VERSION:
+      flat = None
+  if flat is not None:
+    levels = [{key[len(f'{k}_'):]: value for key, value in flat.items() if key.startswith(f'{k}_')}
+              for k in range(int(flat['levels']))]
+  else:
+    levels = []
+    for directory in directories:
+      radius = tracing_radius(directory, r1 if directory == rundir else None)
+      if radius is None and directory != rundir:
+        radius = float(os.path.basename(directory)[len('r1_'):])
+      check_error_code(radius is None, 'ERROR: the r1 of the tracings in '+directory+' is unknown (give -r1).')
+      levels.append(build_level(directory, radius))
+    levels.sort(key=lambda level: level['r1'])
+    flat = {f'{k}_{key}': value for k, level in enumerate(levels) for key, value in level.items()}
+    np.savez(cache, version=INDEX_VERSION, levels=len(levels), **flat)
+  for level in levels:
+    for name in ('cs', 'pf', 'ef', 'ofm', 'd'):
+      level['grid_'+name] = periodic_grid(level['t_'+name], level['p_'+name])
+  return levels
+
+def query(index, r, t, p):
+  # Footpoints and quantities (see above) of the points (r, t, p), as a
+  # dict of arrays.
+  r, t, p = (np.atleast_1d(np.asarray(a, dtype=np.float64)) for a in (r, t, p))
+  result = {name: np.full(r.shape, np.nan) for name in OUTPUTS}
+  radii = np.array([level['r1'] for level in index])
+  which = np.searchsorted(radii, r*(1 + 1e-9), side='right') - 1
+  for k, level in enumerate(index):
+    sel = which == k
+    if not np.any(sel):
+      continue
+    ts, ps_ = t[sel], p[sel]
+    rss_t, rss_p = to_angles(bilinear(locate(level['grid_cs'], ts, ps_), level['x_rss']))
+    r0_t, r0_p = to_angles(bilinear(locate(level['grid_pf'], rss_t, rss_p), level['x_r0']))
+    ip0, ip1, it0, it1, wp, wt = locate(level['grid_ofm'], r0_t, r0_p)
+    polarity = level['ofm'][np.where(wp < 0.5, ip0, ip1), np.where(wt < 0.5, it0, it1)]
+    values = {'r1': level['r1'], 'rss_t': rss_t, 'rss_p': rss_p, 'r0_t': r0_t, 'r0_p': r0_p,
+              'polarity': polarity,
+              'expfac': 10**bilinear(locate(level['grid_ef'], rss_t, rss_p), level['log_expfac']),
+              'dchb': bilinear(locate(level['grid_d'], ts, ps_), level['dchb'])}
+    for name, value in values.items():
+      result[name][sel] = value
+  return result
+
+def run(args):
+  index = load_index(args.rundir, args.r1)
+  print('=> Backmapping index of '+args.rundir+': r1 = '+', '.join(f"{level['r1']:g}" for level in index))
+
+  with open(args.csv, newline='') as f:
+    rows = list(csv.DictReader(f))
+  check_error_code(len(rows) == 0 or any(c not in rows[0] for c in ('r', 't', 'p')),
+    'ERROR: '+args.csv+' needs the columns r, t, p.')
+  scale = np.pi/180 if args.degrees else 1.0
+  r, t, p = (np.array([float(row[c]) for row in rows]) for c in ('r', 't', 'p'))
+  result = query(index, r, t*scale, p*scale)
+  for name in ('rss_t', 'rss_p', 'r0_t', 'r0_p'):
+    result[name] = result[name]/scale
+
+  output = args.output or os.path.splitext(args.csv)[0]+'_backmap.csv'
+  with open(output, 'w', newline='') as f:
+    writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()) + OUTPUTS)
+    writer.writeheader()
+    for i, row in enumerate(rows):
+      writer.writerow({**row, **{name: f'{result[name][i]:.8g}' for name in OUTPUTS}})
+  print(f'=> Wrote {len(rows)} points to {output} ({np.count_nonzero(np.isnan(result["r1"]))} below the lowest r1).')
+
+def check_error_code(ierr,message):
+  if ierr > 0:
+    print(' ')
+    print(message)
+    print('Error code of fail : '+str(ierr))
+    sys.exit(1)
+
+def main():
+  args = argParsing()
+  run(args)
+
+if __name__ == '__main__':
+  main()
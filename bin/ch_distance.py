@@ -187,11 +187,11 @@ def ch_distance(args):
     for i in range(nt_ch):
       if in_coronal_hole_list[j][i]:
         boundary_point = False
-        if  (not_coronal_hole_list[max(0,j-1):min(np_tp-1,j+1)+1,max(0,i-1):min(nt_tp-1,i+1)+1]).any():
+        if  (not_coronal_hole_list[max(0,j-1):min(np_ch-1,j+1)+1,max(0,i-1):min(nt_ch-1,i+1)+1]).any():
           boundary_point = True
       else:
         boundary_point = False
-        if (in_coronal_hole_list[max(0,j-1):min(np_tp-1,j+1)+1,max(0,i-1):min(nt_tp-1,i+1)+1]).any():
+        if (in_coronal_hole_list[max(0,j-1):min(np_ch-1,j+1)+1,max(0,i-1):min(nt_ch-1,i+1)+1]).any():
           boundary_point = True
 
       if boundary_point:
@@ -4,9 +4,17 @@ import sys
 import numpy as np
 import argparse
 import subprocess
+import time
+import json
+import shutil
 from pathlib import Path
 #
 import psi_io as ps
+import namelist_io
+import swig_stages as stages
+import swig_planner as planner
+import solver_watchdog as watchdog
+import pfss_spectral
 
 ########################################################################
 #  COR_PFSS_CS_POT3D: Coronal magnetic field PFSS+CS model using POT3D
@@ -53,12 +61,93 @@ def argParsing():
     required=False)
 
   parser.add_argument('-r1',
-    help='Specify the r1 distance (default=21.5).',
+    help='Specify the r1 distance (default=21.5).  With a comma-separated list (e.g. 21.5,30) the CS model is solved to the largest and the Br slice at each of the others is written to cs/br_r1_cs_<r1>.h5.',
     dest='r1',
+    type=str,
+    default='21.5',
+    required=False)
+
+  parser.add_argument('-retain',
+    help='Retention policy for intermediate files: all (default) keeps everything, minimal deletes each intermediate as soon as the last stage that reads it has completed.',
+    dest='retain',
+    type=str,
+    choices=stages.RETAIN_POLICIES,
+    default='all',
+    required=False)
+
+  parser.add_argument('-resume',
+    help='Skip the PFSS and/or CS solve if the run manifest shows it already completed with the same inputs.',
+    dest='resume',
+    action='store_true',
+    default=False,
+    required=False)
+
+  parser.add_argument('-stages',
+    help='Comma-separated list of stages to run (default: pfss,cs).  Used by the swig.py scheduler to run each solve as its own job.',
+    dest='stages',
+    type=str,
+    default='pfss,cs',
+    required=False)
+
+  parser.add_argument('-products',
+    help='Comma-separated list of final SWiG products that will be needed (default: all).  Solver outputs that none of them need are not written.',
+    dest='products',
+    type=str,
+    default=','.join(stages.PRODUCTS),
+    required=False)
+
+  parser.add_argument('-pfss_engine',
+    help='PFSS solver: pot3d (default), spectral, a fast spherical-harmonic solution (pfss_spectral.py) for screening runs, or linear, the POT3D solution in -pfss_mean plus the spectral solution of the difference of the maps.',
+    dest='pfss_engine',
+    type=str,
+    choices=['pot3d', 'spectral', 'linear'],
+    default='pot3d',
+    required=False)
+
+  parser.add_argument('-pfss_mean',
+    help='With -pfss_engine linear, the POT3D PFSS run directory (with br_input_tp.h5 and br/bt/bp_pfss.h5) of the reference (e.g. ensemble-mean) map.',
+    dest='pfss_mean',
+    type=str,
+    required=False)
+
+  parser.add_argument('-lmax',
+    help='With -pfss_engine linear, maximum degree of the spectral solution of the map difference (default 40).',
+    dest='lmax',
+    type=int,
+    default=40,
+    required=False)
+
+  parser.add_argument('-verify',
+    help='With -pfss_engine linear, also run POT3D on the map and record the difference of the two solutions in pfss/linear_pfss.json.',
+    dest='verify',
+    action='store_true',
+    default=False,
+    required=False)
+
+  parser.add_argument('-epscg',
+    help='CG solver tolerance for the PFSS and CS runs (default: epscg of the POT3D templates).',
+    dest='epscg',
+    type=float,
+    required=False)
+
+  parser.add_argument('-time_limit',
+    help='Abort a POT3D run that takes longer than this many seconds (default: no limit).',
+    dest='time_limit',
     type=float,
-    default=21.5,
     required=False)
 
+  parser.add_argument('-max_iterations',
+    help='Abort a POT3D run after this many CG iterations (default: no limit besides ncgmax).',
+    dest='max_iterations',
+    type=int,
+    required=False)
+
+  parser.add_argument('-stall_iterations',
+    help='Abort a POT3D run whose CG residual has not dropped by 10%% over this many iterations (default 100000, 0 to disable).',
+    dest='stall_iterations',
+    type=int,
+    default=100000,
+    required=False)
 
   return parser.parse_args()
 
@@ -88,9 +177,78 @@ def run(args):
 
   pot3d=sys.path[0]+'/../pot3d/bin/pot3d'
 
+  # The CS model is solved to the largest r1.
+  args.radii = sorted(set(float(r) for r in args.r1.split(',')))
+  args.r1 = args.radii[-1]
+
   # Some error checking:
   check_error_code(float(args.rss) <= 1.0,'ERROR: rss must be greather than 1.')
-  check_error_code(float(args.rss) >= float(args.r1),'ERROR: r1 must be greater than rss.')
+  check_error_code(float(args.rss) >= args.radii[0],'ERROR: r1 must be greater than rss.')
+
+  args.products = stages.parse_products(args.products)
+  check_error_code(args.products is None,'ERROR: invalid -products (choose from '+','.join(stages.PRODUCTS)+').')
+
+  rundir = os.getcwd()
+
+  # A non-default tolerance is part of the parameters of the solves.
+  solver = {'epscg': args.epscg} if args.epscg else {}
+  engine = {'pfss_engine': args.pfss_engine} if args.pfss_engine != 'pot3d' else {}
+  radii = {'radii': args.radii} if len(args.radii) > 1 else {}
+  if args.pfss_engine == 'linear':
+    check_error_code(args.pfss_mean is None,'ERROR: -pfss_engine linear needs -pfss_mean.')
+    args.pfss_mean = str(Path(args.pfss_mean).resolve())
+    engine.update({'pfss_mean': stages.file_checksum(args.pfss_mean+'/br_pfss.h5'), 'lmax': args.lmax})
+  stage_list = [
+    ('pfss', 'PFSS', lambda: run_pfss(args, br_input_file, pfss_file, pot3d),
+             {'input_map': stages.file_checksum(br_input_file), 'rss': args.rss, **solver, **engine}),
+    ('cs',   'CS',   lambda: run_cs(args, cs_file, pot3d),
+             {'rss': args.rss, 'r1': args.r1, **solver, **radii}),
+  ]
+  selected = args.stages.split(',')
+  for stage in selected:
+    check_error_code(stage not in [s[0] for s in stage_list],'ERROR: unknown stage '+stage+' (choose from pfss,cs).')
+
+  for stage, label, run_stage, params in stage_list:
+    if stage not in selected:
+      continue
+    outputs = stages.stage_outputs(stage, args.products)
+    if stage == 'cs':
+      outputs += ['cs/'+slice_file(r) for r in args.radii[:-1]]
+    if args.resume and stages.stage_complete(rundir, stage, params, outputs=outputs):
+      print("=> "+label+" solution already complete (resume), skipping.")
+    else:
+      tstart = time.time()
+      result = run_stage()
+      elapsed = time.time()-tstart
+      stages.record_stage(rundir, stage, params, outputs=outputs, elapsed=elapsed)
+      if result is not None:
+        grid, memory = result
+        planner.record_timing(stage, np.prod(grid), args.np, elapsed, memory)
+    if args.retain == 'minimal':
+      stages.release_intermediates(rundir)
+
+  print('===========================')
+  print('===========================')
+  print('=> PFSS+CS model complete!')
+  print('===========================')
+  print('===========================')
+
+  # Merge the two runs [NOT NEEDED FOR NOW - MAYBE LATER]
+  #print("=> Merging two runs")
+  #concate3D_dim2('pfss/br_pfss.h5','cs/br_cs.h5','br_pfsscs.h5',-1)
+  #concate3D_dim2('pfss/bt_pfss.h5','cs/bt_cs.h5','bt_pfsscs.h5',-2)
+  #concate3D_dim2('pfss/bp_pfss.h5','cs/bp_cs.h5','bp_pfsscs.h5',-2)
+
+#def concate3D_dim2(file1,file2,file3,dl):
+#  rvec1, tvec1, pvec1, data1   = ps.rdhdf_3d(file1)
+#  rvec2, tvec2, pvec2, data2   = ps.rdhdf_3d(file2)
+#  data1 = np.array(data1)
+#  data2 = np.array(data2)
+#  data = np.concatenate([data1[:,:,0:dl],data2], axis=2)
+#  rvec = np.concatenate([rvec1[0:dl],rvec2])
+#  ps.wrhdf_3d(file3, rvec, tvec1, pvec1, data)
+
+def run_pfss(args, br_input_file, pfss_file, pot3d):
 
   # Setup the PFSS run.
   print("=> Making directory to run PFSS: pfss")
@@ -109,12 +267,14 @@ def run(args):
   ntt = len(tvec)+1
   npp = len(pvec)+1
   
-  print("=> Copying input file template and input map to pfss directory...")
-  ierr = subprocess.run(['cp', pfss_file, 'pfss/pot3d.dat']).returncode
-  check_error_code(ierr,'Failed on copy of '+pfss_file+' to pfss/pot3d.dat')
-  sed('nt', str(ntt), 'pfss/pot3d.dat')
-  sed('np', str(npp), 'pfss/pot3d.dat')
-  sed('nr', str(int(np.ceil(npp/6.67))), 'pfss/pot3d.dat')
+  print("=> Writing input file from template and input map to pfss directory...")
+  nrr, ntt, npp = planner.pot3d_grid('pfss', ntt, npp)
+  pot3d_values = {'nt': ntt, 'np': npp, 'nr': nrr, 'r1': args.rss}
+  if 'pfss/br_r0_pfss.h5' not in stages.stage_outputs('pfss', args.products):
+    pot3d_values['br_photo_file'] = ''
+  if args.epscg:
+    pot3d_values['epscg'] = args.epscg
+  namelist_io.customize(pfss_file, 'pfss/pot3d.dat', pot3d_values)
 
 #  Command='grep "nt=" pfss/pot3d.dat'
 #  ierr = subprocess.run(["bash","-c",Command],stdout=subprocess.PIPE,stderr=subprocess.DEVNULL)
@@ -145,102 +305,114 @@ def run(args):
 
   ps.wrhdf_2d('pfss/br_input_tp.h5',tvec,pvec,data)
 
-  print("=> Entering pfss directory and modifying input file... ")
+  print("=> Entering pfss directory... ")
   os.chdir("pfss")
-  sed('r1',str(args.rss),'pot3d.dat')
 
-  print("=> Running POT3D for PFSS...")
-  Command='mpiexec -np '+str(args.np)+' '+pot3d +' 1>pot3d.log 2>pot3d.err'
-  print('   Command: '+Command)
-  ierr = subprocess.run(["bash","-c",Command])
-  check_error_code(ierr.returncode,'Failed : '+Command)
-  print("    ...done!")
+  if args.pfss_engine == 'spectral':
+    print("=> Computing spectral PFSS solution...")
+    nml = namelist_io.read_namelist('pot3d.dat')
+    fields = pfss_spectral.solve(tvec, pvec, np.transpose(data), args.rss, nrr,
+      r0=namelist_io.get_value(nml, 'r0'), drratio=namelist_io.get_value(nml, 'drratio'))
+    pfss_spectral.write_solution(fields, br_r0='br_photo_file' not in pot3d_values)
+    print("    ...done!")
+  elif args.pfss_engine == 'linear':
+    run_pfss_linear(args, tvec, pvec, data, pot3d, 'br_photo_file' not in pot3d_values)
+  else:
+    print("=> Running POT3D for PFSS...")
+    memory = run_pot3d(args, pot3d, 'POT3D (PFSS)')
 
   # Create input for CS. Here, we assume no overlap between PFSS
   # and CS so we just take the outer slice.
   rvec_pfss, tvec_pfss, pvec_pfss, data_pfss = ps.rdhdf_3d('br_pfss.h5')
   ps.wrhdf_2d('br_rss.h5', tvec_pfss, pvec_pfss, data_pfss[:,:,-1])
   os.chdir("..")
+  # Only POT3D runs go into the timing history.
+  return ((nrr, ntt, npp), memory) if args.pfss_engine == 'pot3d' else None
+
+def run_pfss_linear(args, tvec, pvec, data, pot3d, br_r0):
+
+  # PFSS solution of the reference map plus that of the difference.
+  print("=> Computing PFSS solution from "+args.pfss_mean+" plus the map difference (lmax="+str(args.lmax)+")...")
+  nml = namelist_io.read_namelist('pot3d.dat')
+  r0 = namelist_io.get_value(nml, 'r0')
+  report = pfss_spectral.perturb_solution(args.pfss_mean, tvec, pvec, np.transpose(data), args.rss,
+                                          r0=r0, lmax=args.lmax, br_r0=br_r0)
+  check_error_code(report is None,'ERROR: the map and the -pfss_mean map have different meshes.')
+  print(f"    ...done (difference {report['perturbation']:.2e}, truncation error {report['truncation_error']:.2e} of |Br|)")
+
+  if args.verify:
+    # Full POT3D solve of the same map for comparison.
+    print("=> Running POT3D for PFSS in verify/ for comparison...")
+    os.makedirs("verify", exist_ok=True)
+    for file in ('pot3d.dat', 'br_input_tp.h5'):
+      shutil.copyfile(file, 'verify/'+file)
+    os.chdir("verify")
+    run_pot3d(args, pot3d, 'POT3D (PFSS, verify)')
+    os.chdir("..")
+    report['versus_pot3d'] = pfss_spectral.compare('.', 'verify')
+    for name, diff in report['versus_pot3d'].items():
+      print(f"   {name}: relative L2 difference from POT3D {diff['rel_l2']:.3e}")
+
+  with open('linear_pfss.json', 'w') as f:
+    json.dump(report, f, indent=1)
+
+def run_cs(args, cs_file, pot3d):
+
+  # Read the PFSS input map for the grid size.
+  tvec, pvec, _ = ps.rdhdf_2d('pfss/br_input_tp.h5')
+  nrr, ntt, npp = planner.pot3d_grid('cs', len(tvec)+1, len(pvec)+1)
 
   # Set up the CS run.
   print("=> Making directory to run CS: cs")
   os.makedirs("cs", exist_ok=True)
-  print("=> Copying input file template and input map to cs directory...")
-  ierr = subprocess.run(['cp', cs_file, 'cs/pot3d.dat']).returncode
-  check_error_code(ierr,'Failed on copy of '+cs_file+' to cs/pot3d.dat')
-  sed('nt', str(ntt), 'cs/pot3d.dat')
-  sed('np', str(npp), 'cs/pot3d.dat')
-  sed('nr', str(int(np.ceil(npp/3.6))), 'cs/pot3d.dat')
+  print("=> Writing input file from template and copying input map to cs directory...")
+  pot3d_values = {'nt': ntt, 'np': npp, 'nr': nrr, 'r0': args.rss, 'r1': args.r1}
+  if args.epscg:
+    pot3d_values['epscg'] = args.epscg
+  namelist_io.customize(cs_file, 'cs/pot3d.dat', pot3d_values)
   ierr = subprocess.run(['cp', 'pfss/br_rss.h5', 'cs/']).returncode
   check_error_code(ierr,'Failed on copy of pfss/br_rss.h5 to cs/')
-  print("=> Entering cs directory and modifying input file... ")
+  print("=> Entering cs directory... ")
   os.chdir("cs")
-  sed('r0',str(args.rss),'pot3d.dat')
-  sed('r1',str(args.r1),'pot3d.dat')
 
   # CS POT3D
   print("=> Running POT3D for CS...")
-  Command='mpiexec -np '+str(args.np)+' '+pot3d +' 1>pot3d.log 2>pot3d.err'
-  print('   Command: '+Command)
-  ierr = subprocess.run(["bash","-c",Command])
-  check_error_code(ierr.returncode,'Failed : '+Command)
-  print("    ...done!")
+  memory = run_pot3d(args, pot3d, 'POT3D (CS)')
 
-  # Extract (unsigned) outer slice of CS Br for later use.
+  # Extract (unsigned) outer slice of CS Br for later use, and the
+  # slices at the other r1 radii.
   rvec_cs, tvec_cs, pvec_cs, data_cs = ps.rdhdf_3d('br_cs.h5')
   ps.wrhdf_2d('br_r1_cs.h5', tvec_cs, pvec_cs, data_cs[:,:,-1])
+  for r in args.radii[:-1]:
+    ps.wrhdf_2d(slice_file(r), tvec_cs, pvec_cs, radial_slice(np.asarray(rvec_cs), np.asarray(data_cs), r))
+    print("   ...wrote file: cs/"+slice_file(r))
   os.chdir("..")
-
-  print('===========================')
-  print('===========================')
-  print('=> PFSS+CS model complete!')
-  print('===========================')
-  print('===========================')
-
-  # Merge the two runs [NOT NEEDED FOR NOW - MAYBE LATER]
-  #print("=> Merging two runs")
-  #concate3D_dim2('pfss/br_pfss.h5','cs/br_cs.h5','br_pfsscs.h5',-1)
-  #concate3D_dim2('pfss/bt_pfss.h5','cs/bt_cs.h5','bt_pfsscs.h5',-2)
-  #concate3D_dim2('pfss/bp_pfss.h5','cs/bp_cs.h5','bp_pfsscs.h5',-2)
-
-#def concate3D_dim2(file1,file2,file3,dl):
-#  rvec1, tvec1, pvec1, data1   = ps.rdhdf_3d(file1)
-#  rvec2, tvec2, pvec2, data2   = ps.rdhdf_3d(file2)
-#  data1 = np.array(data1)
-#  data2 = np.array(data2)
-#  data = np.concatenate([data1[:,:,0:dl],data2], axis=2)
-#  rvec = np.concatenate([rvec1[0:dl],rvec2])
-#  ps.wrhdf_3d(file3, rvec, tvec1, pvec1, data)
-
-def get_sed_command():
-  """Detect which sed command to use and return appropriate arguments.
-  
-  Returns: (sed_cmd, suffix_args) where suffix_args is [''] for BSD sed or [] for GNU sed
-  """
-  # First check if gsed (GNU sed) is available
-  result = subprocess.run(['which', 'gsed'], capture_output=True, text=True)
-  if result.returncode == 0:
-    return ('gsed', [])
-  
-  # Check if system sed is GNU sed by testing --version flag
-  result = subprocess.run(['sed', '--version'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
-  if result.returncode == 0:
-    # GNU sed supports --version
-    return ('sed', [])
-  else:
-    # BSD sed (macOS) doesn't support --version and requires '' after -i
-    return ('sed', [''])
-
-# Cache the sed command detection
-_sed_cmd, _sed_suffix = get_sed_command()
-
-def sed(match,value,file):
-  match_pattern = '.*' + match + '=.*'
-  replace_pattern = '  ' + match + '=' + value
-  sed_directive = f's/{match_pattern}/{replace_pattern}/'
-  cmd = [_sed_cmd, '-i'] + _sed_suffix + [sed_directive, file]
-  ierr = subprocess.run(cmd).returncode
-  check_error_code(ierr, 'Failed on sed of '+match+' in '+file)
+  return (nrr, ntt, npp), memory
+
+def slice_file(r):
+  return f'br_r1_cs_{r:g}.h5'
+
+def radial_slice(rvec, data, r):
+  # Slice of data (np,nt,nr) at radius r.  r^2 Br is nearly constant
+  # in the outer corona, so it is interpolated linearly in r.
+  k = int(np.clip(np.searchsorted(rvec, r), 1, len(rvec)-1))
+  w = (r - rvec[k-1])/(rvec[k] - rvec[k-1])
+  return ((1-w)*rvec[k-1]**2*data[:,:,k-1] + w*rvec[k]**2*data[:,:,k])/r**2
+
+def run_pot3d(args, pot3d, label):
+  # Run POT3D in the current directory under the watchdog, which aborts
+  # it early on errors, a stalled solve, or the time/iteration limits.
+  # Returns the peak memory (bytes) of the run: that of its largest
+  # rank times the ranks (None if unknown).
+  Command='mpiexec -np '+str(args.np)+' '+pot3d +' 1>pot3d.log 2>pot3d.err'
+  print('   Command: '+Command)
+  usage = {}
+  ierr, failure = watchdog.run_watched(Command, label, watchdog.POT3D_LOGS, watchdog.POT3D_FATAL,
+    report=os.path.join('..', watchdog.REPORT_NAME), time_limit=args.time_limit,
+    max_iterations=args.max_iterations, stall_iterations=args.stall_iterations, usage=usage)
+  check_error_code(ierr,'Failed : '+Command+(' ('+failure['reason']+': '+failure['detail']+')' if failure else ''))
+  print("    ...done!")
+  return usage['memory']*args.np if 'memory' in usage else None
 
 def check_error_code(ierr,message):
   if ierr > 0:
@@ -273,4 +445,29 @@ if __name__ == '__main__':
 #       - POT3D resolution is now autoset based on the input map size.
 #       - Changed sed command so it can also work on macOS.
 #
+# ### Version 1.3.0, 10/19/2026:
+#       - Split PFSS and CS runs into separate stages recorded in the
+#         run manifest (swig_manifest.json).
+#       - Added -resume to skip stages that already completed.
+#       - Added -retain to delete intermediates once no longer needed.
+#       - Added -stages to run only the PFSS or the CS solve.
+#       - Added -products to skip solver outputs that are not needed.
+#       - POT3D input files are now written with namelist_io.py instead
+#         of sed.
+#       - Each POT3D run's grid size, -np, time, and peak memory is
+#         added to the timing history used by swig_planner.py.
+#       - POT3D now runs under a watchdog (solver_watchdog.py) that aborts
+#         it on errors, a stalled CG solve, or the new -time_limit,
+#         -max_iterations, and -stall_iterations budgets, and writes the
+#         reason to watchdog_failure.json.
+#       - Added -epscg to override the CG tolerance of the templates.
+#       - Added -pfss_engine spectral to compute the PFSS solution with
+#         the spherical-harmonic solver pfss_spectral.py instead of POT3D.
+#       - Added -pfss_engine linear (with -pfss_mean, -lmax, and -verify)
+#         to obtain the PFSS solution of a map from the POT3D solution of
+#         a nearby map plus the spectral solution of their difference.
+#       - -r1 accepts a comma-separated list of radii: the CS model is
+#         solved to the largest and the Br slice at each of the others is
+#         written to cs/br_r1_cs_<r1>.h5.
+#
 ########################################################################
@@ -0,0 +1,221 @@
+import numpy as np
+#
+import psi_io as ps
+
+########################################################################
+#  FIELDLINE_TRACER: Field line tracing of POT3D solutions in NumPy
+########################################################################
+#        Predictive Science Inc.
+#        www.predsci.com
+#        San Diego, California, USA 92121
+########################################################################
+# Copyright 2024 Predictive Science Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+########################################################################
+#
+# An alternative to MAPFL (mag_trace_analysis.py -tracer python) for
+# screening runs and machines without the compiled tracer.  All field
+# lines of a seed mesh are integrated at once as NumPy arrays with the
+# classical RK4 scheme, in Cartesian coordinates (so that the poles are
+# not singular).  Each component of B is interpolated trilinearly on its
+# own (staggered) POT3D mesh, periodic in phi.  The step is a fraction
+# of the local radial and theta mesh spacing, and a field line ends
+# where it crosses the inner or outer radius (the crossing point is
+# interpolated linearly within the last step).
+#
+# trace_pfss() and trace_cs() write the files that MAPFL writes with
+# the rsrc/mapfl_pfss.in and rsrc/mapfl_cs.in templates, on the same
+# uniform seed meshes (ntss x npss points including both poles and phi
+# 0 and 2pi) and in the same layouts (ofm_r0.h5 pt, the others tp):
+#   rss_r0_t.h5, rss_r0_p.h5: r0 footpoints of the rss points,
+#   expfac_rss_r0.h5:         (|B| at r0)/(|B| at rss)*(r0/rss)^2,
+#   ofm_r0.h5:                sign of Br at r0 of the open field lines
+#                             (that reach rss), 0 for closed ones,
+#   r1_rss_t.h5, r1_rss_p.h5: rss footpoints of the r1 points of CS.
+# The Q maps (slogq_*) are not computed.
+#
+########################################################################
+
+# Field line status.
+REACHED_INNER = 0
+REACHED_OUTER = 1
+UNFINISHED = -1
+
+def read_component(file):
+  # One component of B with its mesh.  Phi is reduced to its distinct
+  # points (the POT3D meshes repeat the first point, or have a ghost
+  # point at each end).
+  r, t, p, f = ps.rdhdf_3d(file)
+  r, t, p, f = (np.asarray(a, dtype=np.float64) for a in (r, t, p, f))
+  tol = 1e-6
+  start, stop = 0, len(p)
+  if abs(p[-1] - p[0] - 2*np.pi) <= tol:
+    stop = len(p) - 1
+  elif p[-1] - p[0] > 2*np.pi + tol:
+    start, stop = 1, len(p) - 1
+  p = p[start:stop]
+  return {'r': r, 't': t, 'p': p, 'p_ext': np.append(p, p[0] + 2*np.pi),
+          'f': np.ascontiguousarray(f[start:stop])}
+
+def read_field(directory, brfile, btfile, bpfile):
+  return [read_component(f'{directory}/{file}') for file in (brfile, btfile, bpfile)]
+
+def cell(scale, x):
+  # Cell index and linear weight of each x in scale (clamped to it).
+  x = np.clip(x, scale[0], scale[-1])
+  i = np.clip(np.searchsorted(scale, x) - 1, 0, len(scale) - 2)
+  return i, (x - scale[i])/(scale[i+1] - scale[i])
+
+def interpolate(comp, r, t, p):
+  # Trilinear interpolation of a component at the points (r, t, p).
+  ir, wr = cell(comp['r'], r)
+  it, wt = cell(comp['t'], t)
+  n = len(comp['p'])
+  p = comp['p'][0] + np.mod(p - comp['p'][0], 2*np.pi)
+  ip = np.clip(np.searchsorted(comp['p_ext'], p, side='right') - 1, 0, n - 1)
+  wp = (p - comp['p_ext'][ip])/(comp['p_ext'][ip+1] - comp['p_ext'][ip])
+  # Gathers from the flattened field (f is (np, nt, nr)).
+  f = comp['f']
+  nt, nr = f.shape[1], f.shape[2]
+  flat = f.ravel()
+  value = 0.0
+  for jp, cp in ((ip, 1 - wp), ((ip + 1) % n, wp)):
+    for jt, ct in ((it, 1 - wt), (it + 1, wt)):
+      k = (jp*nt + jt)*nr + ir
+      value = value + cp*ct*((1 - wr)*np.take(flat, k) + wr*np.take(flat, k + 1))
+  return value
+
+def to_spherical(x):
+  r = np.sqrt(np.sum(x*x, axis=1))
+  t = np.arccos(np.clip(x[:, 2]/r, -1, 1))
+  p = np.mod(np.arctan2(x[:, 1], x[:, 0]), 2*np.pi)
+  return r, t, p
+
+def to_cartesian(r, t, p):
+  return np.column_stack((r*np.sin(t)*np.cos(p), r*np.sin(t)*np.sin(p), r*np.cos(t)))
+
+def field(fld, x):
+  # Cartesian B and its magnitude at the points x (n, 3).
+  r, t, p = to_spherical(x)
+  br, bt, bp = (interpolate(comp, r, t, p) for comp in fld)
+  st, ct, sp, cp = np.sin(t), np.cos(t), np.sin(p), np.cos(p)
+  b = np.column_stack((br*st*cp + bt*ct*cp - bp*sp,
+                       br*st*sp + bt*ct*sp + bp*cp,
+                       br*ct - bt*st))
+  return b, np.sqrt(np.sum(b*b, axis=1))
+
+def trace(fld, r, t, p, sign, r_min, r_max, step=0.5, max_length=10000.0):
+  # Trace field lines from the points (r, t, p) along sign*B until they
+  # cross r_min or r_max.  Returns the end points (r, t, p) and status.
+  x = to_cartesian(r, t, p)
+  sign = np.asarray(sign, dtype=np.float64)*np.ones(len(x))
+  status = np.full(len(x), UNFINISHED)
+  length = np.zeros(len(x))
+  active = np.arange(len(x))
+  dr = np.diff(fld[0]['r'])
+  dt = np.min(np.diff(fld[1]['t']))
+  def rhs(points, s):
+    b, bmag = field(fld, points)
+    return s[:, None]*b/np.maximum(bmag, 1e-300)[:, None]
+  while len(active):
+    xa, sa = x[active], sign[active]
+    ra = np.sqrt(np.sum(xa*xa, axis=1))
+    ir = np.clip(np.searchsorted(fld[0]['r'], ra) - 1, 0, len(dr) - 1)
+    h = (step*np.minimum(dr[ir], ra*dt))[:, None]
+    k1 = rhs(xa, sa)
+    k2 = rhs(xa + 0.5*h*k1, sa)
+    k3 = rhs(xa + 0.5*h*k2, sa)
+    k4 = rhs(xa + h*k3, sa)
+    xn = xa + h*(k1 + 2*k2 + 2*k3 + k4)/6
+    rn = np.sqrt(np.sum(xn*xn, axis=1))
+    length[active] += h[:, 0]
+    # End the lines that crossed a boundary at the crossing point.
+    for bound, reached, crossed in ((r_min, REACHED_INNER, rn <= r_min),
+                                    (r_max, REACHED_OUTER, rn >= r_max)):
+      if np.any(crossed):
+        w = ((ra - bound)/np.where(ra != rn, ra - rn, 1.0))[crossed, None]
+        xn[crossed] = xa[crossed] + w*(xn[crossed] - xa[crossed])
+        status[active[crossed]] = reached
+    x[active] = xn
+    active = active[(status[active] == UNFINISHED) & (length[active] < max_length)]
+  return (*to_spherical(x), status)
+
+def seed_mesh(ntss, npss):
+  return np.linspace(0, np.pi, ntss), np.linspace(0, 2*np.pi, npss)
+
+def seeds(tvec, pvec, r):
+  # Seed points (flattened in the (p, t) order of the output files).
+  p, t = np.meshgrid(pvec, tvec, indexing='ij')
+  return np.full(p.size, float(r)), t.ravel(), p.ravel()
+
+def write_map(file, tvec, pvec, f, pt=False):
+  # Write the values at the seed points tp, or pt (as MAPFL writes
+  # ofm_r0.h5).
+  f = np.reshape(f, (len(pvec), len(tvec)))
+  if pt:
+    ps.wrhdf_2d(file, pvec, tvec, np.transpose(f))
+  else:
+    ps.wrhdf_2d(file, tvec, pvec, f)
+
+def domain(fld):
+  # Radial extent of the solution (the mesh of Br).
+  return fld[0]['r'][0], fld[0]['r'][-1]
+
+def trace_pfss(directory, ntss, npss, r0=None, outputs=None, step=0.5):
+  # MAPFL outputs of the PFSS solution in directory (see above).  Lines
+  # are traced down to r0 (default: the inner boundary).
+  fld = read_field(directory, 'br_pfss.h5', 'bt_pfss.h5', 'bp_pfss.h5')
+  r_min, rss = domain(fld)
+  r0 = max(r0 or r_min, r_min)
+  tvec, pvec = seed_mesh(ntss, npss)
+  outputs = outputs or ['rss_r0_t.h5', 'rss_r0_p.h5', 'expfac_rss_r0.h5', 'ofm_r0.h5']
+  unfinished = 0
+
+  if {'rss_r0_t.h5', 'rss_r0_p.h5', 'expfac_rss_r0.h5'} & set(outputs):
+    # Backward from rss to r0.
+    r, t, p = seeds(tvec, pvec, rss)
+    b_rss = interpolate(fld[0], r, t, p)
+    r_end, t_end, p_end, status = trace(fld, r, t, p, -np.sign(b_rss), r0, rss + 1.0, step)
+    unfinished += np.count_nonzero(status != REACHED_INNER)
+    write_map(f'{directory}/rss_r0_t.h5', tvec, pvec, t_end)
+    write_map(f'{directory}/rss_r0_p.h5', tvec, pvec, p_end)
+    _, bmag_rss = field(fld, to_cartesian(r, t, p))
+    _, bmag_r0 = field(fld, to_cartesian(r_end, t_end, p_end))
+    expfac = np.where(status == REACHED_INNER,
+                      bmag_r0/np.maximum(bmag_rss, 1e-300)*(r0/rss)**2, 0.0)
+    write_map(f'{directory}/expfac_rss_r0.h5', tvec, pvec, expfac)
+
+  if 'ofm_r0.h5' in outputs:
+    # Forward from r0: open lines reach rss.
+    r, t, p = seeds(tvec, pvec, r0)
+    b_r0 = interpolate(fld[0], r, t, p)
+    status = trace(fld, r, t, p, np.where(b_r0 >= 0, 1.0, -1.0), r0, rss, step)[3]
+    unfinished += np.count_nonzero(status == UNFINISHED)
+    write_map(f'{directory}/ofm_r0.h5', tvec, pvec, np.where(status == REACHED_OUTER, np.sign(b_r0), 0.0), pt=True)
+  return unfinished
+
+def trace_cs(directory, ntss, npss, r1=None, step=0.5):
+  # MAPFL outputs of the CS solution in directory: lines traced back
+  # from r1 (default: the outer boundary) to rss.
+  fld = read_field(directory, 'br_cs.h5', 'bt_cs.h5', 'bp_cs.h5')
+  rss, r_max = domain(fld)
+  r1 = min(r1 or r_max, r_max)
+  tvec, pvec = seed_mesh(ntss, npss)
+  r, t, p = seeds(tvec, pvec, r1)
+  b_r1 = interpolate(fld[0], r, t, p)
+  r_end, t_end, p_end, status = trace(fld, r, t, p, np.where(b_r1 >= 0, -1.0, 1.0), rss, r_max + 1.0, step)
+  write_map(f'{directory}/r1_rss_t.h5', tvec, pvec, t_end)
+  write_map(f'{directory}/r1_rss_p.h5', tvec, pvec, p_end)
+  return np.count_nonzero(status != REACHED_INNER)
@@ -1,12 +1,21 @@
 #!/usr/bin/env python3
 import os
 import sys
-import subprocess
 import numpy as np
 import argparse
-from scipy.interpolate import RegularGridInterpolator
+import hashlib
+import time
+import tempfile
+from collections import OrderedDict
 #
 import psi_io as ps
+import namelist_io
+import solver_watchdog as watchdog
+import mapfl_sectors
+import adaptive_seeds
+import swig_stages as stages
+import swig_planner as planner
+import fieldline_tracer as tracer
 
 ########################################################################
 #  MAG_TRACE_ANALYSIS #
@@ -51,37 +60,93 @@ def argParsing():
     default=1.0,
     required=False)
 
-  return parser.parse_args()
+  parser.add_argument('-r1',
+    help='Radius to trace the CS field lines back to rss from (default is the outer boundary of the CS solution).',
+    dest='r1',
+    type=float,
+    required=False)
 
-def get_sed_command():
-  """Detect which sed command to use and return appropriate arguments.
-  
-  Returns: (sed_cmd, suffix_args) where suffix_args is [''] for BSD sed or [] for GNU sed
-  """
-  # First check if gsed (GNU sed) is available
-  result = subprocess.run(['which', 'gsed'], capture_output=True, text=True)
-  if result.returncode == 0:
-    return ('gsed', [])
-  
-  # Check if system sed is GNU sed by testing --version flag
-  result = subprocess.run(['sed', '--version'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
-  if result.returncode == 0:
-    # GNU sed supports --version
-    return ('sed', [])
-  else:
-    # BSD sed (macOS) doesn't support --version and requires '' after -i
-    return ('sed', [''])
+  parser.add_argument('-dchb_method',
+    help='How DCHB at r1 is computed: composed (default) computes it only at the r0 footpoints of the r1 points (the r1->rss and rss->r0 mappings composed), grid computes it on the whole rss tracing grid and interpolates it to r1.',
+    dest='dchb_method',
+    type=str,
+    choices=['composed', 'grid'],
+    default='composed',
+    required=False)
+
+  parser.add_argument('-tracer',
+    help='Field line tracer: mapfl (default) runs MAPFL, python traces with fieldline_tracer.py (no MAPFL needed, no Q maps).',
+    dest='tracer',
+    type=str,
+    choices=['mapfl', 'python'],
+    default='mapfl',
+    required=False)
+
+  parser.add_argument('-retain',
+    help='Retention policy for intermediate files: all (default) keeps everything, minimal deletes each intermediate as soon as the last stage that reads it has completed.',
+    dest='retain',
+    type=str,
+    choices=stages.RETAIN_POLICIES,
+    default='all',
+    required=False)
+
+  parser.add_argument('-resume',
+    help='Skip analysis stages that the run manifest shows already completed with the same inputs.',
+    dest='resume',
+    action='store_true',
+    default=False,
+    required=False)
 
-# Cache the sed command detection
-_sed_cmd, _sed_suffix = get_sed_command()
+  parser.add_argument('-stages',
+    help='Comma-separated list of stages to run (default: pfss_trace,cs_trace,expfac,dchb,br_r1).  Used by the swig.py scheduler to run each stage as its own job.',
+    dest='stages',
+    type=str,
+    default='pfss_trace,cs_trace,expfac,dchb,br_r1',
+    required=False)
+
+  parser.add_argument('-products',
+    help='Comma-separated list of final SWiG products that will be needed (default: all).  Traces and Q maps that none of them need are skipped.',
+    dest='products',
+    type=str,
+    default=','.join(stages.PRODUCTS),
+    required=False)
 
-def sed(match,value,file):
-  match_pattern = '.*' + match + '=.*'
-  replace_pattern = '  ' + match + '=' + value
-  sed_directive = f's@{match_pattern}@{replace_pattern}@'
-  cmd = [_sed_cmd, '-i'] + _sed_suffix + [sed_directive, file]
-  ierr = subprocess.run(cmd).returncode
-  check_error_code(ierr, 'Failed on sed of '+match+' in '+file)
+  parser.add_argument('-adaptive',
+    help='Refine the PFSS seed mesh adaptively in this many levels (default 0: trace every point): every 2^N-th point is traced first, then only the cells near OFM changes, steep expansion factor gradients, high slogQ, or footpoint jumps are refined, and the rest is interpolated.',
+    dest='adaptive',
+    type=int,
+    default=0,
+    required=False)
+
+  parser.add_argument('-sectors',
+    help='Split the MAPFL seed mesh into this many sectors traced by concurrent MAPFL processes, and stitch their outputs (default 1: one MAPFL run).',
+    dest='sectors',
+    type=int,
+    default=1,
+    required=False)
+
+  parser.add_argument('-sector_axis',
+    help='Axis along which the seed mesh is split with -sectors: p (phi, default) or t (theta).',
+    dest='sector_axis',
+    type=str,
+    choices=['p', 't'],
+    default='p',
+    required=False)
+
+  parser.add_argument('-cores',
+    help='Cores shared by the concurrent MAPFL runs of -sectors or -adaptive, each run with its share as OMP_NUM_THREADS (default: all cores).',
+    dest='cores',
+    type=int,
+    default=os.cpu_count() or 1,
+    required=False)
+
+  parser.add_argument('-time_limit',
+    help='Abort a MAPFL run that takes longer than this many seconds (default: no limit).',
+    dest='time_limit',
+    type=float,
+    required=False)
+
+  return parser.parse_args()
 
 def run(args):
 
@@ -105,8 +170,70 @@ def run(args):
 
   mapfl=bindir+'/../mapfl/bin/mapfl'
 
+  args.products = stages.parse_products(args.products)
+  check_error_code(args.products is None,'ERROR: invalid -products (choose from '+','.join(stages.PRODUCTS)+').')
+
   # Change directory to the run directory.
   os.chdir(args.rundir)
+  rundir = os.getcwd()
+
+  if args.tracer == 'python':
+    print('=> Tracing field lines with fieldline_tracer.py instead of MAPFL.')
+    qmaps = [f for f in stages.stage_outputs('pfss_trace', args.products) if 'slogq' in f]
+    check_error_code(len(qmaps) > 0 and 'pfss_trace' in args.stages.split(','),
+      'ERROR: -tracer python does not compute the Q maps (drop slogq_r0,slogq_rss from -products).')
+    check_error_code(args.adaptive > 0, 'ERROR: -adaptive needs -tracer mapfl.')
+
+  # The MAPFL stages keep their manifest parameters as before.
+  tracer_params = {'tracer': args.tracer} if args.tracer != 'mapfl' else {}
+  adaptive_params = {'adaptive': args.adaptive} if args.adaptive else {}
+  stage_list = [
+    ('pfss_trace', lambda: trace_pfss(args, pfss_file, mapfl), {'r0_trace': args.r0_trace, **tracer_params, **adaptive_params}),
+    ('cs_trace',   lambda: trace_cs(args, cs_file, mapfl),     {**({'r1': args.r1} if args.r1 else {}), **tracer_params}),
+    ('expfac',     project_expfac,                             {}),
+    ('dchb',       lambda: compute_dchb(args, bindir),         {'method': args.dchb_method}),
+    ('br_r1',      assign_br_r1_polarity,                      {}),
+  ]
+  selected = args.stages.split(',')
+  for stage in selected:
+    check_error_code(stage not in [s[0] for s in stage_list],'ERROR: unknown stage '+stage+'.')
+
+  # Map size, for the timing history (the map may already be released).
+  map_points = None
+  if os.path.exists('pfss/br_input_tp.h5'):
+    tvec, pvec = ps.rdhdf_scales('pfss/br_input_tp.h5')[:2]
+    map_points = len(tvec)*len(pvec)
+
+  for stage, run_stage, params in stage_list:
+    if stage not in selected:
+      continue
+    outputs = stages.stage_outputs(stage, args.products)
+    if stage == 'dchb' and args.dchb_method == 'composed':
+      # DCHB is not computed on the rss grid.
+      outputs = [f for f in outputs if f != 'pfss/dchb_rss.h5']
+    if args.resume and stages.stage_complete(rundir, stage, params, outputs=outputs):
+      print("=> Stage "+stage+" already complete (resume), skipping.")
+      continue
+    tstart = time.time()
+    run_stage()
+    elapsed = time.time()-tstart
+    stages.record_stage(rundir, stage, params, outputs=outputs, elapsed=elapsed)
+    if map_points:
+      planner.record_timing(stage, map_points, 1, elapsed)
+    if args.retain == 'minimal':
+      stages.release_intermediates(rundir)
+
+  print('===========================================')
+  print('===========================================')
+  print('=> Magnetic field trace analysis complete!')
+  print('===========================================')
+  print('===========================================')
+
+# Refinement criteria of the adaptive PFSS tracing (adaptive_seeds.py).
+ADAPTIVE_KINDS = {'ofm_r0.h5': 'ofm', 'expfac_rss_r0.h5': 'expfac', 'slogq_r0.h5': 'slogq', 'slogq_rss.h5': 'slogq'}
+ADAPTIVE_FOOTPOINTS = [('rss_r0_t.h5', 'rss_r0_p.h5')]
+
+def trace_pfss(args, pfss_file, mapfl):
 
   # 1) Trace PFSS backward from rss to r0:
   #  - theta coords            -> rss_r0_t.h5
@@ -114,73 +241,168 @@ def run(args):
   #  - expansion factor at rss -> expfac_rss_r0.h5
   #  - Make OFM from r0 to rss -> ofm_r0.h5 (-1, 0 1)
 
-  # Setup the PFSS MAPFL tracing:
-  print("=> Running MAPFL on PFSS solution... ")
   os.chdir("pfss")
-  ierr = os.system('cp '+pfss_file+' mapfl.in')
-  check_error_code(ierr,'Failed on copy of '+pfss_file+' to mapfl.in')
 
   tvec, pvec, _ = ps.rdhdf_2d('br_input_tp.h5')
   ntss = len(tvec)
   npss = len(pvec)
-  
-  # Set the lower tracing limits and dimensions:
-  sed('ch_map_r',str(args.r0_trace),'mapfl.in')
-  sed('domain_r_min',str(args.r0_trace),'mapfl.in')
-  sed('ntss',str((ntss - 1) * 2 + 1),'mapfl.in')
-  sed('npss',str((npss - 1) * 2 + 1),'mapfl.in')
 
-  Command=mapfl +' 1>mapfl.log 2>mapfl.err'
-  print('   Command: '+Command)
-  ierr = subprocess.run(["bash","-c",Command])
-  check_error_code(ierr.returncode,'Failed : '+Command)
-  line_to_check='A field line did not reach'
-  check_file_for_line(line_to_check,'mapfl.log','Failed : A field line did not reach R0 or R1.')
+  outputs = stages.stage_outputs('pfss_trace', args.products)
+  if args.tracer == 'python':
+    print("=> Tracing PFSS solution (python)... ")
+    unfinished = tracer.trace_pfss('.', (ntss - 1) * 2 + 1, (npss - 1) * 2 + 1, args.r0_trace,
+                                   outputs=[os.path.basename(f) for f in outputs])
+    check_error_code(unfinished, 'ERROR: '+str(unfinished)+' PFSS field line(s) did not reach R0 or R1.')
+    print("    ...done!")
+    os.chdir("..")
+    return
+
+  # Setup the PFSS MAPFL tracing:
+  print("=> Running MAPFL on PFSS solution... ")
+
+  # Set the lower tracing limits and dimensions:
+  mapfl_values = {'ch_map_r': args.r0_trace, 'domain_r_min': args.r0_trace,
+                  'ntss': (ntss - 1) * 2 + 1, 'npss': (npss - 1) * 2 + 1}
+
+  # Only trace (and compute Q) in the directions the products need.
+  if 'pfss/slogq_r0.h5' not in outputs:
+    mapfl_values['trace_fwd'] = False
+  if 'pfss/slogq_rss.h5' not in outputs:
+    mapfl_values['slogqbfile'] = ' '
+    if 'pfss/rss_r0_t.h5' not in outputs:
+      mapfl_values['trace_bwd'] = False
+  namelist_io.customize(pfss_file, 'mapfl.in', mapfl_values)
+
+  if args.adaptive:
+    run_mapfl_adaptive(args, mapfl, 'MAPFL (PFSS)', ADAPTIVE_KINDS, ADAPTIVE_FOOTPOINTS)
+  else:
+    run_mapfl(args, mapfl, 'MAPFL (PFSS)')
 
   print("    ...done!")
   os.chdir("..")
 
-  # 2) Trace CS backwards from r1 to rss:
+def trace_cs(args, cs_file, mapfl):
+
+  # 2) Trace CS backwards from r1 (-r1, or the outer boundary) to rss:
   #  - theta coords -> r1_rss_t.h5
   #  - phi coords   -> r1_rss_p.h5
 
+  tvec, pvec, _ = ps.rdhdf_2d('pfss/br_input_tp.h5')
+  ntss = len(tvec)
+  npss = len(pvec)
+
+  os.chdir("cs")
+  if args.tracer == 'python':
+    print("=> Tracing CS solution (python)...")
+    unfinished = tracer.trace_cs('.', ntss, npss, args.r1)
+    check_error_code(unfinished, 'ERROR: '+str(unfinished)+' CS field line(s) did not reach rss.')
+    print("    ...done!")
+    os.chdir("..")
+    return
+
   # Setup the CS MAPFL tracing:
   print("=> Running MAPFL on CS solution...")
-  os.chdir("cs")
-  ierr = os.system('cp '+cs_file+' mapfl.in')
-  check_error_code(ierr,'Failed on copy of '+cs_file+' to mapfl.in')
-  sed('ntss', str(ntss), 'mapfl.in')
-  sed('npss', str(npss), 'mapfl.in')
-  Command=mapfl +' 1>mapfl.log 2>mapfl.err'
-  print('   Command: '+Command)
-  ierr = subprocess.run(["bash","-c",Command])
-  check_error_code(ierr.returncode,'Failed : '+Command)
-  line_to_check='A field line did not reach'
-  check_file_for_line(line_to_check,'mapfl.log','Failed : A field line did not reach R0 or R1.')
+  mapfl_values = {'ntss': ntss, 'npss': npss}
+  if args.r1:
+    mapfl_values['r1'] = args.r1
+  namelist_io.customize(cs_file, 'mapfl.in', mapfl_values)
+  run_mapfl(args, mapfl, 'MAPFL (CS)')
 
   print("    ...done!")
   os.chdir("..")
 
-  print("=> Reading in trace results for processing...")
-  # Read in all required tracing results:
+def project_expfac():
+
+  print("=> Projecting expansion factor at RSS out to R1...")
   t_r1_rss,        p_r1_rss,        r1_rss_t      = ps.rdhdf_2d('cs/r1_rss_t.h5')
   _,               _,               r1_rss_p      = ps.rdhdf_2d('cs/r1_rss_p.h5')
-  t_br_r1_cs,      p_br_r1_cs,      br_r1_cs      = ps.rdhdf_2d('cs/br_r1_cs.h5')
-  t_br_rss_pm_cs,  p_br_rss_pm_cs,  br_rss_pm_cs  = ps.rdhdf_2d('cs/br_rss_pm_cs.h5')
   t_expfac_rss_r0, p_expfac_rss_r0, expfac_rss_r0 = ps.rdhdf_2d('pfss/expfac_rss_r0.h5')
 
-  print("=> Projecting expansion factor at RSS out to R1...")
   # Get expansion factor at r1 through interpolation:
   expfac_r1_r0 = slice_tp(t_expfac_rss_r0, p_expfac_rss_r0, expfac_rss_r0, r1_rss_t, r1_rss_p)
   ps.wrhdf_2d('expfac_rss_at_r1.h5', p_r1_rss, t_r1_rss, np.transpose(expfac_r1_r0))
   print("   ...wrote file: expfac_rss_at_r1.h5")
 
+def compute_dchb(args, bindir):
+  if args.dchb_method == 'grid':
+    compute_dchb_grid(bindir)
+  else:
+    compute_dchb_composed(bindir)
+
+def compute_dchb_composed(bindir):
+
+  print("=> Composing the R1->RSS and RSS->R0 mappings...")
+  t_r1_rss,        p_r1_rss,        r1_rss_t     = ps.rdhdf_2d('cs/r1_rss_t.h5')
+  _,               _,               r1_rss_p     = ps.rdhdf_2d('cs/r1_rss_p.h5')
+  t_rss_r0,        p_rss_r0,        rss_r0_t     = ps.rdhdf_2d('pfss/rss_r0_t.h5')
+  _,               _,               rss_r0_p     = ps.rdhdf_2d('pfss/rss_r0_p.h5')
+
+  # Interpolate the R0 footpoints of the RSS points to the RSS end of
+  # each R1 field line.
+  r1_r0_t, r1_r0_p = compose_footpoints(t_rss_r0, p_rss_r0, rss_r0_t, rss_r0_p, r1_rss_t, r1_rss_p)
+
+  # The composed footpoints and their DCHB are only passed through
+  # ch_distance.py, in a temporary directory that is then deleted.
+  with tempfile.TemporaryDirectory(prefix='dchb_', dir='cs') as tmpdir:
+    ps.wrhdf_2d(tmpdir+'/r1_r0_t.h5', t_r1_rss, p_r1_rss, r1_r0_t)
+    ps.wrhdf_2d(tmpdir+'/r1_r0_p.h5', t_r1_rss, p_r1_rss, r1_r0_p)
+
+    print("=> Calculating the distance to open field boundaries (DCHB) at the R1 footpoints... ")
+    command = bindir+'/ch_distance.py -t '+tmpdir+'/r1_r0_t.h5 -p '+tmpdir+'/r1_r0_p.h5 -force_ch -chfile pfss/ofm_r0.h5 -dfile '+tmpdir+'/dchb_r1.h5'
+    ierr = os.system(command)
+    check_error_code(ierr,'Failed on : '+command)
+    _,               _,               dchb_r1      = ps.rdhdf_2d(tmpdir+'/dchb_r1.h5')
+  ps.wrhdf_2d('dchb_at_r1.h5', p_r1_rss, t_r1_rss, np.transpose(dchb_r1))
+  print("   ...wrote file: dchb_at_r1.h5")
+
+# Footpoints of an RSS cell whose corners are more than this many cell
+# sizes apart are not interpolated (see compose_footpoints).
+FOOTPOINT_SPREAD = 2.0
+
+def compose_footpoints(t_f, p_f, ft, fp, t, p):
+  # R0 footpoints (ft, fp on the RSS grid (p_f, t_f)) at the RSS points
+  # (t, p).  The footpoints are interpolated as unit vectors so that phi
+  # wraps around.  Field lines converge from RSS to R0, so the corner
+  # footpoints of a cell are normally closer together than the cell;
+  # where they are more than FOOTPOINT_SPREAD cell sizes apart (the cell
+  # straddles a separatrix, and its corners map to different parts of
+  # R0), the average would land in between, so the footpoint of the
+  # nearest corner is used instead.
+  ft, fp = np.asarray(ft), np.asarray(fp)
+  t_f, p_f = np.asarray(t_f, dtype=np.float64), np.asarray(p_f, dtype=np.float64)
+  plan = cached_plan(t_f, p_f, t, p)
+  wp, wt = plan['wp'], plan['wt']
+  corners = [(plan['ip0'], plan['it0'], (1 - wp)*(1 - wt)), (plan['ip1'], plan['it0'], wp*(1 - wt)),
+             (plan['ip0'], plan['it1'], (1 - wp)*wt),       (plan['ip1'], plan['it1'], wp*wt)]
+  vecs = np.stack([np.stack([np.sin(ft[ip, it])*np.cos(fp[ip, it]), np.sin(ft[ip, it])*np.sin(fp[ip, it]),
+                             np.cos(ft[ip, it])], axis=-1) for ip, it, _ in corners])
+  weights = np.stack([w for _, _, w in corners])
+  v = np.sum(weights[..., None]*vecs, axis=0)
+  v[plan['outside']] = 0
+
+  nearest = vecs[np.argmax(weights, axis=0), np.arange(weights.shape[1])]
+  spread = np.max(np.arccos(np.clip(np.sum(vecs*nearest, axis=-1), -1, 1)), axis=0)
+  dt = np.abs(t_f[plan['it1']] - t_f[plan['it0']])
+  dp = np.mod(p_f[plan['ip1']] - p_f[plan['ip0']], 2*np.pi)*np.sin(0.5*(t_f[plan['it1']] + t_f[plan['it0']]))
+  diverged = (spread > FOOTPOINT_SPREAD*np.hypot(dt, dp)) & ~plan['outside']
+  v[diverged] = nearest[diverged]
+
+  x, y, z = v[:, 0], v[:, 1], v[:, 2]
+  norm = np.maximum(np.sqrt(x*x + y*y + z*z), 1e-300)
+  t0 = np.arccos(np.clip(z/norm, -1, 1)).reshape(plan['shape'])
+  p0 = np.mod(np.arctan2(y, x), 2*np.pi).reshape(plan['shape'])
+  return t0, p0
+
+def compute_dchb_grid(bindir):
+
   print("=> Calculating the distance to open field boundaries (DCHB)... ")
   print("   (automatically projecting DCHB at R0 to RSS)")
   # Get DCHB at rss:
   ierr = os.system(bindir+'/ch_distance.py -t pfss/rss_r0_t.h5 -p pfss/rss_r0_p.h5 -force_ch -chfile pfss/ofm_r0.h5 -dfile pfss/dchb_rss.h5')
   check_error_code(ierr,'Failed on : '+bindir+'/ch_distance.py -t pfss/rss_r0_t.h5 -p pfss/rss_r0_p.h5 -force_ch -chfile pfss/ofm_r0.h5 -dfile pfss/dchb_rss.h5')
   t_dchb_rss,      p_dchb_rss,      dchb_rss     = ps.rdhdf_2d('pfss/dchb_rss.h5')
+  t_r1_rss,        p_r1_rss,        r1_rss_t     = ps.rdhdf_2d('cs/r1_rss_t.h5')
+  _,               _,               r1_rss_p     = ps.rdhdf_2d('cs/r1_rss_p.h5')
 
   print("=> Projecting DCHB at RSS out to R1...")
   # Get DCHB at r1 through interpolation:  
@@ -188,7 +410,14 @@ def run(args):
   ps.wrhdf_2d('dchb_at_r1.h5', p_r1_rss, t_r1_rss, np.transpose(dchb_r1))
   print("   ...wrote file: dchb_at_r1.h5")
 
+def assign_br_r1_polarity():
+
   print("=> Using RSS->R1 tracings to assign polarity to CS Br at R1...")
+  t_r1_rss,        p_r1_rss,        r1_rss_t      = ps.rdhdf_2d('cs/r1_rss_t.h5')
+  _,               _,               r1_rss_p      = ps.rdhdf_2d('cs/r1_rss_p.h5')
+  t_br_r1_cs,      p_br_r1_cs,      br_r1_cs      = ps.rdhdf_2d('cs/br_r1_cs.h5')
+  t_br_rss_pm_cs,  p_br_rss_pm_cs,  br_rss_pm_cs  = ps.rdhdf_2d('cs/br_rss_pm_cs.h5')
+
   # Make 2D mesh grids of tracing coordinates from r1 to rss:
   mesh_r1_trace_t, mesh_r1_trace_p = np.meshgrid(t_r1_rss,p_r1_rss)
   # Interpolate br_cs_r1 to tracing mesh:
@@ -200,38 +429,109 @@ def run(args):
   br_r1 = br_r1_unsigned*polarity_ss_mapped_to_r1
   ps.wrhdf_2d('br_r1.h5', p_r1_rss, t_r1_rss, np.transpose(br_r1))
   print("   ...wrote file: br_r1.h5")
-  
-  print('===========================================')
-  print('===========================================')
-  print('=> Magnetic field trace analysis complete!')
-  print('===========================================')
-  print('===========================================')
 
-def slice_tp(t_f,p_f,f,t,p):
-  # Extend domain to deal with periodic phi
-  p_f_extended, f_extended = extend_periodic_tp(p_f,f)
+# Interpolation plans of the most recently used (source grid, target
+# points) pairs.  Three of the slices of a run are at the same points.
+PLAN_CACHE_SIZE = 4
+_plans = OrderedDict()
 
-  interp = RegularGridInterpolator((p_f_extended, t_f), f_extended, bounds_error=False, fill_value=0)
-  coords=np.column_stack((p.flatten(), t.flatten()))
-  values=(interp((coords))).reshape(p.shape)
-  return values
+def slice_tp(t_f,p_f,f,t,p):
+  # Interpolate f (np, nt), periodic in phi, to the points (t, p) with
+  # the interpolation plan of the grid and the points.
+  return apply_plan(cached_plan(t_f, p_f, t, p), f)
 
-def extend_periodic_tp(xvec,data):
-  # Detect type of periodicity and return extended data and scale.
+def periodic_range(xvec):
+  # Range of the distinct points of a periodic phi scale.
   tol=1e-6
   if (np.abs(xvec[-1]-xvec[0]-2*np.pi)<=tol):
     # Assume 1-point overlap...
-    data = np.delete(data, 0, 0)
-    xvec = np.delete(xvec, 0, 0)
+    return 1, len(xvec)
   elif ((xvec[-1]-xvec[0])>2*np.pi+tol and (xvec[-2]-xvec[1])<2*np.pi-tol):
     # Assume 2-point overlap...
-    data = np.delete(data, 0, 0)
-    xvec = np.delete(xvec, 0, 0)
-    data = np.delete(data, len(xvec)-1, 0)
-    xvec = np.delete(xvec, len(xvec)-1, 0)
-  data = np.append(data,np.append(data,data,0),0)
-  xvec = np.append(xvec-2*np.pi,np.append(xvec,xvec+2*np.pi))
-  return xvec,data
+    return 1, len(xvec)-1
+  return 0, len(xvec)
+
+def axis_weights(grid, x):
+  # Index of the cell of each x, its linear weight, and whether x is out
+  # of bounds (as in scipy's RegularGridInterpolator).
+  i = np.clip(np.searchsorted(grid, x) - 1, 0, len(grid) - 2)
+  w = (x - grid[i])/(grid[i+1] - grid[i])
+  return i, w, (x < grid[0]) | (x > grid[-1])
+
+def interp_plan(t_f, p_f, t, p):
+  # Corner indices and bilinear weights of the points (t, p) in the grid
+  # (p_f, t_f).  Phi is periodic: the cells are found on the distinct
+  # points extended by -2pi and +2pi, and the extended indices are mapped
+  # back onto the field, so the field itself is never extended.  Points
+  # outside the grid get 0.
+  t_f = np.asarray(t_f, dtype=np.float64)
+  p_f = np.asarray(p_f, dtype=np.float64)
+  start, stop = periodic_range(p_f)
+  n = stop - start
+  p_ext = np.concatenate([p_f[start:stop] - 2*np.pi, p_f[start:stop], p_f[start:stop] + 2*np.pi])
+  ip, wp, out_p = axis_weights(p_ext, np.asarray(p, dtype=np.float64).ravel())
+  it, wt, out_t = axis_weights(t_f, np.asarray(t, dtype=np.float64).ravel())
+  return {'ip0': start + ip % n, 'ip1': start + (ip + 1) % n, 'it0': it, 'it1': it + 1,
+          'wp': wp, 'wt': wt, 'outside': out_p | out_t, 'shape': np.shape(p)}
+
+def cached_plan(t_f, p_f, t, p):
+  h = hashlib.sha1()
+  for vec in (t_f, p_f, t, p):
+    vec = np.ascontiguousarray(vec, dtype=np.float64)
+    h.update(str(vec.shape).encode())
+    h.update(vec.tobytes())
+  key = h.hexdigest()
+  if key in _plans:
+    _plans.move_to_end(key)
+  else:
+    _plans[key] = interp_plan(t_f, p_f, t, p)
+    if len(_plans) > PLAN_CACHE_SIZE:
+      _plans.popitem(last=False)
+  return _plans[key]
+
+def apply_plan(plan, f):
+  # Values of f (np, nt) at the points of the plan.
+  f = np.asarray(f)
+  wp, wt = plan['wp'], plan['wt']
+  values = (f[plan['ip0'], plan['it0']]*(1 - wp)*(1 - wt) + f[plan['ip1'], plan['it0']]*wp*(1 - wt) +
+            f[plan['ip0'], plan['it1']]*(1 - wp)*wt + f[plan['ip1'], plan['it1']]*wp*wt)
+  values[plan['outside']] = 0
+  return values.reshape(plan['shape'])
+
+def run_mapfl_adaptive(args, mapfl, label, kinds, footpoints):
+  # Run MAPFL with mapfl.in on an adaptively refined subset of its seed
+  # mesh (adaptive_seeds.py) and write the outputs on the full mesh.
+  Command=mapfl +' 1>mapfl.log 2>mapfl.err'
+  print('   Command: '+Command+' (adaptive seed mesh, '+str(args.adaptive)+' levels)')
+  nml = namelist_io.read_namelist('mapfl.in')
+  tvec, pvec = mapfl_sectors.seed_mesh(nml, 't'), mapfl_sectors.seed_mesh(nml, 'p')
+  runs, layouts = [], {}
+  def trace(meshes):
+    ierr, failure, outputs = mapfl_sectors.run_meshes('mapfl.in', Command, meshes, args.sectors, label,
+      report=os.path.abspath(os.path.join('..', watchdog.REPORT_NAME)), time_limit=args.time_limit, append=len(runs) > 0,
+      cores=args.cores, layouts=layouts)
+    runs.append(len(meshes))
+    check_error_code(ierr,'Failed : '+Command+(' ('+failure['reason']+': '+failure['detail']+')' if failure else ''))
+    return outputs
+  fields = adaptive_seeds.trace_adaptive(trace, tvec, pvec, args.adaptive, kinds, footpoints)
+  for file, f in fields.items():
+    # In the layout MAPFL writes the file in.
+    mapfl_sectors.write_output(file, {'t': tvec, 'p': pvec}, np.transpose(f), layouts.get(file, False))
+
+def run_mapfl(args, mapfl, label):
+  # Run MAPFL in the current directory under the watchdog, which aborts
+  # it as soon as a field line fails to reach R0 or R1 (or -time_limit).
+  # With -sectors, concurrent MAPFL runs each trace a sector of the seed
+  # mesh and their outputs are stitched together.
+  Command=mapfl +' 1>mapfl.log 2>mapfl.err'
+  print('   Command: '+Command)
+  if args.sectors > 1:
+    ierr, failure = mapfl_sectors.run_sectors('mapfl.in', Command, args.sectors, args.sector_axis, label,
+      report=os.path.abspath(os.path.join('..', watchdog.REPORT_NAME)), time_limit=args.time_limit, cores=args.cores)
+  else:
+    ierr, failure = watchdog.run_watched(Command, label, watchdog.MAPFL_LOGS, watchdog.MAPFL_FATAL,
+      report=os.path.join('..', watchdog.REPORT_NAME), time_limit=args.time_limit)
+  check_error_code(ierr,'Failed : '+Command+(' ('+failure['reason']+': '+failure['detail']+')' if failure else ''))
 
 def check_error_code(ierr,message):
   if ierr > 0:
@@ -240,12 +540,6 @@ def check_error_code(ierr,message):
     print('Error code of fail : '+str(ierr))
     sys.exit(1)
 
-def check_file_for_line(line_to_check,file,message):
-  Command='grep "'+line_to_check+'" '+file
-  ierr = subprocess.run(["bash","-c",Command],stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-  ierr = 1 if ierr.returncode == 0 else 0
-  check_error_code(ierr,message)
-
 def main():
   args = argParsing()
   run(args)
@@ -267,4 +561,39 @@ if __name__ == '__main__':
 #       - MAPFL resolution is now autoset based on the POT3D run size.
 #       - Changed sed command so it can also work on macOS.
 #
+# ### Version 2.2.0, 10/19/2026:
+#       - Split tracing and analysis into stages recorded in the
+#         run manifest (swig_manifest.json).
+#       - Added -resume to skip stages that already completed.
+#       - Added -retain to delete intermediates once no longer needed.
+#       - Added -stages to run a subset of the stages.
+#       - Added -products to skip PFSS traces and Q maps that are not
+#         needed.
+#       - MAPFL input files are now written with namelist_io.py instead
+#         of sed.
+#       - MAPFL now runs under a watchdog (solver_watchdog.py) that aborts
+#         it as soon as a field line fails to reach R0 or R1 (instead of
+#         checking mapfl.log afterwards) or after the new -time_limit,
+#         and writes the reason to watchdog_failure.json.
+#       - Each stage's time and peak memory is added to the timing
+#         history used by swig_planner.py.
+#       - Added -r1 to trace the CS field lines back from a radius below
+#         the outer boundary of the CS solution.
+#       - slice_tp() now interpolates with cached interpolation plans
+#         (cell indices and bilinear weights per source grid and target
+#         points) instead of a RegularGridInterpolator on a tripled copy
+#         of the field.
+#       - DCHB at r1 is now computed only at the r0 footpoints of the r1
+#         points, from the composed r1->rss and rss->r0 mappings.  Added
+#         -dchb_method grid to compute it on the rss grid as before.
+#         Cells of the rss grid whose corner footpoints diverge take the
+#         footpoint of the nearest corner instead of the average.
+#       - Added -tracer python to trace the field lines with
+#         fieldline_tracer.py (RK4 in NumPy) instead of MAPFL.
+#       - Added -sectors and -sector_axis to trace sectors of the seed
+#         mesh with concurrent MAPFL runs (mapfl_sectors.py), which share
+#         the -cores cores (OMP_NUM_THREADS of each run).
+#       - Added -adaptive to trace the PFSS solution on an adaptively
+#         refined seed mesh (adaptive_seeds.py).
+#
 ########################################################################
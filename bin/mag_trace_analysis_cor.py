@@ -1,10 +1,17 @@
 #!/usr/bin/env python3
 import os
 import sys
-import subprocess
+import glob
+import traceback
 import numpy as np
 import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import psi_io as ps
+import namelist_io
+import solver_watchdog as watchdog
+import mapfl_sectors
+import adaptive_seeds
+import plot_maps
 
 ########################################################################
 #  MAG_TRACE_ANALYSIS_COR #
@@ -13,6 +20,8 @@ import psi_io as ps
 # INPUT:   Directory of run (where 3D coronal magnetic field data resides)
 # OUTPUT:  expfac_rss_at_r1.h5, dchb_at_r1.h5
 #          ofm_r0.h5, slogq_r0.h5
+#          (in mag_trace_analysis/<index>/ for each snapshot of a
+#          sequence, see -indices)
 #
 ########################################################################
 #          Predictive Science Inc.
@@ -86,37 +95,69 @@ def argParsing():
     required=False,
     type=str)
 
-  return parser.parse_args()
+  parser.add_argument('-shell',
+    help='Trace compact copies of the B cubes cut (with HDF5 hyperslab reads) to the radial range from -r0_trace to -r1 that the analysis needs, instead of the full cubes.  The copies are deleted after tracing.',
+    dest='shell',
+    action='store_true',
+    default=False,
+    required=False)
 
-def get_sed_command():
-  """Detect which sed command to use and return appropriate arguments.
-  
-  Returns: (sed_cmd, suffix_args) where suffix_args is [''] for BSD sed or [] for GNU sed
-  """
-  # First check if gsed (GNU sed) is available
-  result = subprocess.run(['which', 'gsed'], capture_output=True, text=True)
-  if result.returncode == 0:
-    return ('gsed', [])
-  
-  # Check if system sed is GNU sed by testing --version flag
-  result = subprocess.run(['sed', '--version'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
-  if result.returncode == 0:
-    # GNU sed supports --version
-    return ('sed', [])
-  else:
-    # BSD sed (macOS) doesn't support --version and requires '' after -i
-    return ('sed', [''])
+  parser.add_argument('-adaptive',
+    help='Refine the MAPFL seed mesh adaptively in this many levels (default 0: trace every point): every 2^N-th point is traced first, then only the cells near OFM changes, steep expansion factor gradients, high slogQ, or footpoint jumps are refined, and the rest is interpolated.',
+    dest='adaptive',
+    type=int,
+    default=0,
+    required=False)
+
+  parser.add_argument('-sectors',
+    help='Split the MAPFL seed mesh into this many sectors traced by concurrent MAPFL processes, and stitch their outputs (default 1: one MAPFL run).',
+    dest='sectors',
+    type=int,
+    default=1,
+    required=False)
+
+  parser.add_argument('-sector_axis',
+    help='Axis along which the seed mesh is split with -sectors: p (phi, default) or t (theta).',
+    dest='sector_axis',
+    type=str,
+    choices=['p', 't'],
+    default='p',
+    required=False)
+
+  parser.add_argument('-indices',
+    help='Analyze the sequence of snapshots with these indices (e.g. 1-120, 1,5,10-20, or 1-120:5), with brfile, btfile, and bpfile as patterns such as br{:03d}.h5.  A brfile with a * (e.g. "br*.h5", with bt*.h5 and bp*.h5) also analyzes a sequence: all the matching files.  Each snapshot is analyzed in mag_trace_analysis/<index>.',
+    dest='indices',
+    type=str,
+    required=False)
 
-# Cache the sed command detection
-_sed_cmd, _sed_suffix = get_sed_command()
+  parser.add_argument('-cores',
+    help='Core budget: shared by the concurrent MAPFL runs of -sectors or -adaptive (each run with its share as OMP_NUM_THREADS), and for a sequence by the snapshots analyzed concurrently, each with -sectors cores (default: all cores).',
+    dest='cores',
+    type=int,
+    default=os.cpu_count() or 1,
+    required=False)
+
+  parser.add_argument('-consolidate',
+    help='For a sequence, also write the ofm, slogq, dchb, and expfac maps of all snapshots as 3D (t, p, index) files mag_trace_analysis/<name>_sequence.h5.',
+    dest='consolidate',
+    action='store_true',
+    default=False,
+    required=False)
+
+  parser.add_argument('-noplot',
+    help='Do not plot the results.',
+    dest='noplot',
+    action='store_true',
+    default=False,
+    required=False)
 
-def sed(match,value,file):
-  match_pattern = '.*' + match + '=.*'
-  replace_pattern = '  ' + match + '=' + value
-  sed_directive = f's@{match_pattern}@{replace_pattern}@'
-  cmd = [_sed_cmd, '-i'] + _sed_suffix + [sed_directive, file]
-  ierr = subprocess.run(cmd).returncode
-  check_error_code(ierr, 'Failed on sed of '+match+' in '+file)
+  parser.add_argument('-time_limit',
+    help='Abort a MAPFL run that takes longer than this many seconds (default: no limit).',
+    dest='time_limit',
+    type=float,
+    required=False)
+
+  return parser.parse_args()
 
 def run(args):
 
@@ -150,79 +191,277 @@ def run(args):
 
   os.chdir("mag_trace_analysis")
 
-  ierr = subprocess.run(['cp', mapfl_file, 'mapfl.in']).returncode
-  check_error_code(ierr,'Failed on copy of '+mapfl_file+' to mapfl.in')
+  snapshots = sequence_files(args, rundir)
+  if snapshots:
+    run_sequence(args, mapfl, mapfl_file, snapshots, psi_plot2d_loc)
+  else:
+    mapfl_values = mesh_values(args, rundir+'/'+args.brfile)
+    mapfl_values.update({'bfile%r': rundir+'/'+args.brfile,
+                         'bfile%t': rundir+'/'+args.btfile,
+                         'bfile%p': rundir+'/'+args.bpfile})
+    analyze(args, mapfl, mapfl_file, mapfl_values, psi_plot2d_loc)
+
+  print("    ...done!")
 
-  sed("bfile%r","'"+rundir+'/'+args.brfile+"'",'mapfl.in')
-  sed("bfile%t","'"+rundir+'/'+args.btfile+"'",'mapfl.in')
-  sed("bfile%p","'"+rundir+'/'+args.bpfile+"'",'mapfl.in')
-  sed("r1 = ",str(args.r1),'mapfl.in')
+def mesh_values(args, brfile):
+  # MAPFL values of the seed mesh and tracing limits (writing the mesh
+  # files in the current directory).
+  mapfl_values = {'r1': args.r1}
 
   if not (args.mesh_t or args.mesh_p):
-    _, tvec, pvec, _ = ps.rdhdf_3d(rundir+'/'+args.brfile)
+    _, tvec, pvec = ps.rdhdf_scales(brfile)
 
   if args.mesh_t:
-    sed("mesh_file_t",args.mesh_t,'mapfl.in')
+    mapfl_values['mesh_file_t'] = args.mesh_t
   else:
     if args.uniform:
-      sed("mesh_file_t","' '",'mapfl.in')
+      mapfl_values['mesh_file_t'] = ' '
       if args.nt is None:
-        sed("ntss",str(len(tvec)*2),'mapfl.in')
+        mapfl_values['ntss'] = len(tvec)*2
       else:
-        sed("ntss",str(args.nt),'mapfl.in')
+        mapfl_values['ntss'] = args.nt
     else:
       tvec_new = add_midpoints(tvec)
       ps.wrhdf_1d('mesh_file_t_resX2.h5', tvec_new, tvec_new)
-      sed("mesh_file_t","'mesh_file_t_resX2.h5'",'mapfl.in')
+      mapfl_values['mesh_file_t'] = os.path.abspath('mesh_file_t_resX2.h5')
 
   if args.mesh_p:
-    sed("mesh_file_p=",args.mesh_p,'mapfl.in')
+    mapfl_values['mesh_file_p'] = args.mesh_p
   else:
     if args.uniform:
-      sed("mesh_file_p","' '",'mapfl.in')
+      mapfl_values['mesh_file_p'] = ' '
       if args.np is None:
-        sed("npss",str(len(pvec)*2),'mapfl.in')
+        mapfl_values['npss'] = len(pvec)*2
       else:
-        sed("npss",str(args.np),'mapfl.in')
+        mapfl_values['npss'] = args.np
     else:
       pvec_new = add_midpoints(pvec)
       ps.wrhdf_1d('mesh_file_p_resX2.h5', pvec_new, pvec_new)
-      sed("mesh_file_p","'mesh_file_p_resX2.h5'",'mapfl.in')
+      mapfl_values['mesh_file_p'] = os.path.abspath('mesh_file_p_resX2.h5')
 
   # Set the lower tracing limits and dimensions:
-  sed('ch_map_r',str(args.r0_trace),'mapfl.in')
-  sed('domain_r_min',str(args.r0_trace),'mapfl.in')
+  mapfl_values['ch_map_r'] = args.r0_trace
+  mapfl_values['domain_r_min'] = args.r0_trace
+  return mapfl_values
 
-  Command=mapfl +' 1>mapfl.log 2>mapfl.err'
-  print('   Command: '+Command)
-  ierr = subprocess.run(["bash","-c",Command])
-  check_error_code(ierr.returncode,'Failed : '+Command)
-  line_to_check='A field line did not reach'
-  check_file_for_line(line_to_check,'mapfl.log','Failed : A field line did not reach R0 or R1.')
+def analyze(args, mapfl, template, mapfl_values, psi_plot2d_loc, plot_workers=None):
+  # Trace the B files of mapfl_values with the MAPFL template in the
+  # current directory, and compute DCHB and the plots, with plot_workers
+  # cores (default -cores).
+  if args.shell:
+    mapfl_values = {**mapfl_values, **extract_shell(mapfl_values, args.r0_trace, args.r1 or np.inf)}
+
+  namelist_io.customize(template, 'mapfl.in', mapfl_values)
+
+  if args.adaptive:
+    run_mapfl_adaptive(args, mapfl, 'MAPFL', ADAPTIVE_KINDS, ADAPTIVE_FOOTPOINTS, plot_workers)
+  else:
+    run_mapfl(args, mapfl, 'MAPFL', plot_workers)
+  if args.shell:
+    for key in SHELL_FILES:
+      os.remove(SHELL_FILES[key])
 
   print("=> Calculating the distance to open field boundaries (DCHB)... ")
   dchb_command = 'ch_distance.py -t r1_r0_t.h5 -p r1_r0_p.h5 -force_ch -chfile ofm_r0.h5 -dfile dchb_r1.h5'
   ierr = os.system(dchb_command)
   check_error_code(ierr,'Failed on : ' + dchb_command)
 
-  print('=> Plotting results...')
-
-  ierr = os.system(psi_plot2d_loc+' -tp -unit_label "slog(Q)" -cmin -7 -cmax 7 -ll -finegrid slogq_r0.h5 -cmap RdBu -o slogq_r0.png')
-  check_error_code(ierr,'Failed to plot slogq_r0.h5')
-
-  ierr = os.system(psi_plot2d_loc+' -tp -unit_label "slog(Q)" -cmin -7 -cmax 7 -ll -finegrid slogq_r1.h5 -cmap RdBu -o slogq_r1.png')
-  check_error_code(ierr,'Failed to plot slogq_r1.h5')
-
-  ierr = os.system(psi_plot2d_loc+' -tp -cmin -1 -cmax 1 -ll -finegrid ofm_r0.h5 -o ofm_r0.png')
-  check_error_code(ierr,'Failed to plot ofm_r0.h5')
-
-  ierr = os.system(psi_plot2d_loc+' -tp -cmin 0 -ll -finegrid dchb_r1.h5 -cmap RdBu         -o dchb_r1.png')
-  check_error_code(ierr,'Failed to plot dchb_r1.h5')
-
-  ierr = os.system(psi_plot2d_loc+' -tp -cmin 0 -cmax 500 -ll -finegrid expfac_r1_r0.h5   -cmap jet -o expfac_r1_r0.png')
-  check_error_code(ierr,'Failed to plot expfac_r1_r0.h5')
-
-  print("    ...done!")
+  if not args.noplot:
+    print('=> Plotting results...')
+    plot_results(psi_plot2d_loc, plot_workers)
+
+# Consolidated (time-indexed) outputs of -consolidate.
+SEQUENCE_OUTPUTS = ['ofm_r0', 'slogq_r0', 'slogq_r1', 'dchb_r1', 'expfac_r1_r0']
+
+def parse_indices(text):
+  # Indices of a list of ranges such as 1-120, 1,5,10-20 or 1-120:5.
+  indices = []
+  for part in text.split(','):
+    part, _, step = part.partition(':')
+    first, _, last = part.partition('-')
+    indices.extend(range(int(first), int(last or first) + 1, int(step or 1)))
+  return sorted(set(indices))
+
+def sequence_files(args, rundir):
+  # The [(index, (br, bt, bp))] snapshots of a sequence, or None for a
+  # single snapshot.  With -indices the file names are formatted with
+  # each index (e.g. br{:03d}.h5); a * in brfile matches the files in
+  # rundir and the matched part replaces the * of btfile and bpfile.
+  if args.indices:
+    return [(str(i), tuple(rundir+'/'+file.format(i) for file in (args.brfile, args.btfile, args.bpfile)))
+            for i in parse_indices(args.indices)]
+  if '*' not in args.brfile:
+    return None
+  check_error_code(args.brfile.count('*') != 1 or '*' not in args.btfile or '*' not in args.bpfile,
+    'ERROR: brfile must have one * and btfile and bpfile a * too.')
+  prefix, suffix = args.brfile.split('*')
+  keys = sorted(os.path.basename(file)[len(prefix):len(os.path.basename(file))-len(suffix)]
+                for file in glob.glob(os.path.join(rundir, args.brfile)))
+  check_error_code(len(keys) == 0, 'ERROR: no files match '+os.path.join(rundir, args.brfile))
+  return [(key, tuple(rundir+'/'+file.replace('*', key) for file in (args.brfile, args.btfile, args.bpfile)))
+          for key in keys]
+
+def run_sequence(args, mapfl, mapfl_file, snapshots, psi_plot2d_loc):
+  # Analyze each snapshot in its own directory (mag_trace_analysis/<index>),
+  # up to -cores cores at a time.  The mesh files and the MAPFL template
+  # are written once (all the snapshots must be on the same grid).
+  missing = [file for _, files in snapshots for file in files if not os.path.exists(file)]
+  check_error_code(len(missing) > 0, 'ERROR: missing '+', '.join(missing))
+  scales = ps.rdhdf_scales(snapshots[0][1][0])
+  for key, files in snapshots[1:]:
+    check_error_code(any(len(a) != len(b) or not np.allclose(a, b) for a, b in zip(scales, ps.rdhdf_scales(files[0]))),
+      'ERROR: '+files[0]+' is not on the grid of '+snapshots[0][1][0])
+  namelist_io.customize(mapfl_file, 'mapfl_sequence.in', mesh_values(args, snapshots[0][1][0]))
+  template = os.path.abspath('mapfl_sequence.in')
+
+  workers = max(1, min(args.cores//max(args.sectors, 1), len(snapshots)))
+  plot_workers = max(1, args.cores//workers)
+  print(f'=> Analyzing {len(snapshots)} snapshots, {workers} at a time (logs in <index>/mag_trace_analysis.log)...')
+  sys.stdout.flush()
+  failed = []
+  with ProcessPoolExecutor(max_workers=workers) as pool:
+    futures = [pool.submit(analyze_snapshot, args, mapfl, template, psi_plot2d_loc, key, files, plot_workers)
+               for key, files in snapshots]
+    for future in as_completed(futures):
+      key, ierr = future.result()
+      print('   '+key+(': done' if not ierr else ': FAILED (see '+key+'/mag_trace_analysis.log)'))
+      sys.stdout.flush()
+      if ierr:
+        failed.append(key)
+  done = [key for key, _ in snapshots if key not in failed]
+  if args.consolidate and done:
+    consolidate(done)
+  check_error_code(len(failed), 'ERROR: failed snapshots: '+', '.join(sorted(failed)))
+
+def analyze_snapshot(args, mapfl, template, psi_plot2d_loc, key, files, plot_workers):
+  # Analyze one snapshot of a sequence in the directory key, with its
+  # output in key/mag_trace_analysis.log.  Returns (key, error code).
+  cwd = os.getcwd()
+  os.makedirs(key, exist_ok=True)
+  os.chdir(key)
+  saved = [os.dup(1), os.dup(2)]
+  with open('mag_trace_analysis.log', 'w') as log:
+    os.dup2(log.fileno(), 1)
+    os.dup2(log.fileno(), 2)
+    try:
+      analyze(args, mapfl, template, dict(zip(('bfile%r', 'bfile%t', 'bfile%p'), files)), psi_plot2d_loc, plot_workers)
+      ierr = 0
+    except SystemExit as e:
+      ierr = e.code or 1
+    except Exception:
+      traceback.print_exc()
+      ierr = 1
+    finally:
+      sys.stdout.flush()
+      sys.stderr.flush()
+      for fd, saved_fd in zip((1, 2), saved):
+        os.dup2(saved_fd, fd)
+        os.close(saved_fd)
+      os.chdir(cwd)
+  return key, ierr
+
+def consolidate(keys):
+  # Write the outputs of the snapshots keys as <name>_sequence.h5 files
+  # (t, p, snapshot index), for the outputs that all of them have.
+  print('=> Writing the consolidated outputs...')
+  # The snapshot index is the key if every key is a number (in numeric
+  # order), else its position (a mix of both could repeat or misorder
+  # the indices).
+  numeric = all(key.isdigit() for key in keys)
+  if numeric:
+    keys = sorted(keys, key=int)
+  index = [float(key) if numeric else float(k) for k, key in enumerate(keys)]
+  for name in SEQUENCE_OUTPUTS:
+    files = [os.path.join(key, name+'.h5') for key in keys]
+    if not all(os.path.exists(file) for file in files):
+      continue
+    t, p, _ = ps.rdhdf_2d(files[0])
+    ps.wrhdf_3d(name+'_sequence.h5', t, p, index, np.stack([np.asarray(ps.rdhdf_2d(file)[2]) for file in files]))
+    print('   '+name+'_sequence.h5')
+
+# Compact copies of the B cubes traced with -shell.
+SHELL_FILES = {'bfile%r': 'br_shell.h5', 'bfile%t': 'bt_shell.h5', 'bfile%p': 'bp_shell.h5'}
+
+def extract_shell(mapfl_values, rmin, rmax):
+  # Write the radial range [rmin, rmax] of each B cube (on its own
+  # staggered r mesh) to SHELL_FILES, reading only that range.
+  print('=> Extracting the shell r=['+str(rmin)+', '+str(rmax)+'] of the B cubes...')
+  size = shell_size = 0
+  for key, file in SHELL_FILES.items():
+    r, t, p, f = ps.rdhdf_3d_xrange(mapfl_values[key], rmin, rmax)
+    ps.wrhdf_3d(file, r, t, p, f)
+    size += os.path.getsize(mapfl_values[key])
+    shell_size += os.path.getsize(file)
+    print('   '+file+': r=['+f'{r[0]:g}'+', '+f'{r[-1]:g}'+'], '+str(len(r))+' points')
+  print(f'   ...{shell_size/2**20:.0f} MB of {size/2**20:.0f} MB.')
+  return {key: os.path.abspath(file) for key, file in SHELL_FILES.items()}
+
+# Refinement criteria of the adaptive tracing (adaptive_seeds.py).
+ADAPTIVE_KINDS = {'ofm_r0.h5': 'ofm', 'expfac_r1_r0.h5': 'expfac', 'slogq_r0.h5': 'slogq', 'slogq_r1.h5': 'slogq'}
+ADAPTIVE_FOOTPOINTS = [('r1_r0_t.h5', 'r1_r0_p.h5')]
+
+PLOTS = [
+  ('slogq_r0',     '"slog(Q)"', -7,   7,    'RdBu'),
+  ('slogq_r1',     '"slog(Q)"', -7,   7,    'RdBu'),
+  ('ofm_r0',       None,        -1,   1,    None),
+  ('dchb_r1',      None,        0,    None, 'RdBu'),
+  ('expfac_r1_r0', None,        0,    500,  'jet'),
+]
+
+def plot_results(psi_plot2d_loc, workers=None):
+  plots = PLOTS
+  specs = []
+  if plot_maps.have_matplotlib():
+    # The plots with the psi_plot2d colormaps are left to it.
+    specs = [{'data': name+'.h5', 'output': name+'.png', 'unit_label': label,
+              'cmin': cmin, 'cmax': cmax, 'cmap': cmap} for name, label, cmin, cmax, cmap in PLOTS]
+    plots = [plot for plot, spec in zip(PLOTS, specs) if not plot_maps.renders(spec)]
+    specs = [spec for spec in specs if plot_maps.renders(spec)]
+
+  # The psi_plot2d plots run with the same workers.
+  commands = [psi_plot2d_loc+' -tp'+(' -unit_label '+label if label else '')+' -cmin '+str(cmin)+
+              (' -cmax '+str(cmax) if cmax is not None else '')+' -ll -finegrid '+name+'.h5'+
+              (' -cmap '+cmap if cmap else '')+' -o '+name+'.png' for name, label, cmin, cmax, cmap in plots]
+  ierrs = plot_maps.render_plots(specs, workers, commands=commands)
+  for (name, *_), ierr in zip(plots, ierrs):
+    check_error_code(ierr,'Failed to plot '+name+'.h5')
+
+def run_mapfl_adaptive(args, mapfl, label, kinds, footpoints, cores=None):
+  # Run MAPFL with mapfl.in on an adaptively refined subset of its seed
+  # mesh (adaptive_seeds.py) and write the outputs on the full mesh.
+  # The MAPFL runs share cores (default -cores).
+  Command=mapfl +' 1>mapfl.log 2>mapfl.err'
+  print('   Command: '+Command+' (adaptive seed mesh, '+str(args.adaptive)+' levels)')
+  nml = namelist_io.read_namelist('mapfl.in')
+  tvec, pvec = mapfl_sectors.seed_mesh(nml, 't'), mapfl_sectors.seed_mesh(nml, 'p')
+  runs, layouts = [], {}
+  def trace(meshes):
+    ierr, failure, outputs = mapfl_sectors.run_meshes('mapfl.in', Command, meshes, args.sectors, label,
+      report=os.path.abspath(os.path.join('.', watchdog.REPORT_NAME)), time_limit=args.time_limit, append=len(runs) > 0,
+      cores=cores or args.cores, layouts=layouts)
+    runs.append(len(meshes))
+    check_error_code(ierr,'Failed : '+Command+(' ('+failure['reason']+': '+failure['detail']+')' if failure else ''))
+    return outputs
+  fields = adaptive_seeds.trace_adaptive(trace, tvec, pvec, args.adaptive, kinds, footpoints)
+  for file, f in fields.items():
+    # In the layout MAPFL writes the file in.
+    mapfl_sectors.write_output(file, {'t': tvec, 'p': pvec}, np.transpose(f), layouts.get(file, False))
+
+def run_mapfl(args, mapfl, label, cores=None):
+  # Run MAPFL in the current directory under the watchdog, which aborts
+  # it as soon as a field line fails to reach R0 or R1 (or -time_limit).
+  # With -sectors, concurrent MAPFL runs each trace a sector of the seed
+  # mesh (sharing cores, default -cores) and their outputs are stitched
+  # together.
+  Command=mapfl +' 1>mapfl.log 2>mapfl.err'
+  print('   Command: '+Command)
+  if args.sectors > 1:
+    ierr, failure = mapfl_sectors.run_sectors('mapfl.in', Command, args.sectors, args.sector_axis, label,
+      report=os.path.abspath(os.path.join('.', watchdog.REPORT_NAME)), time_limit=args.time_limit, cores=cores or args.cores)
+  else:
+    ierr, failure = watchdog.run_watched(Command, label, watchdog.MAPFL_LOGS, watchdog.MAPFL_FATAL,
+      report=os.path.join('.', watchdog.REPORT_NAME), time_limit=args.time_limit)
+  check_error_code(ierr,'Failed : '+Command+(' ('+failure['reason']+': '+failure['detail']+')' if failure else ''))
 
 def check_error_code(ierr,message):
   if ierr > 0:
@@ -231,12 +470,6 @@ def check_error_code(ierr,message):
     print('Error code of fail : '+str(ierr))
     sys.exit(1)
 
-def check_file_for_line(line_to_check,file,message):
-  Command='grep "'+line_to_check+'" '+file
-  ierr = subprocess.run(["bash","-c",Command],stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-  ierr = 1 if ierr.returncode == 0 else 0
-  check_error_code(ierr,message)
-
 def add_midpoints(grid):
     midpoints = (grid[:-1] + grid[1:]) / 2.0
     new_grid = np.empty(len(grid) + len(midpoints))
@@ -264,4 +497,26 @@ if __name__ == '__main__':
 # ### Version 1.1.0, 11/05/2025, modified by MS:
 #       - Changed sed command so it can also work on macOS.
 #
+# ### Version 1.2.0, 10/19/2026:
+#       - Plots are now rendered in-process and in parallel with
+#         plot_maps.py (psi_plot2d is still used for the plots with
+#         its psi_red_blue colormap, and if matplotlib is unavailable).
+#       - The MAPFL input file is now written with namelist_io.py
+#         instead of sed.  This also fixes setting r1 and a custom
+#         -mesh_p, which the sed patterns did not match.
+#       - MAPFL now runs under a watchdog (solver_watchdog.py) that aborts
+#         it as soon as a field line fails to reach R0 or R1 (instead of
+#         checking mapfl.log afterwards) or after the new -time_limit.
+#       - Added -sectors and -sector_axis to trace sectors of the seed
+#         mesh with concurrent MAPFL runs (mapfl_sectors.py), which share
+#         the -cores cores (OMP_NUM_THREADS of each run).
+#       - Added -adaptive to trace on an adaptively refined seed mesh
+#         (adaptive_seeds.py).
+#       - Added -shell to trace compact copies of the B cubes cut to the
+#         radial range from -r0_trace to -r1 (read with HDF5 hyperslabs).
+#       - Added a sequence mode (-indices, or a * in brfile) that sets up
+#         the mesh files and MAPFL template once and analyzes the
+#         snapshots concurrently within -cores, with -consolidate to
+#         write time-indexed files.  Added -noplot.
+#
 ########################################################################
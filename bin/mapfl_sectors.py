@@ -0,0 +1,264 @@
+import os
+import shutil
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+#
+import psi_io as ps
+import namelist_io
+import solver_watchdog as watchdog
+
+########################################################################
+#  MAPFL_SECTORS: Run MAPFL concurrently over sectors of its seed mesh
+########################################################################
+#        Predictive Science Inc.
+#        www.predsci.com
+#        San Diego, California, USA 92121
+########################################################################
+# Copyright 2024 Predictive Science Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+########################################################################
+#
+# MAPFL traces one field line per point of its seed (t, p) mesh, all
+# in one process.  run_sectors() splits the seed mesh of a mapfl.in
+# into contiguous phi (or theta) sectors, each run by its own MAPFL
+# process (in mapfl_sector_<k>/, with mesh_file_t/p written for the
+# sector), concurrently and each under the watchdog.  The 2D outputs of
+# the sectors are then stitched back into the full-grid files, and the
+# sector logs appended to mapfl.log/mapfl.err.  run_meshes() traces a
+# list of (t, p) meshes the same way and returns their outputs (used by
+# the adaptive refinement of adaptive_seeds.py).
+#
+# Each sector is traced with HALO extra seed points on either side
+# (within the full mesh), which are dropped when stitching, so that the
+# seed neighbours used by MAPFL at the sector edges (e.g. for the Q
+# maps) are the same as in a single run.  The outputs of MAPFL come in
+# both layouts (ofm_r0.h5 is pt, the others tp) and on the seed points
+# or on the cell centres between them (the slogq maps), which is found
+# by matching the scales of the sector files with the sector meshes, in
+# the layout that fits every sector (the range check of
+# remesh_map.read_map cannot tell the layouts apart on a sector that
+# spans less than pi in phi).  Each file is stitched along its own axis and
+# written back in its own layout; a file that is on neither mesh is an
+# error.  The traces (footpoints, OFM, expansion factor) are per seed point and
+# so the same as in a single run.  The Q maps (slogq) at the sector
+# edges and at phi 0/2pi have not been compared with those of a single
+# MAPFL run: if MAPFL computes Q from the seed neighbours with its own
+# treatment of the mesh ends, the edge columns of a sector (where its
+# mesh ends) may differ from a single run, so check them before relying
+# on -sectors for Q maps.
+#
+# The concurrent runs share a core budget (cores, default all cores):
+# each MAPFL process is run with OMP_NUM_THREADS set to its share, so
+# that the OpenMP threads of the sectors do not oversubscribe the node.
+#
+########################################################################
+
+HALO = 1
+
+# Output files of MAPFL: (flag that enables it, file name variable).
+OUTPUTS = [
+  ('compute_ch_map', 'ch_map_output_file'),
+  ('trace_fwd',      'slogqffile'),
+  ('trace_bwd',      'tbfile'),
+  ('trace_bwd',      'pbfile'),
+  ('trace_bwd',      'ebfile'),
+  ('trace_bwd',      'slogqbfile'),
+]
+
+SECTOR_DIR = 'mapfl_sector_{}'
+
+def get(nml, key, default=None):
+  # Value of key, or default if it is not in the namelist.
+  if key.lower() not in nml['keys']:
+    return default
+  return namelist_io.get_value(nml, key)
+
+def output_files(nml):
+  files = []
+  for flag, key in OUTPUTS:
+    name = str(get(nml, key, ' ')).strip()
+    if get(nml, flag, False) and name:
+      files.append(name)
+  return files
+
+def seed_mesh(nml, axis):
+  # The seed mesh along axis ('t' or 'p') of the namelist: its mesh
+  # file, its uniform mesh, or the mesh of the B files.
+  if not get(nml, 'new_'+axis+'_mesh', False):
+    r, t, p = ps.rdhdf_scales(get(nml, 'bfile%r'))
+    return np.asarray(t if axis == 't' else p)
+  file = str(get(nml, 'mesh_file_'+axis, ' ')).strip()
+  if file:
+    return np.asarray(ps.rdhdf_1d(file)[1])
+  return np.linspace(0, np.pi if axis == 't' else 2*np.pi, get(nml, 'n'+axis+'ss'))
+
+def sector_ranges(n, count, halo=HALO):
+  # (first, last+1) of the traced points and of the kept points of each
+  # of count contiguous sectors of n points.
+  edges = np.linspace(0, n, count + 1).round().astype(int)
+  return [(max(a - halo, 0), min(b + halo, n), a, b) for a, b in zip(edges[:-1], edges[1:]) if b > a]
+
+def write_runs(nml, meshes):
+  # Write a directory with mapfl.in and mesh_file_t/p for each (t, p)
+  # mesh in meshes (the B files by absolute path).  Returns the
+  # directories.
+  values = {key: os.path.abspath(get(nml, key)) for key in ('bfile%r', 'bfile%t', 'bfile%p')}
+  values.update({'new_t_mesh': True, 'new_p_mesh': True, 'mesh_file_t': 'mesh_t.h5', 'mesh_file_p': 'mesh_p.h5'})
+  namelist_io.set_values(nml, values)
+  directories = []
+  for k, mesh in enumerate(meshes):
+    directory = SECTOR_DIR.format(k)
+    os.makedirs(directory, exist_ok=True)
+    for name, vec in zip(('t', 'p'), mesh):
+      ps.wrhdf_1d(os.path.join(directory, 'mesh_'+name+'.h5'), vec, vec)
+    namelist_io.write_namelist(nml, os.path.join(directory, 'mapfl.in'))
+    directories.append(directory)
+  return directories
+
+def run_directories(directories, command, workers, label, report, time_limit, append=False, cores=None):
+  # Run MAPFL in the directories, up to workers at a time, each with
+  # OMP_NUM_THREADS set to its share of cores.
+  workers = max(min(workers, len(directories)), 1)
+  threads = max(1, (cores or os.cpu_count() or 1)//workers)
+  env = dict(os.environ, OMP_NUM_THREADS=str(threads))
+  def run(directory):
+    return watchdog.run_watched(command, label+' ('+directory+')', watchdog.MAPFL_LOGS, watchdog.MAPFL_FATAL,
+                                cwd=os.path.abspath(directory), report=report, time_limit=time_limit, env=env)
+  with ThreadPoolExecutor(max_workers=workers) as pool:
+    results = list(pool.map(run, directories))
+  collect_logs(directories, append)
+  failed = [result for result in results if result[0]]
+  return failed[0] if failed else (0, None)
+
+def mesh_kind(vec, mesh):
+  # 'points' if vec is the mesh, 'cells' if it is its cell centres.
+  vec = np.asarray(vec, dtype=np.float64)
+  if len(vec) == len(mesh) and np.allclose(vec, mesh, atol=1e-5):
+    return 'points'
+  if len(vec) == len(mesh) - 1 and np.allclose(vec, 0.5*(mesh[1:] + mesh[:-1]), atol=1e-5):
+    return 'cells'
+  return None
+
+def read_output(file, meshes):
+  # (x, y, f, {pt: mesh kinds {'t', 'p'}}) of the output file traced on
+  # the seed meshes, with the layouts (pt or not) that fit them: none if
+  # it is on neither the seed points nor their cell centres, and both if
+  # the t and p meshes are the same (e.g. a phi sector of [0, pi]).
+  x, y, f = ps.rdhdf_2d(file)
+  layouts = {}
+  for pt, scales in ((False, {'t': x, 'p': y}), (True, {'t': y, 'p': x})):
+    kinds = {axis: mesh_kind(scales[axis], meshes[axis]) for axis in ('t', 'p')}
+    if None not in kinds.values():
+      layouts[pt] = kinds
+  return x, y, np.asarray(f), layouts
+
+def in_layout(x, y, f, pt):
+  # (scales {'t', 'p'}, f (nt, np)) of a file in the layout pt.
+  if pt:
+    return {'t': y, 'p': x}, f
+  return {'t': x, 'p': y}, np.transpose(f)
+
+def write_output(file, scales, f, pt):
+  # Write f (nt, np) in the layout pt (as MAPFL wrote the file).
+  if pt:
+    ps.wrhdf_2d(file, scales['p'], scales['t'], f)
+  else:
+    ps.wrhdf_2d(file, scales['t'], scales['p'], np.transpose(f))
+
+def stitch(files, meshes, sectors, axis):
+  # Full-grid outputs from those of the sectors, each along axis on its
+  # own mesh (seed points or cell centres) and in its own layout.
+  # Returns an error message, or None.
+  along = 0 if axis == 't' else 1
+  n = len(meshes[axis])
+  for file in files:
+    outputs = [read_output(os.path.join(directory, file), {**meshes, axis: meshes[axis][first:last]})
+               for directory, (first, last, _, _) in sectors]
+    # MAPFL writes a file in the same layout in every sector.
+    fits = set.intersection(*(set(output[3]) for output in outputs))
+    if not fits:
+      return file+' is not on the seed mesh of its sectors'
+    pt = True in fits and (False not in fits)
+    pieces, coords = [], []
+    for (x, y, f, layouts), (_, (first, last, keep_first, keep_last)) in zip(outputs, sectors):
+      scales, f = in_layout(x, y, f, pt)
+      # The cells are those between the kept points (the last sector
+      # has one fewer).
+      end = keep_last if layouts[pt][axis] == 'points' else min(keep_last, n - 1)
+      keep = slice(keep_first - first, end - first)
+      pieces.append(f[keep] if along == 0 else f[:, keep])
+      coords.append(np.asarray(scales[axis])[keep])
+    write_output(file, {**scales, axis: np.concatenate(coords)}, np.concatenate(pieces, axis=along), pt)
+  return None
+
+def collect_logs(directories, append=False):
+  # Write (or append) the logs of the runs to those of the run directory.
+  for log in watchdog.MAPFL_LOGS:
+    with open(log, 'a' if append else 'w') as out:
+      for directory in directories:
+        file = os.path.join(directory, log)
+        if os.path.exists(file):
+          out.write(f'### {directory}\n')
+          with open(file, errors='replace') as f:
+            out.write(f.read())
+
+def run_sectors(mapfl_in, command, count, axis='p', label='MAPFL', report=None, time_limit=None, cores=None):
+  # Run MAPFL (command, in the current directory) with mapfl_in in count
+  # concurrent sectors along axis (sharing cores) and stitch the outputs.  Returns
+  # (error code, failure dict or None) as watchdog.run_watched.
+  nml = namelist_io.read_namelist(mapfl_in)
+  meshes = {'t': seed_mesh(nml, 't'), 'p': seed_mesh(nml, 'p')}
+  ranges = sector_ranges(len(meshes[axis]), count)
+  sector_meshes = [(meshes['t'][first:last], meshes['p']) if axis == 't' else (meshes['t'], meshes['p'][first:last])
+                   for first, last, _, _ in ranges]
+  directories = write_runs(nml, sector_meshes)
+  print(f'   Tracing {len(meshes["t"])}x{len(meshes["p"])} seed points in {len(directories)} {axis} sectors.')
+  ierr, failure = run_directories(directories, command, len(directories), label, report, time_limit, cores=cores)
+  if ierr:
+    return ierr, failure
+  error = stitch(output_files(nml), meshes, list(zip(directories, ranges)), axis)
+  if error:
+    return 1, {'reason': 'stitch', 'detail': error}
+  for directory in directories:
+    shutil.rmtree(directory)
+  return 0, None
+
+def run_meshes(mapfl_in, command, meshes, workers=1, label='MAPFL', report=None, time_limit=None, append=False,
+               cores=None, layouts=None):
+  # Trace each (t, p) mesh of meshes with its own MAPFL run, up to
+  # workers at a time (sharing cores).  Returns (error code, failure dict or None, a
+  # list of {output file: f (len(p), len(t))} per mesh).  The outputs
+  # must be on the seed points.  If layouts is a dict, layouts[file]
+  # is set to whether MAPFL wrote the file pt.
+  nml = namelist_io.read_namelist(mapfl_in)
+  directories = write_runs(nml, meshes)
+  ierr, failure = run_directories(directories, command, workers, label, report, time_limit, append, cores)
+  if ierr:
+    return ierr, failure, None
+  outputs = []
+  for directory, (tvec, pvec) in zip(directories, meshes):
+    outputs.append({})
+    for file in output_files(nml):
+      x, y, f, fits = read_output(os.path.join(directory, file), {'t': np.asarray(tvec), 'p': np.asarray(pvec)})
+      fits = [pt for pt, kinds in fits.items() if set(kinds.values()) == {'points'}]
+      if not fits:
+        return 1, {'reason': 'stitch', 'detail': file+' of '+directory+' is not on the seed points'}, None
+      pt = fits[0] if len(fits) == 1 else (layouts or {}).get(file, False)
+      outputs[-1][file] = np.transpose(in_layout(x, y, f, pt)[1])
+      if layouts is not None:
+        layouts[file] = pt
+  for directory in directories:
+    shutil.rmtree(directory)
+  return 0, None, outputs
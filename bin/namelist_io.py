@@ -0,0 +1,110 @@
+import os
+import re
+import sys
+import numbers
+from functools import lru_cache
+
+########################################################################
+#  NAMELIST_IO: Read, modify, and write Fortran namelist input files
+########################################################################
+#        Predictive Science Inc.
+#        www.predsci.com
+#        San Diego, California, USA 92121
+########################################################################
+# Copyright 2024 Predictive Science Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+########################################################################
+#
+# Used to customize the POT3D (pot3d.dat) and MAPFL (mapfl.in) input
+# templates in rsrc/.  The templates have one "key=value" per line; the
+# comments and layout are kept and only the lines of the set keys are
+# rewritten.  Keys are case-insensitive (as in Fortran) and must exist
+# in the template, so a misspelled key is an error instead of a silent
+# no-op.  Python values are written as Fortran values:
+#   bool -> .true./.false.,  number -> number,  str -> 'quoted string'.
+#
+########################################################################
+
+_assignment = re.compile(r'^\s*([A-Za-z_][\w%]*)\s*=')
+
+@lru_cache(maxsize=None)
+def _parse(file, mtime):
+  with open(file) as f:
+    lines = tuple(f.read().splitlines())
+  keys = {}
+  for i, line in enumerate(lines):
+    match = _assignment.match(line)
+    if match and not line.lstrip().startswith('!'):
+      keys[match.group(1).lower()] = (i, match.group(1))
+  return lines, keys
+
+def read_namelist(file):
+  # Templates are parsed once per process (and again if modified).
+  lines, keys = _parse(os.path.abspath(file), os.stat(file).st_mtime_ns)
+  return {'file': file, 'lines': list(lines), 'keys': keys}
+
+def format_value(value):
+  if isinstance(value, bool) or type(value).__name__ == 'bool_':
+    return '.true.' if value else '.false.'
+  if isinstance(value, numbers.Number):
+    return str(value)
+  return "'" + str(value).replace("'", "''") + "'"
+
+def get_value(nml, key):
+  # Value of key as a Python value (the inverse of format_value).
+  entry = nml['keys'].get(key.lower())
+  check_error_code(entry is None, 'ERROR: '+key+' is not a variable in '+str(nml['file']))
+  text = nml['lines'][entry[0]].split('=', 1)[1]
+  if not text.strip().startswith(("'", '"')):
+    text = text.split('!', 1)[0]
+  text = text.strip().rstrip(',')
+  if text.lower() in ('.true.', '.false.'):
+    return text.lower() == '.true.'
+  if text[:1] in ("'", '"'):
+    return text[1:-1].replace(text[0]*2, text[0])
+  try:
+    return int(text)
+  except ValueError:
+    pass
+  try:
+    return float(text.lower().replace('d', 'e'))
+  except ValueError:
+    return text
+
+def set_values(nml, values):
+  for key, value in values.items():
+    entry = nml['keys'].get(key.lower())
+    check_error_code(entry is None, 'ERROR: '+key+' is not a variable in '+str(nml['file']))
+    i, name = entry
+    nml['lines'][i] = '  ' + name + '=' + format_value(value)
+
+def write_namelist(nml, file):
+  tmp = str(file) + '.tmp'
+  with open(tmp, 'w') as f:
+    f.write('\n'.join(nml['lines']) + '\n')
+  os.replace(tmp, file)
+
+def customize(template, file, values):
+  # Write file from template with values set, in one step.
+  nml = read_namelist(template)
+  set_values(nml, values)
+  write_namelist(nml, file)
+
+def check_error_code(ierr,message):
+  if ierr > 0:
+    print(' ')
+    print(message)
+    print('Error code of fail : '+str(ierr))
+    sys.exit(1)
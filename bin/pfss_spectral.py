@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+import os
+import sys
+import argparse
+import numpy as np
+from scipy.interpolate import RegularGridInterpolator
+#
+import psi_io as ps
+import swig_planner as planner
+
+########################################################################
+#  PFSS_SPECTRAL: Spherical-harmonic PFSS solver (NumPy)
+########################################################################
+#        Predictive Science Inc.
+#        www.predsci.com
+#        San Diego, California, USA 92121
+########################################################################
+# Copyright 2024 Predictive Science Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+########################################################################
+#
+# A fast alternative to the POT3D PFSS solve for screening runs.  The
+# input Br(r0,t,p) is expanded in (orthonormal) spherical harmonics,
+#   Br(r0) = sum a_lm Y_lm,
+# using an FFT in phi and Gauss-Legendre quadrature in cos(t) (the map
+# is interpolated linearly to the quadrature nodes).  The monopole l=0
+# is dropped, which balances the flux as POT3D does.  With the potential
+# zero at the source surface s (B = -grad Phi),
+#   Phi = sum a_lm g_l(r) Y_lm,   Br = sum a_lm f_l(r) Y_lm,
+#   f_l(r) = [(l+1)(r0/r)^(l+2) + l(r/s)^(l-1)(r0/s)^(l+2)] / D_l,
+#   g_l(r) = r0[(r0/r)^(l+1) - (r/s)^l (r0/s)^(l+1)] / D_l,
+#   D_l    = (l+1) + l(r0/s)^(2l+1),
+# and Bt = -(1/r) dPhi/dt, Bp = -(1/(r sin t)) dPhi/dp.
+#
+# The fields are written as br/bt/bp_pfss.h5 on the staggered meshes
+# of POT3D, so that they can be used in place of its outputs.  For the
+# POT3D sizes nr, nt, np (of the half meshes), the main meshes r, t, p
+# have nr-1, nt-1, np-1 points: r from r0 to s with cells growing
+# geometrically by drratio (largest/smallest cell, as POT3D's mesh with
+# one rfrac segment and nfrmesh=0), t and p uniform from 0 to pi and
+# 2pi.  The half meshes rh, th, ph are their midpoints plus a ghost
+# point half a cell outside each end.  Br is on (r, th, ph), Bt on
+# (rh, t, ph), and Bp on (rh, th, p); the analytic solution is evaluated
+# at the ghost points too.  br_rss.h5 (the CS input) and br_r0_pfss.h5
+# (Br at r0 on (th, ph)) are written as for POT3D.
+#
+# As the solution is linear in Br(r0), the solution of a map close to
+# another one already solved by POT3D (e.g. an ensemble realization and
+# the ensemble mean) is obtained by adding the spectral solution of the
+# (small, smooth) difference to it: perturb_solution().
+#
+########################################################################
+
+def argParsing():
+  parser = argparse.ArgumentParser(description='Spherical-harmonic PFSS solution for an input Br map (and comparison with a POT3D solution).')
+
+  parser.add_argument('br_input_file',
+    help='Br map input file (pt or tp).',
+    type=str)
+
+  parser.add_argument('-rss',
+    help='Specify the rss distance (default=2.5).',
+    dest='rss',
+    type=float,
+    default=2.5,
+    required=False)
+
+  parser.add_argument('-nr',
+    help='POT3D radial size nr (half mesh points; default: as POT3D, from the map size).',
+    dest='nr',
+    type=int,
+    required=False)
+
+  parser.add_argument('-drratio',
+    help='Ratio of the largest to the smallest radial cell (default 2.5, as in rsrc/pot3d_pfss.dat).',
+    dest='drratio',
+    type=float,
+    default=2.5,
+    required=False)
+
+  parser.add_argument('-lmax',
+    help='Maximum spherical harmonic degree (default: resolved by the map).',
+    dest='lmax',
+    type=int,
+    required=False)
+
+  parser.add_argument('-outdir',
+    help='Directory to write the solution in (default: current directory).',
+    dest='outdir',
+    type=str,
+    default='.',
+    required=False)
+
+  parser.add_argument('-compare',
+    help='Directory of a POT3D PFSS solution (br/bt/bp_pfss.h5) to compare the spectral solution with.',
+    dest='compare',
+    type=str,
+    required=False)
+
+  return parser.parse_args()
+
+def legendre(lmax, theta):
+  # Orthonormal associated Legendre functions P[l,m,:] (Y_lm = P e^imp)
+  # of cos(theta) and their derivatives dP/dtheta, for 0 <= m <= l <= lmax.
+  x, s = np.cos(theta), np.sin(theta)
+  P = np.zeros((lmax + 2, lmax + 2, len(theta)))
+  P[0, 0] = 1/np.sqrt(4*np.pi)
+  for m in range(1, lmax + 2):
+    P[m, m] = -np.sqrt((2*m + 1)/(2*m))*s*P[m-1, m-1]
+  for m in range(0, lmax + 1):
+    P[m+1, m] = np.sqrt(2*m + 3)*x*P[m, m]
+    for l in range(m + 2, lmax + 2):
+      a = np.sqrt((4*l*l - 1)/(l*l - m*m))
+      b = np.sqrt(((l - 1)**2 - m*m)/(4*(l - 1)**2 - 1))
+      P[l, m] = a*(x*P[l-1, m] - b*P[l-2, m])
+  dP = np.zeros((lmax + 1, lmax + 1, len(theta)))
+  for l in range(1, lmax + 1):
+    dP[l, 0] = np.sqrt(l*(l + 1))*P[l, 1]
+    for m in range(1, l + 1):
+      dP[l, m] = 0.5*(np.sqrt((l + m + 1)*(l - m))*P[l, m+1] - np.sqrt((l + m)*(l - m + 1))*P[l, m-1])
+  return P[:lmax+1, :lmax+1], dP
+
+def uniform_p(pvec, f):
+  # The map on uniform, non-duplicated periodic phi points (nt, np).
+  if abs(pvec[-1] - pvec[0] - 2*np.pi) < 1e-6:
+    pvec, f = pvec[:-1], f[:, :-1]
+  npp = len(pvec)
+  puni = pvec[0] + np.arange(npp)*2*np.pi/npp
+  if not np.allclose(pvec, puni, atol=1e-6*2*np.pi/npp):
+    f = np.array([np.interp(puni, pvec, row, period=2*np.pi) for row in f])
+  return puni, f
+
+def default_lmax(tvec, pvec):
+  return int(min(len(tvec) - 1, (len(pvec) - 1)//2))
+
+def analyze(tvec, pvec, br, lmax):
+  # Coefficients a[l,m] (m >= 0) of br (nt, np) at r0.
+  puni, f = uniform_p(pvec, br)
+  lmax = min(lmax, (len(puni) - 1)//2)
+  F = np.fft.rfft(f, axis=1)[:, :lmax+1]*np.exp(-1j*np.arange(lmax + 1)*puni[0])
+  x, w = np.polynomial.legendre.leggauss(max(lmax + 1, len(tvec)))
+  theta = np.arccos(x)
+  order = np.argsort(tvec)
+  Fg = np.array([np.interp(theta, tvec[order], F[order, m].real) + 1j*np.interp(theta, tvec[order], F[order, m].imag)
+                 for m in range(lmax + 1)])
+  P, _ = legendre(lmax, theta)
+  a = np.einsum('lmj,j,mj->lm', P, w, Fg)*2*np.pi/len(puni)
+  a[0, 0] = 0.0
+  return a
+
+def radial_functions(lmax, r, r0, rss):
+  # f_l(r) and g_l(r) (lmax+1, nr).
+  l = np.arange(lmax + 1)[:, None]
+  r = np.asarray(r)[None, :]
+  den = (l + 1) + l*(r0/rss)**(2*l + 1)
+  f = ((l + 1)*(r0/r)**(l + 2) + l*(r/rss)**(l - 1)*(r0/rss)**(l + 2))/den
+  g = r0*((r0/r)**(l + 1) - (r/rss)**l*(r0/rss)**(l + 1))/den
+  return f, g
+
+def synthesize(a, radial, P, pvec):
+  # sum a_lm h_l(r) P_lm(t) e^imp, as an array (np, nt, nr).
+  lmax = a.shape[0] - 1
+  C = np.einsum('lmt,lm,lr->mtr', P, a, radial, optimize=True)
+  m = np.arange(lmax + 1)
+  E = np.where(m == 0, 1.0, 2.0)[:, None]*np.exp(1j*m[:, None]*np.asarray(pvec)[None, :])
+  return np.real(np.tensordot(E, C, axes=([0], [0])))
+
+def r_mesh(r0, rss, nr, drratio):
+  # nr points from r0 to rss, with cells growing geometrically by drratio.
+  if nr < 3 or drratio == 1.0:
+    return np.linspace(r0, rss, nr)
+  q = drratio**(1.0/(nr - 2))
+  dr = q**np.arange(nr - 1)
+  return r0 + (rss - r0)*np.concatenate([[0.0], np.cumsum(dr)/np.sum(dr)])
+
+def half_mesh(vec):
+  # Midpoints of vec, with a ghost point half a cell outside each end.
+  mid = 0.5*(vec[1:] + vec[:-1])
+  return np.concatenate([[2*vec[0] - mid[0]], mid, [2*vec[-1] - mid[-1]]])
+
+def evaluate(a, name, r, t, p, r0, rss):
+  # Component name (br, bt, or bp) of the solution with coefficients a on
+  # the mesh (r, t, p), as an array (np, nt, nr).
+  lmax = a.shape[0] - 1
+  r, t, p = np.asarray(r), np.asarray(t), np.asarray(p)
+  f, g = radial_functions(lmax, r, r0, rss)
+  P, dP = legendre(lmax, t)
+  if name == 'br':
+    return synthesize(a, f, P, p)
+  if name == 'bt':
+    return synthesize(a, -g/r, dP, p)
+  s = np.sin(t)
+  s[np.abs(s) < 1e-12] = np.inf
+  return synthesize(a*1j*np.arange(lmax + 1)[None, :], -g/r, P, p)/s[None, :, None]
+
+def pot3d_meshes(nr, nt, np_, rss, r0=1.0, drratio=2.5):
+  # Staggered meshes (r, t, p) of br, bt, bp, and br at r0 of a POT3D
+  # run of size nr, nt, np (see above).
+  r = r_mesh(r0, rss, nr - 1, drratio)
+  t = np.linspace(0, np.pi, nt - 1)
+  p = np.linspace(0, 2*np.pi, np_ - 1)
+  rh, th, ph = half_mesh(r), half_mesh(t), half_mesh(p)
+  return {'br': (r, th, ph), 'bt': (rh, t, ph), 'bp': (rh, th, p), 'br_r0': (r[:1], th, ph)}
+
+def solve(tvec, pvec, br, rss, nr, r0=1.0, drratio=2.5, lmax=None):
+  # PFSS fields of br (nt, np) on the meshes of the POT3D run of the map
+  # (nr, and nt, np of one more than the map, as cor_pfss_cs_pot3d.py
+  # sets them).  Returns a dict name -> (rvec, tvec, pvec, data (np, nt,
+  # nr)).
+  tvec, pvec, br = np.asarray(tvec), np.asarray(pvec), np.asarray(br)
+  lmax = default_lmax(tvec, pvec) if lmax is None else lmax
+  a = analyze(tvec, pvec, br, lmax)
+  meshes = pot3d_meshes(nr, len(tvec) + 1, len(pvec) + 1, rss, r0, drratio)
+  return {name: (*mesh, evaluate(a, name[:2], *mesh, r0, rss)) for name, mesh in meshes.items()}
+
+def write_solution(fields, outdir='.', br_r0=True):
+  # Write the POT3D PFSS outputs (and the CS input br_rss.h5).
+  for name in ('br', 'bt', 'bp'):
+    r, t, p, data = fields[name]
+    ps.wrhdf_3d(os.path.join(outdir, name+'_pfss.h5'), r, t, p, data)
+  r, t, p, data = fields['br']
+  ps.wrhdf_2d(os.path.join(outdir, 'br_rss.h5'), t, p, data[:, :, -1])
+  if br_r0:
+    r, t, p, data = fields['br_r0']
+    ps.wrhdf_2d(os.path.join(outdir, 'br_r0_pfss.h5'), t, p, data[:, :, 0])
+
+def perturb_solution(mean_dir, tvec, pvec, br, rss, r0=1.0, lmax=40, outdir='.', br_r0=True):
+  # Linear (ensemble) solution: the POT3D solution of the mean map in
+  # mean_dir plus the spectral solution of br - mean map, truncated at
+  # lmax, evaluated on the meshes of the POT3D solution.  Returns the
+  # size of the perturbation and the error from its truncation (at r0,
+  # relative to br).
+  tm, pm, fm = ps.rdhdf_2d(os.path.join(mean_dir, 'br_input_tp.h5'))
+  fm = np.transpose(np.asarray(fm))
+  if fm.shape != np.shape(br):
+    return None
+  diff = np.asarray(br) - fm
+  a = analyze(tvec, pvec, diff, lmax)
+  for name in ('br', 'bt', 'bp'):
+    r, t, p, f = ps.rdhdf_3d(os.path.join(mean_dir, name+'_pfss.h5'))
+    ps.wrhdf_3d(os.path.join(outdir, name+'_pfss.h5'), r, t, p, np.asarray(f) + evaluate(a, name, r, t, p, r0, rss))
+  mean_r0 = os.path.join(mean_dir, 'br_r0_pfss.h5')
+  if br_r0 and os.path.exists(mean_r0):
+    t, p, f = ps.rdhdf_2d(mean_r0)
+    ps.wrhdf_2d(os.path.join(outdir, 'br_r0_pfss.h5'), t, p, np.asarray(f) + evaluate(a, 'br', [r0], t, p, r0, rss)[:, :, 0])
+  # The l=0 part of the difference is flux imbalance, which POT3D removes too.
+  resolved = np.transpose(evaluate(a, 'br', [r0], tvec, pvec, r0, rss)[:, :, 0])
+  weight = np.sin(tvec)[:, None]*np.ones(len(pvec))[None, :]
+  diff = diff - np.sum(diff*weight)/np.sum(weight)
+  norm = max(np.linalg.norm(br), 1e-300)
+  return {'lmax': int(a.shape[0] - 1),
+          'perturbation': float(np.linalg.norm(diff)/norm),
+          'truncation_error': float(np.linalg.norm(diff - resolved)/norm)}
+
+def compare(spectral_dir, pot3d_dir):
+  # Relative L2 and max differences of the spectral fields from POT3D's
+  # (interpolated to the spectral mesh).
+  result = {}
+  for name in ('br', 'bt', 'bp'):
+    r, t, p, f = ps.rdhdf_3d(os.path.join(spectral_dir, name+'_pfss.h5'))
+    r_ref, t_ref, p_ref, f_ref = ps.rdhdf_3d(os.path.join(pot3d_dir, name+'_pfss.h5'))
+    interp = RegularGridInterpolator((np.asarray(p_ref), np.asarray(t_ref), np.asarray(r_ref)), np.asarray(f_ref),
+                                     bounds_error=False, fill_value=None)
+    pp, tt, rr = np.meshgrid(p, t, r, indexing='ij')
+    g = interp(np.stack([pp, tt, rr], axis=-1))
+    f = np.asarray(f)
+    result[name] = {'rel_l2': float(np.linalg.norm(f - g)/max(np.linalg.norm(g), 1e-300)),
+                    'max_abs': float(np.max(np.abs(f - g))),
+                    'max_ref': float(np.max(np.abs(g)))}
+  return result
+
+def read_map_tp(br_input_file):
+  # The map as (tvec, pvec, f (nt, np)), from a pt or tp file.
+  xvec, yvec, data = ps.rdhdf_2d(br_input_file)
+  xvec, yvec, data = np.asarray(xvec), np.asarray(yvec), np.asarray(data)
+  if np.max(xvec) > 3.5:
+    return yvec, xvec, data
+  return xvec, yvec, np.transpose(data)
+
+def check_error_code(ierr,message):
+  if ierr > 0:
+    print(' ')
+    print(message)
+    print('Error code of fail : '+str(ierr))
+    sys.exit(1)
+
+def main():
+  args = argParsing()
+  check_error_code(args.rss <= 1.0, 'ERROR: rss must be greather than 1.')
+  tvec, pvec, br = read_map_tp(args.br_input_file)
+  nr = args.nr or planner.pot3d_grid('pfss', len(tvec) + 1, len(pvec) + 1)[0]
+  os.makedirs(args.outdir, exist_ok=True)
+  fields = solve(tvec, pvec, br, args.rss, nr, drratio=args.drratio, lmax=args.lmax)
+  write_solution(fields, args.outdir)
+  print(f'=> Spectral PFSS solution (nr={nr}, lmax={args.lmax or default_lmax(tvec, pvec)}) written to {args.outdir}')
+  if args.compare:
+    print(f'=> Relative differences from the POT3D solution in {args.compare}:')
+    for name, diff in compare(args.outdir, args.compare).items():
+      print(f"   {name}: relative L2 {diff['rel_l2']:.3e}, max |diff| {diff['max_abs']:.3e} (max |B| {diff['max_ref']:.3e})")
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+import os
+import sys
+import argparse
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+#
+import psi_io as ps
+
+########################################################################
+#  PLOT_MAPS: Render 2D (t,p) maps to PNG in-process and in parallel
+########################################################################
+#        Predictive Science Inc.
+#        www.predsci.com
+#        San Diego, California, USA 92121
+########################################################################
+# Copyright 2024 Predictive Science Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+########################################################################
+#
+# This renders the same latitude-longitude plots as
+#   psi_plot2d -tp -ll -finegrid [-unit_label L] [-cmin A] [-cmax B] [-cmap C]
+# without starting a new Python/matplotlib process for every map.
+# Each plot is described by a dict with the keys:
+#   data:   HDF5 file name, or an in-memory tuple (xvec, yvec, data)
+#           in the psi_io.rdhdf_2d layout (pt or tp is auto-detected).
+#   output: PNG file name.
+#   unit_label, cmin, cmax, cmap: optional, as in psi_plot2d.
+# The colormaps of psi_plot2d itself (psi_red_blue, also its default)
+# are not reproduced here: callers leave the plots that use them to
+# psi_plot2d (see renders()), whose commands render_plots() runs in the
+# same pool of workers.
+#
+########################################################################
+
+def argParsing():
+  parser = argparse.ArgumentParser(description='Plot 2D (t,p) HDF5 maps in latitude-longitude.')
+
+  parser.add_argument('files',
+    help='HDF5 map file(s) to plot.',
+    nargs='+',
+    type=str)
+
+  parser.add_argument('-unit_label',
+    help='Colorbar unit label.',
+    dest='unit_label',
+    type=str,
+    required=False)
+
+  parser.add_argument('-cmin',
+    help='Minimum colorbar value.',
+    dest='cmin',
+    type=float,
+    required=False)
+
+  parser.add_argument('-cmax',
+    help='Maximum colorbar value.',
+    dest='cmax',
+    type=float,
+    required=False)
+
+  parser.add_argument('-cmap',
+    help='Colormap (any matplotlib colormap; use psi_plot2d for psi_red_blue).',
+    dest='cmap',
+    type=str,
+    required=True)
+
+  parser.add_argument('-workers',
+    help='Number of parallel plotting processes (default: number of files, up to the CPU count).',
+    dest='workers',
+    type=int,
+    required=False)
+
+  return parser.parse_args()
+
+def have_matplotlib():
+  try:
+    import matplotlib
+  except ImportError:
+    return False
+  return True
+
+# Colormaps only psi_plot2d has (None: its default, psi_red_blue).
+PSI_PLOT2D_CMAPS = ('psi_red_blue', None)
+
+def renders(spec):
+  # Whether the plot of spec is rendered here (otherwise psi_plot2d is
+  # needed for its colormap).
+  return spec.get('cmap') not in PSI_PLOT2D_CMAPS
+
+def get_cmap(name):
+  import matplotlib
+  return matplotlib.colormaps[name]
+
+def load_map(data):
+  if isinstance(data, (str, os.PathLike)):
+    xvec, yvec, f = ps.rdhdf_2d(str(data))
+  else:
+    xvec, yvec, f = data
+  xvec = np.asarray(xvec)
+  yvec = np.asarray(yvec)
+  f = np.asarray(f)
+  # Return phi, theta and the data as (nt, np) (pt layout).
+  if np.max(xvec) > 3.5:
+    return xvec, yvec, f
+  return yvec, xvec, np.transpose(f)
+
+def render_plot(spec):
+  from matplotlib.figure import Figure
+
+  pvec, tvec, f = load_map(spec['data'])
+  lon = np.degrees(pvec)
+  lat = 90.0 - np.degrees(tvec)
+
+  cmin = spec.get('cmin')
+  cmax = spec.get('cmax')
+  cmin = np.nanmin(f) if cmin is None else cmin
+  cmax = np.nanmax(f) if cmax is None else cmax
+
+  # Use the object-oriented API (no pyplot state) with the Agg canvas.
+  fig = Figure(figsize=(12.6, 6.1), dpi=200)
+  ax = fig.add_subplot()
+  im = ax.pcolormesh(lon, lat, f, cmap=get_cmap(spec.get('cmap')),
+                     vmin=cmin, vmax=cmax, shading='nearest', rasterized=True)
+  ax.set_xlim(0, 360)
+  ax.set_ylim(-90, 90)
+  # Major ticks as in psi_plot2d -ll, with the -finegrid minor grid.
+  ax.set_xticks(np.arange(0, 361, 90))
+  ax.set_yticks(np.arange(-90, 91, 45))
+  ax.set_xticks(np.arange(0, 361, 10), minor=True)
+  ax.set_yticks(np.arange(-90, 91, 5), minor=True)
+  ax.grid(True, which='major', color='0.6', linewidth=1.0)
+  ax.grid(True, which='minor', color='0.75', linewidth=0.5)
+  ax.tick_params(labelsize=20)
+  ax.set_xlabel('Longitude ($^\\circ$)', fontsize=20)
+  ax.set_ylabel('Latitude ($^\\circ$)', fontsize=20)
+  cbar = fig.colorbar(im, ax=ax, fraction=0.04, pad=0.02)
+  cbar.ax.tick_params(labelsize=20)
+  if spec.get('unit_label'):
+    cbar.set_label(spec['unit_label'].strip('"'), fontsize=20)
+  fig.savefig(spec['output'], bbox_inches='tight')
+  return spec['output']
+
+def start_pool(workers=None):
+  # Pool of plotting processes (default: one per CPU, started as they
+  # are needed).  The workers are forked from a server process that has
+  # imported matplotlib once (forkserver), which is safe even when the
+  # pool is used from threads (e.g. those of swig_scheduler.py), unlike
+  # forking the caller.  Where there is no forkserver they are spawned.
+  if 'forkserver' not in multiprocessing.get_all_start_methods():
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+  from multiprocessing import forkserver
+  context = multiprocessing.get_context('forkserver')
+  context.set_forkserver_preload(['matplotlib.figure', 'psi_io', 'plot_maps'])
+  # Start the server now, while the caller may still be single-threaded.
+  forkserver.ensure_running()
+  return ProcessPoolExecutor(max_workers=workers, mp_context=context)
+
+def run_in(cwd, func, arg):
+  # Run func(arg) in the directory cwd (the workers do not follow the
+  # working directory of the caller).
+  os.chdir(cwd)
+  return func(arg)
+
+def render_plots(specs, workers=None, pool=None, commands=()):
+  # Render the plots of specs and run the shell commands (e.g. psi_plot2d
+  # for the plots with its colormaps) in parallel, with pool (see
+  # start_pool) or else with a pool of workers processes started here.
+  # Returns the exit statuses of the commands.
+  tasks = [(render_plot, spec) for spec in specs] + [(os.system, command) for command in commands]
+  if pool is None:
+    if workers is None:
+      workers = min(len(tasks), os.cpu_count() or 1)
+    if workers <= 1 or len(tasks) <= 1:
+      return [func(arg) for func, arg in tasks][len(specs):]
+    with start_pool(workers) as pool:
+      return render_plots(specs, pool=pool, commands=commands)
+  futures = [pool.submit(run_in, os.getcwd(), func, arg) for func, arg in tasks]
+  return [future.result() for future in futures][len(specs):]
+
+def check_error_code(ierr,message):
+  if ierr > 0:
+    print(' ')
+    print(message)
+    print('Error code of fail : '+str(ierr))
+    sys.exit(1)
+
+def main():
+  args = argParsing()
+  check_error_code(not have_matplotlib(), 'Failed : matplotlib is required for plot_maps.py')
+  check_error_code(args.cmap in PSI_PLOT2D_CMAPS, 'Failed : '+args.cmap+' is a psi_plot2d colormap, use psi_plot2d')
+  specs = [{'data': f, 'output': os.path.splitext(f)[0]+'.png', 'unit_label': args.unit_label,
+            'cmin': args.cmin, 'cmax': args.cmax, 'cmap': args.cmap} for f in args.files]
+  render_plots(specs, args.workers)
+
+if __name__ == '__main__':
+  main()
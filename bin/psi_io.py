@@ -55,6 +55,57 @@ def rdhdf_3d(hdf_filename):
     return(x,y,z,f)
 
 
+def rdh5_scales(h5_filename):
+    # Read only the scales of a file (without loading the data).
+    x = np.array([])
+    y = np.array([])
+    z = np.array([])
+
+    with h5.File(h5_filename, 'r') as h5file:
+        f = h5file['Data']
+        scales = [np.array([]), np.array([]), np.array([])]
+        for i in range(0,np.ndim(f)):
+            if (len(f.dims[i].keys())!=0):
+                scales[i] = np.array(f.dims[i][0])
+        x, y, z = scales
+
+    return (x,y,z)
+
+def rdh5_slice(h5_filename, index):
+    # Read a single slice f[index,:,:] of a 3D file (along the last
+    # scale, z) without loading the rest of the data.
+    with h5.File(h5_filename, 'r') as h5file:
+        f = np.array(h5file['Data'][index])
+
+    return f
+
+def rdh5_xrange(h5_filename, xmin, xmax):
+    # Read the part of a 3D file with its first scale (x) in [xmin, xmax],
+    # plus one more point on either side (for interpolation), with a
+    # hyperslab read: only that part of the data is loaded.
+    with h5.File(h5_filename, 'r') as h5file:
+        f = h5file['Data']
+        x, y, z = [np.array(f.dims[i][0]) for i in range(3)]
+        i0 = max(np.searchsorted(x, xmin, side='right') - 2, 0)
+        i1 = min(np.searchsorted(x, xmax, side='left') + 2, len(x))
+        data = np.array(f[:, :, i0:i1])
+
+    return (x[i0:i1], y, z, data)
+
+def rdhdf_scales(hdf_filename):
+
+    x,y,z = rdh5_scales(hdf_filename)
+    return (x,y,z)
+
+def rdhdf_3d_slice(hdf_filename, index):
+
+    return rdh5_slice(hdf_filename, index)
+
+def rdhdf_3d_xrange(hdf_filename, xmin, xmax):
+
+    return rdh5_xrange(hdf_filename, xmin, xmax)
+
+
 def wrh5(h5_filename, x, y, z, f):
 
     h5file = h5.File(h5_filename, 'w')
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+import os
+import sys
+import hashlib
+import argparse
+from collections import OrderedDict
+import numpy as np
+#
+import psi_io as ps
+
+########################################################################
+#  REMESH_MAP: Flux-conserving remesh of 2D (t,p) full-Sun maps
+########################################################################
+#        Predictive Science Inc.
+#        www.predsci.com
+#        San Diego, California, USA 92121
+########################################################################
+# Copyright 2024 Predictive Science Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+########################################################################
+#
+# Each map point is taken to represent the cell around it (bounded by
+# the midpoints to its neighbours, the poles, and periodic in phi).
+# A new point's value is the area-weighted average of the old cells it
+# overlaps (area measured as d(cos t) dp on the sphere), so the total
+# flux of a Br map is preserved.  The weights are separable in t and p.
+#
+# A map can be coarsened by a factor (for the -preview runs of swig.py)
+# or remeshed to a target resolution or to the grid of another map
+# (swig.py -remesh).  The weights of each (source grid, target grid)
+# pair are cached, in memory and as .npz files in $SWIG_REMESH_CACHE
+# (default ~/.swig/remesh_cache), so that a batch of maps of the same
+# size computes them only once.
+#
+########################################################################
+
+def argParsing():
+  parser = argparse.ArgumentParser(description='Coarsen or remesh a 2D (t,p) full-Sun map while conserving flux.')
+
+  parser.add_argument('input_map',
+    help='Input 2D map (h5, pt or tp).',
+    type=str)
+
+  parser.add_argument('output_map',
+    help='Output 2D map (h5, same layout as the input).',
+    type=str)
+
+  parser.add_argument('-factor',
+    help='Coarsening factor in each dimension (default 4, unless -target is set).',
+    dest='factor',
+    type=int,
+    required=False)
+
+  parser.add_argument('-target',
+    help='Target resolution NPxNT (phi x theta points, as in the map file names, e.g. 361x181), or an h5 map whose grid to remesh to.',
+    dest='target',
+    type=str,
+    required=False)
+
+  return parser.parse_args()
+
+def is_periodic_dup(pvec):
+  # True if the last phi point repeats the first one (at +2pi).
+  return len(pvec) > 1 and abs(pvec[-1] - pvec[0] - 2*np.pi) < 1e-6
+
+def t_edges(tvec):
+  edges = np.empty(len(tvec) + 1)
+  edges[1:-1] = 0.5*(tvec[1:] + tvec[:-1])
+  edges[0] = 0.0
+  edges[-1] = np.pi
+  return edges
+
+def p_edges(pvec):
+  # Cell edges of the (non-duplicated) periodic phi points.
+  edges = np.empty(len(pvec) + 1)
+  edges[1:-1] = 0.5*(pvec[1:] + pvec[:-1])
+  edges[0] = 0.5*(pvec[-1] - 2*np.pi + pvec[0])
+  edges[-1] = edges[0] + 2*np.pi
+  return edges
+
+def overlap(lo_new, hi_new, lo_old, hi_old):
+  return np.maximum(0.0, np.minimum(hi_new[:, None], hi_old[None, :]) -
+                         np.maximum(lo_new[:, None], lo_old[None, :]))
+
+def t_weights(tvec, tvec_new):
+  # Weights W (n_new, n_old) such that f_new = W @ f, from the overlap
+  # of the cells in u = -cos(t) (proportional to their area).
+  e_old = -np.cos(t_edges(tvec))
+  e_new = -np.cos(t_edges(tvec_new))
+  w = overlap(e_new[:-1], e_new[1:], e_old[:-1], e_old[1:])
+  return w/np.sum(w, axis=1, keepdims=True)
+
+def p_weights(pvec, pvec_new):
+  # As t_weights, for periodic phi (without duplicate points).
+  e_old = p_edges(pvec)
+  e_new = p_edges(pvec_new)
+  w = sum(overlap(e_new[:-1], e_new[1:], e_old[:-1] + k*2*np.pi, e_old[1:] + k*2*np.pi)
+          for k in (-1, 0, 1))
+  return w/np.sum(w, axis=1, keepdims=True)
+
+# Weights of the most recently used grid pairs.
+CACHE_SIZE = 8
+_weights = OrderedDict()
+
+def cache_dir():
+  return os.environ.get('SWIG_REMESH_CACHE', os.path.expanduser('~/.swig/remesh_cache'))
+
+def grid_key(*vecs):
+  h = hashlib.sha1()
+  for vec in vecs:
+    vec = np.ascontiguousarray(vec, dtype=np.float64)
+    h.update(str(len(vec)).encode())
+    h.update(vec.tobytes())
+  return h.hexdigest()
+
+def remesh_weights(tvec, pvec, tvec_new, pvec_new):
+  # (t weights, p weights) of a grid pair (phi without duplicate points),
+  # from the cache if they were computed before.
+  key = grid_key(tvec, pvec, tvec_new, pvec_new)
+  if key in _weights:
+    _weights.move_to_end(key)
+    return _weights[key]
+  file = os.path.join(cache_dir(), key+'.npz')
+  try:
+    with np.load(file) as cached:
+      weights = cached['wt'], cached['wp']
+  except (OSError, KeyError, ValueError):
+    weights = t_weights(tvec, tvec_new), p_weights(pvec, pvec_new)
+    try:
+      os.makedirs(cache_dir(), exist_ok=True)
+      tmp = file+'.'+str(os.getpid())+'.tmp.npz'
+      np.savez(tmp, wt=weights[0], wp=weights[1])
+      os.replace(tmp, file)
+    except OSError as e:
+      print('=> WARNING: could not cache remesh weights in '+cache_dir()+': '+str(e))
+  _weights[key] = weights
+  if len(_weights) > CACHE_SIZE:
+    _weights.popitem(last=False)
+  return weights
+
+def remesh_tp(tvec, pvec, f, tvec_new, pvec_new):
+  # Remesh f (nt, np) from (tvec, pvec) to (tvec_new, pvec_new).
+  dup, dup_new = is_periodic_dup(pvec), is_periodic_dup(pvec_new)
+  if dup:
+    pvec, f = pvec[:-1], f[:, :-1]
+  p_new = pvec_new[:-1] if dup_new else pvec_new
+  wt, wp = remesh_weights(tvec, pvec, tvec_new, p_new)
+  f_new = wt @ f @ wp.T
+  if dup_new:
+    f_new = np.concatenate([f_new, f_new[:, :1]], axis=1)
+  return f_new
+
+def uniform_mesh(tvec, pvec, nt, npp):
+  # Uniform mesh over the t range of the map, with a duplicate phi point
+  # if the map has one (npp counts it).
+  tvec_new = np.linspace(tvec[0], tvec[-1], nt)
+  if is_periodic_dup(pvec):
+    pvec_new = np.linspace(pvec[0], pvec[-1], npp)
+  else:
+    pvec_new = pvec[0] + np.arange(npp)*2*np.pi/npp
+  return tvec_new, pvec_new
+
+def coarse_mesh(tvec, pvec, factor):
+  nt = max((len(tvec) - 1)//factor + 1, 3)
+  if is_periodic_dup(pvec):
+    npp = max((len(pvec) - 1)//factor + 1, 4)
+  else:
+    npp = max(len(pvec)//factor, 3)
+  return uniform_mesh(tvec, pvec, nt, npp)
+
+def read_map(file):
+  # (tvec, pvec, f (nt, np), pt) of a 2D map in either layout.
+  xvec, yvec, f = ps.rdhdf_2d(str(file))
+  xvec, yvec, f = np.asarray(xvec), np.asarray(yvec), np.asarray(f)
+  pt = np.max(xvec) > 3.5
+  if pt:
+    return yvec, xvec, f, pt
+  return xvec, yvec, np.transpose(f), pt
+
+def write_map(file, tvec, pvec, f, pt):
+  if pt:
+    ps.wrhdf_2d(str(file), pvec, tvec, f)
+  else:
+    ps.wrhdf_2d(str(file), tvec, pvec, np.transpose(f))
+
+def target_mesh(target, tvec, pvec):
+  # Mesh for -target: NPxNT points, or the grid of a map file.
+  if os.path.exists(target):
+    tvec_new, pvec_new = read_map(target)[:2]
+    return tvec_new, pvec_new
+  try:
+    npp, nt = (int(n) for n in target.lower().split('x'))
+  except ValueError:
+    return None
+  if npp < 3 or nt < 3:
+    return None
+  return uniform_mesh(tvec, pvec, nt, npp)
+
+def coarsen_map(input_map, output_map, factor):
+  tvec, pvec, f, pt = read_map(input_map)
+  tvec_new, pvec_new = coarse_mesh(tvec, pvec, factor)
+  f_new = remesh_tp(tvec, pvec, f, tvec_new, pvec_new)
+  write_map(output_map, tvec_new, pvec_new, f_new, pt)
+  return f.shape, f_new.shape
+
+def remesh_xy(xvec, yvec, f, target):
+  # Remesh a map as read by ps.rdhdf_2d (f (ny, nx), pt or tp) to the
+  # -target mesh.  Returns (xvec, yvec, f) in the same layout, or None
+  # for an invalid target.
+  xvec, yvec, f = np.asarray(xvec), np.asarray(yvec), np.asarray(f)
+  pt = np.max(xvec) > 3.5
+  tvec, pvec, f = (yvec, xvec, f) if pt else (xvec, yvec, np.transpose(f))
+  mesh = target_mesh(target, tvec, pvec)
+  if mesh is None:
+    return None
+  tvec_new, pvec_new = mesh
+  f_new = remesh_tp(tvec, pvec, f, tvec_new, pvec_new)
+  return (pvec_new, tvec_new, f_new) if pt else (tvec_new, pvec_new, np.transpose(f_new))
+
+def remesh_map(input_map, output_map, target):
+  # Remesh input_map to the -target mesh.  Returns the shapes, or None
+  # for an invalid target.
+  xvec, yvec, f = ps.rdhdf_2d(str(input_map))
+  remeshed = remesh_xy(xvec, yvec, f, target)
+  if remeshed is None:
+    return None
+  ps.wrhdf_2d(str(output_map), *remeshed)
+  return np.shape(f), remeshed[2].shape
+
+def check_error_code(ierr,message):
+  if ierr > 0:
+    print(' ')
+    print(message)
+    print('Error code of fail : '+str(ierr))
+    sys.exit(1)
+
+def main():
+  args = argParsing()
+  if args.target:
+    shapes = remesh_map(args.input_map, args.output_map, args.target)
+    check_error_code(shapes is None, 'ERROR: invalid -target '+args.target+' (NPxNT or an h5 map).')
+    shape, shape_new = shapes
+  else:
+    factor = args.factor or 4
+    check_error_code(factor < 1, 'ERROR: -factor must be at least 1.')
+    shape, shape_new = coarsen_map(args.input_map, args.output_map, factor)
+  print(f'=> Remeshed {args.input_map} {shape} -> {args.output_map} {shape_new}')
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+import re
+import json
+import argparse
+from pathlib import Path
+import numpy as np
+#
+import solver_watchdog as watchdog
+import swig_stages as stages
+
+########################################################################
+#  SOLVER_LOGS: Metrics of the POT3D and MAPFL runs from their logs
+########################################################################
+#        Predictive Science Inc.
+#        www.predsci.com
+#        San Diego, California, USA 92121
+########################################################################
+# Copyright 2024 Predictive Science Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+########################################################################
+#
+# run_metrics() reads the logs of the PFSS and CS solves (pfss/, cs/)
+# and tracings of a run directory, and the stage times of its manifest,
+# into one record:
+#   pfss, cs:             CG iterations, final residual, residual
+#                         reduction, and residual history of POT3D,
+#   pfss_trace, cs_trace: field lines that failed and warnings of MAPFL,
+#   elapsed:              wallclock time of each stage.
+# swig.py writes the record of each map to results/solver_metrics*.json.
+# summarize() flattens the records of many runs into a table and flags
+# the outliers (e.g. maps needing many more CG iterations than the
+# others) by their robust z-score (distance from the median in units of
+# the median absolute deviation).
+#
+########################################################################
+
+# Line of a log with the number of CG iterations (if printed).
+ITERATIONS_LINE = re.compile(r'(?i)(\d+)\s+iterations|iterations\D*(\d+)')
+
+# Line of a log with a wallclock time.
+TIME_LINE = re.compile(r'(?i)(?:wall\s*clock|elapsed|total)\s*(?:run\s*)?time\D*?(\d+\.?\d*(?:[EeDd][-+]?\d+)?)')
+
+POT3D_TIMING = ['timing.out']
+
+# Columns of the summary table and those checked for outliers.
+SUMMARY_COLUMNS = ['pfss_iterations', 'cs_iterations', 'pfss_residual', 'cs_residual',
+                   'pfss_time', 'cs_time', 'pfss_trace_time', 'cs_trace_time', 'total_time']
+OUTLIER_COLUMNS = ['pfss_iterations', 'cs_iterations', 'pfss_time', 'cs_time',
+                   'pfss_trace_time', 'cs_trace_time', 'total_time']
+OUTLIER_Z = 3.5
+
+def argParsing():
+  parser = argparse.ArgumentParser(description='Extract the POT3D and MAPFL metrics of SWiG runs from their logs and flag outliers.')
+
+  parser.add_argument('rundirs',
+    help='Run directories (with pfss/ and cs/), or solver_metrics*.json files written by swig.py.',
+    nargs='+',
+    type=str)
+
+  parser.add_argument('-csv',
+    help='Also write the summary table to this CSV file.',
+    dest='csv',
+    type=str,
+    required=False)
+
+  return parser.parse_args()
+
+def log_lines(directory, logs):
+  for log in logs:
+    file = Path(directory) / log
+    if file.exists():
+      with open(file, errors='replace') as f:
+        yield from f
+
+def to_float(text):
+  return float(text.replace('D', 'E').replace('d', 'e'))
+
+def pot3d_metrics(solve_dir):
+  # CG metrics of the POT3D run in solve_dir.
+  history = []
+  iterations = None
+  for line in log_lines(solve_dir, [watchdog.POT3D_HISTORY]):
+    match = watchdog.RESIDUAL_LINE.match(line)
+    if match:
+      history.append((int(match.group(1)), to_float(match.group(2))))
+  for line in log_lines(solve_dir, [log for log in watchdog.POT3D_LOGS if log != watchdog.POT3D_HISTORY]):
+    match = ITERATIONS_LINE.search(line)
+    if match:
+      iterations = int(match.group(1) or match.group(2))
+  if iterations is None and history:
+    iterations = history[-1][0]
+  wall_time = None
+  for line in log_lines(solve_dir, watchdog.POT3D_LOGS + POT3D_TIMING):
+    match = TIME_LINE.search(line)
+    if match:
+      wall_time = to_float(match.group(1))
+  return {'iterations': iterations,
+          'residual': history[-1][1] if history else None,
+          'residual_reduction': history[0][1]/history[-1][1] if history and history[-1][1] > 0 else None,
+          'history': history,
+          'wall_time': wall_time}
+
+def mapfl_metrics(trace_dir):
+  # Failed field lines and warnings of the MAPFL run in trace_dir.
+  fatal = [re.compile(pattern) for pattern in watchdog.MAPFL_FATAL]
+  failed = warnings = 0
+  wall_time = None
+  for line in log_lines(trace_dir, watchdog.MAPFL_LOGS):
+    if any(pattern.search(line) for pattern in fatal):
+      failed += 1
+    elif 'WARNING' in line.upper():
+      warnings += 1
+    match = TIME_LINE.search(line)
+    if match:
+      wall_time = to_float(match.group(1))
+  return {'failed_lines': failed, 'warnings': warnings, 'wall_time': wall_time}
+
+def run_metrics(rundir):
+  # Metrics record of a SWiG run directory.
+  rundir = Path(rundir)
+  manifest = stages.load_manifest(rundir)['stages']
+  return {
+    'rundir': str(rundir),
+    'pfss': pot3d_metrics(rundir / 'pfss'),
+    'cs': pot3d_metrics(rundir / 'cs'),
+    'pfss_trace': mapfl_metrics(rundir / 'pfss'),
+    'cs_trace': mapfl_metrics(rundir / 'cs'),
+    'elapsed': {stage: entry['elapsed'] for stage, entry in manifest.items() if 'elapsed' in entry},
+  }
+
+def write_metrics(rundir, file, extra=None):
+  record = {**(extra or {}), **run_metrics(rundir)}
+  with open(file, 'w') as f:
+    json.dump(record, f, indent=1)
+  return record
+
+def load_metrics(path):
+  # Record of a run directory, or of a solver_metrics*.json file.
+  path = Path(path)
+  if path.is_dir():
+    return run_metrics(path)
+  with open(path) as f:
+    return json.load(f)
+
+def flatten(record):
+  # One row of the summary table.
+  elapsed = record.get('elapsed', {})
+  row = {'run': record.get('input_map', record.get('rundir'))}
+  for solve in ('pfss', 'cs'):
+    row[solve+'_iterations'] = record[solve]['iterations']
+    row[solve+'_residual'] = record[solve]['residual']
+    row[solve+'_time'] = elapsed.get(solve, record[solve]['wall_time'])
+  for trace in ('pfss_trace', 'cs_trace'):
+    row[trace+'_time'] = elapsed.get(trace, record[trace]['wall_time'])
+    row[trace+'_failed'] = record[trace]['failed_lines']
+  row['total_time'] = sum(elapsed.values()) if elapsed else None
+  return row
+
+def outliers(rows, columns=OUTLIER_COLUMNS, z=OUTLIER_Z):
+  # {row index: [columns]} of the values with a robust z-score above z
+  # (high values only: slow maps are the ones to diagnose).
+  flagged = {}
+  for column in columns:
+    values = np.array([row.get(column) if row.get(column) is not None else np.nan for row in rows], dtype=float)
+    valid = ~np.isnan(values)
+    if np.count_nonzero(valid) < 3:
+      continue
+    median = np.median(values[valid])
+    mad = 1.4826*np.median(np.abs(values[valid] - median))
+    scale = mad if mad > 0 else max(abs(median), 1e-12)
+    for i in np.nonzero(valid & ((values - median)/scale > z))[0]:
+      flagged.setdefault(int(i), []).append(column)
+  return flagged
+
+def summarize(records, csv=None):
+  # Print the summary table of the records with the outliers flagged.
+  rows = [flatten(record) for record in records]
+  flagged = outliers(rows)
+  def fmt(value):
+    if value is None:
+      return '-'
+    return f'{value:.2e}' if isinstance(value, float) and 0 < abs(value) < 1e-2 else \
+           (f'{value:.1f}' if isinstance(value, float) else str(value))
+  width = max([len(Path(str(row['run'])).name) for row in rows] + [3])
+  print(f"{'run':{width}s} " + ' '.join(f'{c:>15s}' for c in SUMMARY_COLUMNS))
+  for i, row in enumerate(rows):
+    line = f"{Path(str(row['run'])).name:{width}s} " + ' '.join(f'{fmt(row[c]):>15s}' for c in SUMMARY_COLUMNS)
+    failed = row['pfss_trace_failed'] + row['cs_trace_failed']
+    notes = ([f"OUTLIER: {','.join(flagged[i])}"] if i in flagged else []) + \
+            ([f'{failed} failed field line(s)'] if failed else [])
+    print(line + ('  <= ' + '; '.join(notes) if notes else ''))
+  if flagged:
+    print(f'=> {len(flagged)} of {len(rows)} runs flagged as outliers (robust z-score > {OUTLIER_Z}).')
+  if csv:
+    with open(csv, 'w') as f:
+      f.write(','.join(['run'] + SUMMARY_COLUMNS + ['outlier']) + '\n')
+      for i, row in enumerate(rows):
+        f.write(','.join([str(row['run'])] + ['' if row[c] is None else str(row[c]) for c in SUMMARY_COLUMNS]
+                         + [';'.join(flagged.get(i, []))]) + '\n')
+  return rows, flagged
+
+def main():
+  args = argParsing()
+  summarize([load_metrics(path) for path in args.rundirs], args.csv)
+
+if __name__ == '__main__':
+  main()
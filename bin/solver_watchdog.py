@@ -0,0 +1,187 @@
+import os
+import re
+import sys
+import json
+import time
+import signal
+import subprocess
+
+########################################################################
+#  SOLVER_WATCHDOG: Run POT3D/MAPFL while monitoring their logs
+########################################################################
+#        Predictive Science Inc.
+#        www.predsci.com
+#        San Diego, California, USA 92121
+########################################################################
+# Copyright 2024 Predictive Science Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+########################################################################
+#
+# run_watched() launches a command (in its own process group, so that
+# mpiexec and all of its ranks can be stopped together) and follows its
+# log files while it runs.  The run is aborted as soon as:
+#   fatal_pattern:   a log line matches one of the fatal patterns
+#                    (e.g. MAPFL's "A field line did not reach"),
+#   stalled:         the CG residual has not dropped by stall_factor over
+#                    the last stall_iterations iterations,
+#   iteration_limit: the CG iteration count exceeds max_iterations,
+#   time_limit:      the run exceeds time_limit seconds.
+# A run that exits with an error code fails with reason exit_code, and
+# the logs are checked once more after the run ends.  On failure the
+# reason is written as JSON to the report file (and printed), so that
+# the batch runner can report it and move on to the next map.
+#
+########################################################################
+
+# Fatal log patterns of the solvers.
+POT3D_FATAL = [r'###\s*ERROR', r'\bNaN\b']
+MAPFL_FATAL = [r'A field line did not reach', r'###\s*ERROR']
+
+# POT3D logs (stdout and CG convergence history).
+POT3D_HISTORY = 'pot3d_history.out'
+POT3D_LOGS = ['pot3d.log', 'pot3d.err', POT3D_HISTORY]
+MAPFL_LOGS = ['mapfl.log', 'mapfl.err']
+
+# A line of the CG history file (written every ncghist iterations): the
+# iteration number and the residual in exponential notation, and
+# nothing else.  Other lines (headers) are skipped.
+RESIDUAL_LINE = re.compile(r'^\s*(\d+)\s+([-+]?\d*\.\d+[EeDd][-+]?\d+)\s*$')
+
+REPORT_NAME = 'watchdog_failure.json'
+
+# Bytes per unit of ru_maxrss (kilobytes on Linux, bytes on macOS).
+MAXRSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+def new_lines(log, final=False):
+  # Complete lines appended to log['file'] since the last call (a
+  # trailing partial line is kept for the next call unless final).
+  # Logs left over from an earlier run are ignored until rewritten.
+  if not os.path.exists(log['file']) or os.path.getmtime(log['file']) < log['since']:
+    return []
+  if os.path.getsize(log['file']) < log['offset']:
+    log['offset'], log['partial'] = 0, ''
+  with open(log['file'], errors='replace') as f:
+    f.seek(log['offset'])
+    text = f.read()
+    log['offset'] = f.tell()
+  lines = (log['partial'] + text).split('\n')
+  log['partial'] = '' if final else lines.pop()
+  return lines
+
+def stop(proc, grace=10.0):
+  # Stop the process group of proc (mpiexec and its ranks).
+  for sig in (signal.SIGTERM, signal.SIGKILL):
+    try:
+      os.killpg(proc.pid, sig)
+    except ProcessLookupError:
+      return
+    try:
+      proc.wait(timeout=grace)
+      return
+    except subprocess.TimeoutExpired:
+      continue
+
+def wait(proc, timeout):
+  # proc.wait(timeout) that reaps proc with wait4, returning (exit code,
+  # resource usage of proc and its waited-for descendants), or (None,
+  # None) if it is still running.
+  deadline = time.time() + timeout
+  while True:
+    pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+    if pid:
+      proc.returncode = os.waitstatus_to_exitcode(status)
+      return proc.returncode, rusage
+    if time.time() >= deadline:
+      return None, None
+    time.sleep(min(0.1, timeout))
+
+def run_watched(command, label, logs, fatal=(), cwd=None, report=None,
+                time_limit=None, max_iterations=None,
+                stall_iterations=None, stall_factor=0.9, poll=2.0, usage=None, env=None):
+  # Run command, aborting on the conditions above.  Returns (error code,
+  # failure dict or None).  The CG residuals are only read from the
+  # POT3D_HISTORY log.  If usage is a dict, usage['memory'] is set to
+  # the peak memory (bytes) of the largest process of the run (e.g. one
+  # MPI rank).  env is the environment of the command (default: ours).
+  cwd = cwd or os.getcwd()
+  tstart = time.time()
+  followed = [{'file': os.path.join(cwd, log), 'offset': 0, 'partial': '', 'since': tstart - 1}
+              for log in logs]
+  fatal = [re.compile(pattern) for pattern in fatal]
+  history = []
+  failure = None
+
+  def check(lines, log):
+    for line in lines:
+      for pattern in fatal:
+        if pattern.search(line):
+          return {'reason': 'fatal_pattern', 'detail': line.strip(), 'log': log}
+      match = RESIDUAL_LINE.match(line) if log == POT3D_HISTORY else None
+      if match:
+        history.append((int(match.group(1)), float(match.group(2).replace('D', 'E').replace('d', 'e'))))
+    if not history:
+      return None
+    iterations, residual = history[-1]
+    if max_iterations and iterations > max_iterations:
+      return {'reason': 'iteration_limit', 'detail': f'{iterations} CG iterations (limit {max_iterations})'}
+    if stall_iterations and iterations - history[0][0] >= stall_iterations:
+      before = min(r for i, r in history if i <= iterations - stall_iterations)
+      recent = min(r for i, r in history if i > iterations - stall_iterations)
+      if recent > stall_factor*before:
+        return {'reason': 'stalled', 'detail': f'residual {recent:.3e} after {iterations} iterations '
+                f'(was {before:.3e} {stall_iterations} iterations earlier)'}
+    return None
+
+  proc = subprocess.Popen(['bash', '-c', command], cwd=cwd, env=env, start_new_session=True)
+  while True:
+    ierr, rusage = wait(proc, poll)
+    if rusage is not None and usage is not None:
+      usage['memory'] = rusage.ru_maxrss*MAXRSS_UNIT
+    for log in followed:
+      failure = failure or check(new_lines(log, final=ierr is not None), os.path.basename(log['file']))
+    if failure is None and ierr is None and time_limit and time.time() - tstart > time_limit:
+      failure = {'reason': 'time_limit', 'detail': f'still running after {time_limit:.0f} s'}
+    if failure is not None or ierr is not None:
+      break
+
+  if failure is not None and proc.poll() is None:
+    print(f'=> [watchdog] Aborting {label}: {failure["detail"]}')
+    stop(proc)
+  ierr = proc.wait()
+  if failure is None and ierr:
+    failure = {'reason': 'exit_code', 'detail': f'exited with error code {ierr}'}
+  if failure is None:
+    return 0, None
+
+  failure.update({'label': label, 'command': command, 'cwd': cwd, 'exit_code': ierr,
+                  'elapsed': round(time.time() - tstart, 1),
+                  'iterations': history[-1][0] if history else None,
+                  'residual': history[-1][1] if history else None})
+  print(f'=> [watchdog] {label} failed ({failure["reason"]}): {failure["detail"]}')
+  if report:
+    with open(report, 'w') as f:
+      json.dump(failure, f, indent=1)
+  return (ierr if ierr > 0 else 1), failure
+
+def load_reports(directory, since=0.0):
+  # Failure reports written under directory after time since.
+  reports = []
+  for root, _, files in os.walk(directory):
+    if REPORT_NAME in files:
+      file = os.path.join(root, REPORT_NAME)
+      if os.path.getmtime(file) >= since:
+        with open(file) as f:
+          reports.append(json.load(f))
+  return reports
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+import platform
+import argparse
+import numpy as np
+#
+import psi_io as ps
+
+########################################################################
+#  SWIG_PLANNER: Predict SWiG run time/memory and choose -np
+########################################################################
+#        Predictive Science Inc.
+#        www.predsci.com
+#        San Diego, California, USA 92121
+########################################################################
+# Copyright 2024 Predictive Science Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+########################################################################
+#
+# Every stage run appends its size (grid cells for POT3D, map points
+# otherwise), MPI ranks, elapsed time, and peak memory to a timing
+# history (~/.swig/timings.jsonl, or $SWIG_TIMINGS).  The memory of a
+# POT3D run is the peak of its largest rank (measured by the watchdog)
+# times the ranks; it is not recorded for the other stages.  For each stage a
+# log-linear cost model
+#   log(time)   = a + b*log(cells) + c*log(ranks)
+#   log(memory) = d + e*log(cells)
+# is fitted to the history (of this host, if it has enough records).
+# Exponents that the history cannot determine (e.g. all runs used the
+# same -np) are fixed at typical values and only the constant is fitted.
+# The model predicts the time and memory of a map before it is run, and
+# is used to recommend -np (and how many maps to run at once) to meet a
+# deadline or to maximize throughput on this machine.
+#
+########################################################################
+
+# Grid of the POT3D runs: nr is set from np (phi points) by these ratios.
+POT3D_NR_DIVISOR = {'pfss': 6.67, 'cs': 3.6}
+
+POT3D_STAGES = ['pfss', 'cs']
+
+# Exponents used when the history cannot determine them:
+# (cells, ranks) for time, cells for memory.
+DEFAULT_EXPONENTS = {
+  'pfss': (4/3, -0.9, 1.0),
+  'cs':   (4/3, -0.9, 1.0),
+}
+DEFAULT_EXPONENTS_OTHER = (1.0, 0.0, 1.0)
+
+def argParsing():
+  parser = argparse.ArgumentParser(description='Predict the run time and memory of SWiG for an input map and recommend -np.')
+
+  parser.add_argument('input_map',
+    help='Input Br full-Sun magnetogram (h5).',
+    type=str)
+
+  parser.add_argument('-cores',
+    help='Cores available (default: all cores of this machine).',
+    dest='cores',
+    type=int,
+    default=os.cpu_count() or 1,
+    required=False)
+
+  parser.add_argument('-memory',
+    help='Memory available in GB (default: physical memory of this machine).',
+    dest='memory',
+    type=float,
+    required=False)
+
+  parser.add_argument('-deadline',
+    help='Wallclock deadline in seconds for one map.  The smallest -np that meets it is recommended (otherwise the -np with the best throughput).',
+    dest='deadline',
+    type=float,
+    required=False)
+
+  parser.add_argument('-history',
+    help='Timing history file (default: $SWIG_TIMINGS or ~/.swig/timings.jsonl).',
+    dest='history',
+    type=str,
+    required=False)
+
+  return parser.parse_args()
+
+def history_path():
+  return os.environ.get('SWIG_TIMINGS', os.path.expanduser('~/.swig/timings.jsonl'))
+
+def pot3d_grid(stage, ntt, npp):
+  return int(np.ceil(npp/POT3D_NR_DIVISOR[stage])), ntt, npp
+
+def record_timing(stage, cells, ranks, elapsed, memory=None, file=None):
+  # Append one stage run to the timing history.  memory is the total
+  # peak memory in bytes of the run (e.g. the peak of one rank times
+  # ranks), or None if it was not measured.
+  record = {'stage': stage, 'cells': int(cells), 'ranks': int(ranks),
+            'elapsed': float(elapsed),
+            'memory': float(memory) if memory is not None else None,
+            'host': platform.node(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+  file = file or history_path()
+  try:
+    os.makedirs(os.path.dirname(os.path.abspath(file)), exist_ok=True)
+    with open(file, 'a') as f:
+      f.write(json.dumps(record)+'\n')
+  except OSError as e:
+    print('=> WARNING: could not record timing in '+file+': '+str(e))
+
+def load_history(file=None):
+  file = file or history_path()
+  if not os.path.exists(file):
+    return []
+  records = []
+  with open(file) as f:
+    for line in f:
+      try:
+        records.append(json.loads(line))
+      except ValueError:
+        continue
+  return records
+
+def fit_stage(records, stage):
+  # Fit the cost model of stage.  Returns None without history.
+  host = platform.node()
+  rows = [r for r in records if r['stage'] == stage and r['elapsed'] > 0]
+  local = [r for r in rows if r.get('host') == host]
+  rows = local if len(local) >= 3 else rows
+  if not rows:
+    return None
+  b, c, e = DEFAULT_EXPONENTS.get(stage, DEFAULT_EXPONENTS_OTHER)
+  logn = np.log([r['cells'] for r in rows])
+  logr = np.log([r['ranks'] for r in rows])
+  logt = np.log([r['elapsed'] for r in rows])
+  # Only the runs with a measured memory are used for the memory model.
+  measured = [r for r in rows if r.get('memory')]
+  logm = np.log([r['memory'] for r in measured])
+  logn_m = np.log([r['cells'] for r in measured])
+
+  # Fit only the exponents that vary in the history.
+  fit_n = np.ptp(logn) > 0.1
+  fit_r = np.ptp(logr) > 0.1
+  cols = [np.ones_like(logn)] + ([logn] if fit_n else []) + ([logr] if fit_r else [])
+  fixed = (0 if fit_n else b*logn) + (0 if fit_r else c*logr)
+  if len(rows) >= len(cols):
+    coef = np.linalg.lstsq(np.column_stack(cols), logt - fixed, rcond=None)[0]
+  else:
+    coef = [np.mean(logt - b*logn - c*logr)]
+    fit_n = fit_r = False
+  a = coef[0]
+  if fit_n:
+    b = coef[1]
+  if fit_r:
+    c = coef[-1]
+
+  if not measured:
+    d = None
+  elif len(measured) >= 2 and np.ptp(logn_m) > 0.1:
+    e, d = np.polyfit(logn_m, logm, 1)
+  else:
+    d = np.mean(logm - e*logn_m)
+  return {'a': a, 'b': b, 'c': c, 'd': d, 'e': e, 'samples': len(rows)}
+
+def predict_stage(model, cells, ranks):
+  # Predicted (seconds, bytes) of one stage run.
+  time_s = np.exp(model['a'] + model['b']*np.log(cells) + model['c']*np.log(ranks))
+  memory = np.exp(model['d'] + model['e']*np.log(cells)) if model['d'] is not None else 0.0
+  return float(time_s), float(memory)
+
+def map_sizes(input_map):
+  # Size of each stage for a map: grid cells for the POT3D runs and the
+  # number of map points for the other stages.
+  # The map may be in pt or tp layout (as in run_pfss).
+  xvec, yvec = ps.rdhdf_scales(input_map)[:2]
+  tvec, pvec = (yvec, xvec) if np.max(xvec) > 3.5 else (xvec, yvec)
+  ntt, npp = len(tvec) + 1, len(pvec) + 1
+  sizes = {stage: int(np.prod(pot3d_grid(stage, ntt, npp))) for stage in POT3D_STAGES}
+  sizes['other'] = len(tvec)*len(pvec)
+  return sizes
+
+def predict_map(models, sizes, ranks):
+  # Predicted time of one map (the POT3D runs on ranks, the others in
+  # series) and its peak memory.  Stages without history are skipped.
+  total, peak = 0.0, 0.0
+  for stage, model in models.items():
+    if model is None:
+      continue
+    cells = sizes.get(stage, sizes['other'])
+    time_s, memory = predict_stage(model, cells, ranks if stage in POT3D_STAGES else 1)
+    total += time_s
+    peak = max(peak, memory)
+  return total, peak
+
+def candidate_ranks(cores):
+  ranks = sorted({1, cores} | {2**k for k in range(1, 16) if 2**k < cores})
+  return ranks
+
+def plan(input_map, cores=None, memory=None, deadline=None, history=None):
+  # Table of predictions per -np and the recommended -np.
+  cores = cores or os.cpu_count() or 1
+  if memory is None:
+    memory = os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES')/1e9
+  records = load_history(history)
+  models = {stage: fit_stage(records, stage) for stage in sorted({r['stage'] for r in records})}
+  if not any(models.get(stage) for stage in POT3D_STAGES):
+    return {'rows': [], 'np': None, 'concurrency': None, 'models': models}
+  sizes = map_sizes(input_map)
+  rows = []
+  for ranks in candidate_ranks(cores):
+    time_s, peak = predict_map(models, sizes, ranks)
+    concurrency = max(1, min(cores//ranks, int(memory*1e9//max(peak, 1.0))))
+    rows.append({'np': ranks, 'time': time_s, 'memory': peak, 'concurrency': concurrency,
+                 'throughput': 3600*concurrency/time_s, 'fits': peak <= memory*1e9})
+  feasible = [row for row in rows if row['fits']] or rows
+  meeting = [row for row in feasible if deadline is not None and row['time'] <= deadline]
+  if meeting:
+    best = min(meeting, key=lambda row: row['np'])
+  elif deadline is not None:
+    best = min(feasible, key=lambda row: row['time'])
+  else:
+    best = max(feasible, key=lambda row: (round(row['throughput'], 6), -row['time']))
+  return {'rows': rows, 'np': best['np'], 'concurrency': best['concurrency'], 'models': models,
+          'time': best['time'], 'memory': best['memory']}
+
+def recommend_np(input_map, cores=None, deadline=None):
+  # -np to use for input_map (1 if there is no timing history yet).
+  return plan(input_map, cores=cores, deadline=deadline)['np'] or 1
+
+def main():
+  args = argParsing()
+  result = plan(args.input_map, args.cores, args.memory, args.deadline, args.history)
+  if not result['rows']:
+    print('=> No POT3D timing history yet ('+(args.history or history_path())+').')
+    print('   Run SWiG on a few maps (preferably with different -np) first.')
+    return
+  for stage, model in result['models'].items():
+    if model is not None:
+      print(f"=> {stage:10s} time ~ cells^{model['b']:.2f} * np^{model['c']:.2f}  ({model['samples']} runs)")
+  print(' ')
+  print('      np    time [s]   memory [GB]   maps at once   maps/hour')
+  for row in result['rows']:
+    print(f"  {row['np']:6d}  {row['time']:10.1f}  {row['memory']/1e9:12.2f}  {row['concurrency']:13d}  {row['throughput']:10.1f}"
+          + ('' if row['fits'] else '   (exceeds memory)'))
+  print(' ')
+  goal = f'deadline of {args.deadline:.0f} s' if args.deadline is not None else 'throughput'
+  print(f"=> Recommended for {goal}: -np {result['np']} "
+        f"(predicted {result['time']:.1f} s, {result['memory']/1e9:.2f} GB), "
+        f"{result['concurrency']} map(s) at once on {args.cores} cores")
+  if args.deadline is not None and result['time'] > args.deadline:
+    print('   (no -np is predicted to meet the deadline, this is the fastest)')
+
+if __name__ == '__main__':
+  main()
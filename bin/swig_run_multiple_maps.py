@@ -5,9 +5,12 @@ import argparse
 import subprocess
 from pathlib import Path
 import re
+import time
 import h5py as h5
 import numpy as np
 import psi_io as ps
+import solver_watchdog as watchdog
+import solver_logs
 import shutil
 
 # INPUT:  - Map directory (use Path from pathlib to get full path)
@@ -34,10 +37,55 @@ def argParsing():
     type=str)
 
   parser.add_argument('-np',
-    help='Number of MPI processes (ranks)',
+    help='Number of MPI processes (ranks), or auto to let swig.py choose it for each map from the timing history (see swig_planner.py).',
     dest='np',
+    type=str,
+    default='1',
+    required=False)
+
+  parser.add_argument('-time_limit',
+    help='Abort any single POT3D or MAPFL run that takes longer than this many seconds (the batch then moves on to the next map).',
+    dest='time_limit',
+    type=float,
+    required=False)
+
+  parser.add_argument('-max_iterations',
+    help='Abort a POT3D run after this many CG iterations.',
+    dest='max_iterations',
     type=int,
-    default=1,
+    required=False)
+
+  parser.add_argument('-pfss_engine',
+    help='PFSS solver passed to swig.py: pot3d (default) or spectral.',
+    dest='pfss_engine',
+    type=str,
+    default='pot3d',
+    required=False)
+
+  parser.add_argument('-remesh',
+    help='Remesh each input map (flux-conserving) to this resolution NPxNT or to the grid of this h5 map, passed to swig.py.',
+    dest='remesh',
+    type=str,
+    required=False)
+
+  parser.add_argument('-ensemble',
+    help='For 3D (ensemble) input maps, passed to swig.py: full (default) or linear (solve the PFSS model of the ensemble mean once).',
+    dest='ensemble',
+    type=str,
+    default='full',
+    required=False)
+
+  parser.add_argument('-tracer',
+    help='Field line tracer passed to swig.py: mapfl (default) or python.',
+    dest='tracer',
+    type=str,
+    default='mapfl',
+    required=False)
+
+  parser.add_argument('-deadline',
+    help='With -np auto, the wallclock deadline in seconds for one map.',
+    dest='deadline',
+    type=float,
     required=False)
 
   parser.add_argument('-sw_model',
@@ -66,10 +114,10 @@ def argParsing():
     required=False)
 
   parser.add_argument('-r1',
-    help='Set outer radius (default 21.5 Rs).',
+    help='Set outer radius (default 21.5 Rs), or a comma-separated list of radii (e.g. 21.5,30) to write the products at each.',
     dest='r1',
-    type=float,
-    default=21.5,
+    type=str,
+    default='21.5',
     required=False)
     
   parser.add_argument('-r0_trace',
@@ -86,6 +134,44 @@ def argParsing():
     default=True,
     required=False)
 
+  parser.add_argument('-products',
+    help='Comma-separated list of products passed to swig.py (default: all).',
+    dest='products',
+    type=str,
+    required=False)
+
+  parser.add_argument('-preview',
+    help='Coarsening factor for a preview run passed to swig.py (see swig.py -preview).',
+    dest='preview',
+    type=int,
+    required=False)
+
+  parser.add_argument('-pipeline',
+    help='Number of realizations of a 3D map in flight at a time, passed to swig.py (see swig.py -pipeline).',
+    dest='pipeline',
+    type=int,
+    required=False)
+
+  parser.add_argument('-scratch',
+    help='Scratch location (e.g. /dev/shm or node-local disk) in which swig.py runs the solver and tracing stages.',
+    dest='scratch',
+    type=str,
+    required=False)
+
+  parser.add_argument('-retain',
+    help='Retention policy for intermediate files passed to swig.py (all or minimal).',
+    dest='retain',
+    type=str,
+    default='all',
+    required=False)
+
+  parser.add_argument('-resume',
+    help='Resume an interrupted batch, skipping maps and realizations whose results are already complete.',
+    dest='resume',
+    action='store_true',
+    default=False,
+    required=False)
+
   return parser.parse_args()
 
 def run(args):
@@ -105,12 +191,20 @@ def run(args):
 
   args.swig_path = Path(args.swig_path or f"{sys.path[0]}/../swig.py").resolve()
 
+  metrics = []
   for h5_file in h5_files:
     if is_3D_hdf(h5_file):
       rvec = extract_realization(h5_file)
-      process_file(args, h5_file, rvec)
+      metrics += process_file(args, h5_file, rvec)
     else:
-      process_file(args, h5_file, None)
+      metrics += process_file(args, h5_file, None)
+
+  # Summary of the solver metrics of all maps, with the outliers flagged.
+  if metrics:
+    print(' ')
+    print('=> Solver metrics of all maps:')
+    solver_logs.summarize(metrics, csv=args.outdir / 'solver_metrics_summary.csv')
+    print(f"=> Summary table written to {args.outdir / 'solver_metrics_summary.csv'}")
 
 
 def process_file(args, h5_file, rvec):
@@ -119,21 +213,69 @@ def process_file(args, h5_file, rvec):
 
   print(f"=> Running map: {h5_file.name}")
 
-  r0_trace_str = f"-r0_trace {arg.r0_trace}"
+  r0_trace_str = f"-r0_trace {args.r0_trace}"
   
   command = (
     f"{args.swig_path} {h5_file} -rundir {args.outdir} -oidx {idx} "
-    f"-np {args.np} -sw_model {args.sw_model} {r0_trace_str}"
-    f"-sw_model_params {args.sw_model_params} -rss {args.rss} -r1 {args.r1} ")
+    f"-np {args.np} -sw_model {args.sw_model} {r0_trace_str} "
+    f"-sw_model_params '{args.sw_model_params}' -rss {args.rss} -r1 {args.r1} ")
 
   if not args.plot_results:
     command += "-noplot "
 
+  if args.deadline:
+    command += f"-deadline {args.deadline} "
+
+  if args.pfss_engine != 'pot3d':
+    command += f"-pfss_engine {args.pfss_engine} "
+
+  if args.remesh:
+    command += f"-remesh {args.remesh} "
+
+  if args.ensemble != 'full':
+    command += f"-ensemble {args.ensemble} "
+
+  if args.tracer != 'mapfl':
+    command += f"-tracer {args.tracer} "
+
+  if args.time_limit:
+    command += f"-time_limit {args.time_limit} "
+
+  if args.max_iterations:
+    command += f"-max_iterations {args.max_iterations} "
+
+  if args.products:
+    command += f"-products {args.products} "
+
+  if args.preview:
+    command += f"-preview {args.preview} "
+
+  if args.pipeline:
+    command += f"-pipeline {args.pipeline} "
+
+  if args.scratch:
+    command += f"-scratch {args.scratch} "
+
+  command += f"-retain {args.retain} "
+
+  if args.resume:
+    command += "-resume "
+
+  tstart = time.time()
   ierr = subprocess.run(["bash", "-c", command])
   check_error_code_non_crash(ierr.returncode, f"Failed: {command}")
+  if ierr.returncode:
+    for failure in watchdog.load_reports(args.outdir, since=tstart):
+      print(f"=> {h5_file.name}: {failure['label']} aborted ({failure['reason']}): {failure['detail']}")
+
+  # Solver metrics of the map (and its realizations), written by swig.py
+  # before the pfss and cs directories are cleared.
+  metrics = [solver_logs.load_metrics(file) for file in sorted(args.outdir.glob(f"**/results/solver_metrics_idx{idx}.json"))
+             if 'preview' not in file.parts and file.stat().st_mtime >= tstart]
 
   print("=> Clearing pfss and cs directories")
   remove_files(args.outdir, rvec)
+  return metrics
 
 
 def remove_files(output_dir, rvec):
@@ -154,7 +296,7 @@ def clear_directory(directory):
 
 
 def extract_realization(file):
-  _, _, rvec, _ = ps.rdhdf_3d(file)
+  _, _, rvec = ps.rdhdf_scales(file)
   return np.array(rvec)
 
 
@@ -195,3 +337,20 @@ if __name__ == '__main__':
 #       - Removed -gpu option as POT3D auto-detects this now.
 # ### Version 2.0.0, 09/18/2025, modified by RC:
 #      - Added new swig options.
+# ### Version 2.1.0, 10/19/2026:
+#      - Added -resume to skip maps/realizations that already completed.
+#      - Added -scratch, -retain, -products, -preview, and -pipeline
+#        pass-through options.
+#      - Realization numbers are read without loading the 3D map.
+#      - Fixed passing of -r0_trace and -sw_model_params to swig.py.
+#      - Added -np auto and -deadline pass-through options.
+#      - Added -time_limit and -max_iterations pass-through options, and
+#        the reason a solver/tracer run was aborted is reported before
+#        moving on to the next map.
+#      - The solver metrics of all maps are summarized in a table (also
+#        written to solver_metrics_summary.csv) with outliers flagged.
+#      - Added -pfss_engine pass-through option.
+#      - Added -ensemble pass-through option.
+#      - -r1 accepts a comma-separated list of radii.
+#      - Added -remesh pass-through option.
+#      - Added -tracer pass-through option.
@@ -0,0 +1,192 @@
+import os
+import time
+import signal
+import asyncio
+import traceback
+
+########################################################################
+#  SWIG_SCHEDULER: Run SWiG stages as a dependency graph
+########################################################################
+#        Predictive Science Inc.
+#        www.predsci.com
+#        San Diego, California, USA 92121
+########################################################################
+# Copyright 2024 Predictive Science Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+########################################################################
+#
+# A job is a dict with the keys:
+#   name:    unique job name.
+#   command: shell command to run (run with bash in cwd), or
+#   func:    a Python callable to run in a worker thread instead.
+#   cwd:     directory to run the command in.
+#   cores:   number of cores the job occupies (e.g. -np for POT3D).
+#   after:   names of the jobs that must finish first.
+#   weight:  (optional) relative cost, used to run the jobs on the
+#            critical path first.
+#   group:   (optional) jobs of lower groups are started first (e.g. the
+#            realizations of an ensemble, in order).
+#   resource: (optional) class of resource the job uses (see slots).
+#
+# Jobs whose dependencies are done are started as long as the cores in
+# use stay within the budget (a job larger than the whole budget still
+# runs, alone) and, if slots are given, as long as fewer than
+# slots[resource] jobs of the same resource class are running.  If a
+# job fails (a func job that raises fails with its traceback printed),
+# no new jobs are started, the running commands are terminated (their
+# whole process group, e.g. mpirun and its ranks), and the failed job
+# names are returned.  The running commands are also terminated if the
+# scheduler is interrupted (e.g. by Ctrl-C).  A func job cannot be
+# stopped: its thread is left to finish and its result is dropped.
+#
+# feed is an optional iterator of further batches of jobs (e.g. one per
+# realization of an ensemble, with dependencies within the batch only).
+# A batch is only taken from it (and so built) while fewer than window
+# of the batches taken so far have unfinished jobs.
+#
+########################################################################
+
+def critical_path(jobs):
+  # Length (in summed weights) of the longest chain starting at each job.
+  by_name = {job['name']: job for job in jobs}
+  users = {name: [] for name in by_name}
+  for job in jobs:
+    for dep in job['after']:
+      users[dep].append(job['name'])
+  length = {}
+  def visit(name):
+    if name not in length:
+      length[name] = by_name[name].get('weight', 1) + max([visit(u) for u in users[name]], default=0)
+    return length[name]
+  for name in by_name:
+    visit(name)
+  return length
+
+async def _terminate(proc, grace=10):
+  # Terminate the process group of a command, killing it after grace
+  # seconds if it has not exited.
+  for sig in (signal.SIGTERM, signal.SIGKILL):
+    try:
+      os.killpg(proc.pid, sig)
+    except ProcessLookupError:
+      break
+    try:
+      await asyncio.wait_for(proc.wait(), grace)
+      break
+    except asyncio.TimeoutError:
+      pass
+  return await proc.wait()
+
+async def _run_job(job):
+  if 'func' in job:
+    try:
+      await asyncio.to_thread(job['func'])
+      return 0
+    except SystemExit as e:
+      return e.code if isinstance(e.code, int) and e.code > 0 else 1
+    except Exception:
+      traceback.print_exc()
+      return 1
+  print('   Command:  '+job['command'])
+  # The command runs in its own process group so that it can be
+  # terminated as a whole.
+  proc = await asyncio.create_subprocess_exec('bash', '-c', job['command'], cwd=job.get('cwd'), start_new_session=True)
+  try:
+    return await proc.wait()
+  except asyncio.CancelledError:
+    await asyncio.shield(_terminate(proc))
+    raise
+
+async def _cancel(running):
+  # Cancel the running jobs and wait for their commands to be terminated.
+  for task in running:
+    task.cancel()
+  await asyncio.gather(*running, return_exceptions=True)
+  for job in running.values():
+    print(f"=> [scheduler] Cancelled {job['name']} after {time.time() - job['start']:.1f} s")
+  running.clear()
+
+async def _run_graph(jobs, cores, slots, feed=None, window=1):
+  priority = {}
+  waiting = []
+  batches = []
+  def add(batch):
+    # Dependencies on jobs outside of the batch are dropped.
+    names = {job['name'] for job in batch}
+    for job in batch:
+      job['after'] = [dep for dep in job.get('after', []) if dep in names]
+    priority.update(critical_path(batch))
+    waiting.extend(batch)
+    waiting.sort(key=lambda job: (job.get('group', 0), -priority[job['name']]))
+  add(jobs)
+  done = set()
+  failed = []
+  running = {}
+  in_use = 0
+  busy = {}
+  while waiting or running or feed is not None:
+    # Take batches from feed while fewer than window are unfinished.
+    while feed is not None and not failed and sum(1 for batch in batches if batch) < window:
+      batch = next(feed, None)
+      if batch is None:
+        feed = None
+        break
+      batches.append({job['name'] for job in batch})
+      add(batch)
+    if failed:
+      feed = None
+    if not failed:
+      for job in list(waiting):
+        if not set(job['after']).issubset(done):
+          continue
+        need = job.get('cores', 1)
+        if running and in_use + need > cores:
+          continue
+        resource = job.get('resource')
+        if resource in slots and busy.get(resource, 0) >= slots[resource]:
+          continue
+        waiting.remove(job)
+        in_use += need
+        busy[resource] = busy.get(resource, 0) + 1
+        print(f"=> [scheduler] Starting {job['name']} ({need} core(s), {in_use}/{cores} in use)")
+        job['start'] = time.time()
+        running[asyncio.ensure_future(_run_job(job))] = job
+    if not running:
+      break
+    try:
+      finished, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+      await _cancel(running)
+      raise
+    for task in finished:
+      job = running.pop(task)
+      in_use -= job.get('cores', 1)
+      busy[job.get('resource')] -= 1
+      ierr = task.result()
+      elapsed = time.time() - job['start']
+      if ierr:
+        print(f"=> [scheduler] FAILED {job['name']} (error code {ierr}) after {elapsed:.1f} s")
+        failed.append(job['name'])
+      else:
+        print(f"=> [scheduler] Finished {job['name']} in {elapsed:.1f} s")
+        done.add(job['name'])
+      for batch in batches:
+        batch.discard(job['name'])
+    if failed and running:
+      await _cancel(running)
+  return failed
+
+def run_jobs(jobs, cores, slots=None, feed=None, window=1):
+  return asyncio.run(_run_graph(list(jobs), max(cores, 1), slots or {}, feed, window))
@@ -0,0 +1,307 @@
+import os
+import json
+import time
+import fcntl
+import hashlib
+from pathlib import Path
+
+########################################################################
+#  SWIG_STAGES: Stage table and stage-completion manifest for SWiG runs
+########################################################################
+#        Predictive Science Inc.
+#        www.predsci.com
+#        San Diego, California, USA 92121
+########################################################################
+# Copyright 2024 Predictive Science Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+########################################################################
+#
+# Each stage of a SWiG run lists the files (relative to the run
+# directory) it reads and writes.  When a stage finishes, its inputs
+# and outputs are checksummed into the run manifest so that a rerun
+# with -resume can skip stages whose outputs are still present and
+# unchanged and whose inputs have not changed since.
+#
+# The inputs and outputs also define the dependency graph used by
+# swig_scheduler.py to run independent stages concurrently.  Each stage
+# has a rough relative cost (weight) used to start the stages on the
+# critical path first, and the class of resource it mostly uses (MPI
+# solver, field line tracer, or single-core Python).
+#
+# Outputs listed as optional are only written when a requested product
+# (see PRODUCTS) needs them, so that a lean run (swig.py -products) does
+# not trace field lines or compute Q maps that nobody uses.
+#
+########################################################################
+
+STAGES = {
+  'pfss': {
+    'inputs':  [],
+    'outputs': ['pfss/br_input_tp.h5', 'pfss/br_pfss.h5', 'pfss/bt_pfss.h5',
+                'pfss/bp_pfss.h5', 'pfss/br_r0_pfss.h5', 'pfss/br_rss.h5'],
+    'optional': ['pfss/br_r0_pfss.h5'],
+    'weight':  4,
+    'resource': 'mpi',
+  },
+  'cs': {
+    'inputs':  ['pfss/br_input_tp.h5', 'pfss/br_rss.h5'],
+    'outputs': ['cs/br_cs.h5', 'cs/bt_cs.h5', 'cs/bp_cs.h5',
+                'cs/br_rss_pm_cs.h5', 'cs/br_r1_cs.h5'],
+    'weight':  8,
+    'resource': 'mpi',
+  },
+  'pfss_trace': {
+    'inputs':  ['pfss/br_input_tp.h5', 'pfss/br_pfss.h5', 'pfss/bt_pfss.h5',
+                'pfss/bp_pfss.h5'],
+    'outputs': ['pfss/rss_r0_t.h5', 'pfss/rss_r0_p.h5', 'pfss/expfac_rss_r0.h5',
+                'pfss/ofm_r0.h5', 'pfss/slogq_r0.h5', 'pfss/slogq_rss.h5'],
+    'optional': ['pfss/rss_r0_t.h5', 'pfss/rss_r0_p.h5', 'pfss/expfac_rss_r0.h5',
+                 'pfss/slogq_r0.h5', 'pfss/slogq_rss.h5'],
+    'weight':  2,
+    'resource': 'tracer',
+  },
+  'cs_trace': {
+    'inputs':  ['pfss/br_input_tp.h5', 'cs/br_cs.h5', 'cs/bt_cs.h5',
+                'cs/bp_cs.h5'],
+    'outputs': ['cs/r1_rss_t.h5', 'cs/r1_rss_p.h5'],
+    'weight':  2,
+    'resource': 'tracer',
+  },
+  'expfac': {
+    'inputs':  ['cs/r1_rss_t.h5', 'cs/r1_rss_p.h5', 'pfss/expfac_rss_r0.h5'],
+    'outputs': ['expfac_rss_at_r1.h5'],
+    'weight':  1,
+    'resource': 'python',
+  },
+  'dchb': {
+    'inputs':  ['cs/r1_rss_t.h5', 'cs/r1_rss_p.h5', 'pfss/rss_r0_t.h5',
+                'pfss/rss_r0_p.h5', 'pfss/ofm_r0.h5'],
+    'outputs': ['pfss/dchb_rss.h5', 'dchb_at_r1.h5'],
+    'weight':  2,
+    'resource': 'python',
+  },
+  'br_r1': {
+    'inputs':  ['cs/r1_rss_t.h5', 'cs/r1_rss_p.h5', 'cs/br_r1_cs.h5',
+                'cs/br_rss_pm_cs.h5'],
+    'outputs': ['br_r1.h5'],
+    'weight':  1,
+    'resource': 'python',
+  },
+  'eswim': {
+    'inputs':  ['dchb_at_r1.h5', 'expfac_rss_at_r1.h5'],
+    'outputs': ['vr_r1.h5', 'rho_r1.h5', 't_r1.h5'],
+    'weight':  1,
+    'resource': 'python',
+  },
+  # Collection of the final products by swig.py (outputs depend on -oidx).
+  'results': {
+    'inputs':  ['br_r1.h5', 'vr_r1.h5', 't_r1.h5', 'rho_r1.h5', 'pfss/ofm_r0.h5',
+                'pfss/slogq_r0.h5', 'pfss/br_r0_pfss.h5', 'pfss/slogq_rss.h5'],
+    'outputs': [],
+    'weight':  1,
+    'resource': 'python',
+  },
+}
+
+# Final products that can be requested, and the file each comes from.
+PRODUCTS = {
+  'br':        'br_r1.h5',
+  'vr':        'vr_r1.h5',
+  'rho':       'rho_r1.h5',
+  't':         't_r1.h5',
+  'br_r0':     'pfss/br_r0_pfss.h5',
+  'ofm_r0':    'pfss/ofm_r0.h5',
+  'slogq_r0':  'pfss/slogq_r0.h5',
+  'slogq_rss': 'pfss/slogq_rss.h5',
+}
+
+# Stages repeated at each additional r1 radius (swig.py -r1 r1,r2,...),
+# from the PFSS and CS solutions of the largest.
+R1_STAGES = ['cs_trace', 'expfac', 'dchb', 'br_r1', 'eswim']
+
+# Concurrent jobs per resource class when realizations are pipelined.
+RESOURCE_SLOTS = {'mpi': 1, 'tracer': 1, 'python': 1}
+
+RETAIN_POLICIES = ['all', 'minimal']
+
+MANIFEST_NAME = 'swig_manifest.json'
+
+def parse_products(products):
+  # Comma-separated product list -> list of product names (None if invalid).
+  names = [p.strip() for p in products.split(',') if p.strip()]
+  if not names or any(p not in PRODUCTS for p in names):
+    return None
+  return names
+
+def required_files(products):
+  # The product files and (recursively) every file needed to make them.
+  files = set(PRODUCTS[p] for p in products)
+  pending = list(files)
+  while pending:
+    f = pending.pop()
+    for io in STAGES.values():
+      if f in io['outputs']:
+        for g in io['inputs']:
+          if g not in files:
+            files.add(g)
+            pending.append(g)
+  return files
+
+def required_stages(products):
+  files = required_files(products)
+  return [stage for stage, io in STAGES.items() if files & set(io['outputs'])]
+
+def stage_outputs(stage, products=None):
+  # Outputs written by stage when only products are requested.
+  io = STAGES[stage]
+  if products is None:
+    return io['outputs']
+  files = required_files(products)
+  return [f for f in io['outputs'] if f not in io.get('optional', []) or f in files]
+
+def r1_inputs():
+  # Files the R1_STAGES read from the other stages.
+  made = set(f for stage in R1_STAGES for f in STAGES[stage]['outputs'])
+  return sorted(set(f for stage in R1_STAGES for f in STAGES[stage]['inputs']) - made)
+
+# Intermediate files are the stage outputs that another stage reads.
+def consumers(file):
+  return [stage for stage, io in STAGES.items() if file in io['inputs']]
+
+def dependencies(stage):
+  # Stages that write the inputs of stage.
+  inputs = set(STAGES[stage]['inputs'])
+  return [other for other, io in STAGES.items() if inputs & set(io['outputs'])]
+
+def downstream(stage):
+  # All stages that (directly or indirectly) read the outputs of stage.
+  found = set()
+  pending = [stage]
+  while pending:
+    for f in STAGES.get(pending.pop(), {'outputs': []})['outputs']:
+      for user in consumers(f):
+        if user not in found:
+          found.add(user)
+          pending.append(user)
+  return found
+
+# Checksums of files that have not changed since they were last hashed
+# (keyed on path, size, and modification time).
+_checksum_cache = {}
+
+def file_checksum(path):
+  path = Path(path).resolve()
+  st = path.stat()
+  key = (str(path), st.st_size, st.st_mtime_ns)
+  if key not in _checksum_cache:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+      for chunk in iter(lambda: f.read(1 << 20), b''):
+        h.update(chunk)
+    _checksum_cache[key] = h.hexdigest()
+  return _checksum_cache[key]
+
+def manifest_path(rundir):
+  return Path(rundir).resolve() / MANIFEST_NAME
+
+def load_manifest(rundir):
+  path = manifest_path(rundir)
+  if not path.exists():
+    return {'stages': {}, 'released': []}
+  with open(path) as f:
+    return json.load(f)
+
+def update_manifest(rundir, update):
+  # Apply update(manifest) under an exclusive lock so that concurrently
+  # running stages of the same run do not lose each other's records.
+  path = manifest_path(rundir)
+  with open(str(path)+'.lock', 'w') as lock:
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    manifest = load_manifest(rundir)
+    update(manifest)
+    tmp = str(path)+'.tmp'
+    with open(tmp, 'w') as f:
+      json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+def _checksums(rundir, files):
+  return {f: file_checksum(Path(rundir) / f) for f in files}
+
+def _normalize(params):
+  # Round-trip through JSON so tuples/paths compare like stored values.
+  return json.loads(json.dumps(params or {}, sort_keys=True, default=str))
+
+def record_stage(rundir, stage, params=None, inputs=None, outputs=None, elapsed=None):
+  inputs  = STAGES[stage]['inputs']  if inputs  is None else inputs
+  outputs = STAGES[stage]['outputs'] if outputs is None else outputs
+  entry = {
+    'params':  _normalize(params),
+    'inputs':  _checksums(rundir, inputs),
+    'outputs': _checksums(rundir, outputs),
+    'completed': time.strftime('%Y-%m-%dT%H:%M:%S'),
+  }
+  if elapsed is not None:
+    entry['elapsed'] = elapsed
+  def update(manifest):
+    # A rerun stage invalidates the records of everything downstream.
+    for user in downstream(stage):
+      manifest['stages'].pop(user, None)
+    manifest['stages'][stage] = entry
+    released = set(manifest.get('released', []))
+    manifest['released'] = sorted(released - set(outputs))
+  update_manifest(rundir, update)
+
+def stage_complete(rundir, stage, params=None, inputs=None, outputs=None):
+  manifest = load_manifest(rundir)
+  entry = manifest['stages'].get(stage)
+  if entry is None or entry['params'] != _normalize(params):
+    return False
+  inputs  = STAGES[stage]['inputs']  if inputs  is None else inputs
+  outputs = STAGES[stage]['outputs'] if outputs is None else outputs
+  if set(inputs) != set(entry['inputs']) or set(outputs) != set(entry['outputs']):
+    return False
+  released = set(manifest.get('released', []))
+  for files, recorded in ((inputs, entry['inputs']), (outputs, entry['outputs'])):
+    for f in files:
+      path = Path(rundir) / f
+      if not path.exists():
+        if f in released:
+          continue
+        return False
+      if file_checksum(path) != recorded[f]:
+        return False
+  return True
+
+def release_intermediates(rundir, done=()):
+  # Delete every intermediate file whose consumer stages have all
+  # completed (per the manifest, or listed in done), and note it in the
+  # manifest so that -resume treats the deleted file as satisfied.
+  manifest = load_manifest(rundir)
+  finished = set(manifest['stages']) | set(done)
+  released = []
+  for io in STAGES.values():
+    for f in io['outputs']:
+      users = consumers(f)
+      path = Path(rundir) / f
+      if users and finished.issuperset(users) and path.exists():
+        # Another stage may be releasing the same file concurrently.
+        path.unlink(missing_ok=True)
+        released.append(f)
+  if released:
+    print('=> Released intermediate files: '+' '.join(released))
+    def update(manifest):
+      manifest['released'] = sorted(set(manifest.get('released', [])) | set(released))
+    update_manifest(rundir, update)
+  return released
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+import sys
+import argparse
+import subprocess
+from pathlib import Path
+import numpy as np
+import psi_io as ps
+import namelist_io
+import solver_logs
+import swig_stages as stages
+
+########################################################################
+#  SWIG_TOLERANCE_STUDY: Find the loosest POT3D CG tolerance (epscg)
+#                        that keeps the SWiG products within a bound
+########################################################################
+#        Predictive Science Inc.
+#        www.predsci.com
+#        San Diego, California, USA 92121
+########################################################################
+# Copyright 2024 Predictive Science Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+########################################################################
+#
+# SWiG is run on the input map once for each epscg of the ladder (each
+# in its own run directory, so -resume can continue an interrupted
+# study).  For each run the CG iterations and time of the PFSS and CS
+# solves are reported, together with the relative L2 difference
+#   |f - f_ref| / |f_ref|
+# of the expansion factor, DCHB, Br, and Vr at r1 from those of the
+# run with the tightest tolerance.  The loosest epscg whose differences
+# are all within -bound is recommended, and with -apply it is written
+# into the rsrc/pot3d_pfss.dat and rsrc/pot3d_cs.dat templates.
+#
+########################################################################
+
+# Products compared: name -> file in the map's run directory.
+COMPARED = {
+  'expfac': 'expfac_rss_at_r1.h5',
+  'dchb':   'dchb_at_r1.h5',
+  'br_r1':  'results/br_r1*.h5',
+  'vr_r1':  'results/vr_r1*.h5',
+}
+
+def argParsing():
+  parser = argparse.ArgumentParser(description='Run SWiG over a ladder of POT3D CG tolerances (epscg) and recommend the loosest one that keeps the products within a bound.')
+
+  parser.add_argument('input_map',
+    help='Input Br full-Sun magnetogram (h5).',
+    type=str)
+
+  parser.add_argument('-epscg',
+    help='Comma-separated ladder of epscg values (default: 1e-9,1e-8,1e-7,1e-6,1e-5,1e-4).  The tightest is the reference.',
+    dest='epscg',
+    type=str,
+    default='1e-9,1e-8,1e-7,1e-6,1e-5,1e-4',
+    required=False)
+
+  parser.add_argument('-bound',
+    help='Largest allowed relative L2 difference of each product from the reference run (default 0.01).',
+    dest='bound',
+    type=float,
+    default=0.01,
+    required=False)
+
+  parser.add_argument('-outdir',
+    help='Directory of the study runs (default: <input_map>_epscg_study).',
+    dest='outdir',
+    type=str,
+    required=False)
+
+  parser.add_argument('-np',
+    help='Number of MPI processes (ranks)',
+    dest='np',
+    type=int,
+    default=1,
+    required=False)
+
+  parser.add_argument('-sw_model',
+    help='Select solar wind model.',
+    dest='sw_model',
+    type=str,
+    default='wsa2',
+    required=False)
+
+  parser.add_argument('-rss',
+    help='Set source surface radius (default 2.5 Rs).',
+    dest='rss',
+    type=float,
+    default=2.5,
+    required=False)
+
+  parser.add_argument('-r1',
+    help='Set outer radius (default 21.5 Rs).',
+    dest='r1',
+    type=float,
+    default=21.5,
+    required=False)
+
+  parser.add_argument('-apply',
+    help='Write the recommended epscg into the POT3D templates in rsrc.',
+    dest='apply',
+    action='store_true',
+    default=False,
+    required=False)
+
+  parser.add_argument('-resume',
+    help='Reuse the runs of an interrupted study.',
+    dest='resume',
+    action='store_true',
+    default=False,
+    required=False)
+
+  return parser.parse_args()
+
+def map_rundir(rundir):
+  # swig.py may put the run of a map in a realization subdirectory.
+  manifests = [p for p in Path(rundir).glob('**/'+stages.MANIFEST_NAME) if 'preview' not in p.parts]
+  return manifests[0].parent if manifests else None
+
+def read_product(rundir, pattern):
+  files = sorted(Path(rundir).glob(pattern))
+  if not files:
+    return None
+  return np.asarray(ps.rdhdf_2d(str(files[0]))[2])
+
+def relative_difference(f, f_ref):
+  if f is None or f_ref is None or f.shape != f_ref.shape:
+    return np.nan
+  return float(np.linalg.norm(f - f_ref)/max(np.linalg.norm(f_ref), 1e-300))
+
+def run_study(args, ladder):
+  swig = Path(sys.path[0]).parent / 'swig.py'
+  runs = []
+  for epscg in ladder:
+    rundir = args.outdir / f'epscg_{epscg:g}'
+    print(f'=> Running SWiG with epscg={epscg:.0e} in {rundir}')
+    command = (f"{swig} {args.input_map} -rundir {rundir} -np {args.np} -epscg {epscg} "
+               f"-sw_model {args.sw_model} -rss {args.rss} -r1 {args.r1} -noplot"
+               + (' -resume' if args.resume else ''))
+    print('   Command: '+command)
+    ierr = subprocess.run(['bash', '-c', command]).returncode
+    check_error_code_non_crash(ierr, 'Failed : '+command)
+    workdir = map_rundir(rundir)
+    run = {'epscg': epscg, 'failed': ierr > 0 or workdir is None, 'dir': workdir}
+    if not run['failed']:
+      manifest = stages.load_manifest(workdir)['stages']
+      for stage in ('pfss', 'cs'):
+        run[stage+'_iterations'] = solver_logs.pot3d_metrics(workdir / stage)['iterations']
+        run[stage+'_time'] = manifest.get(stage, {}).get('elapsed', np.nan)
+      run['products'] = {name: read_product(workdir, pattern) for name, pattern in COMPARED.items()}
+    runs.append(run)
+  return runs
+
+def recommend(runs, bound):
+  # Loosest epscg such that it and every tighter epscg keep all products
+  # within bound of the reference (the runs are from tight to loose).
+  reference = next(run for run in runs if not run['failed'])
+  best = reference
+  for run in runs:
+    if run['failed']:
+      continue
+    run['errors'] = {name: relative_difference(run['products'][name], reference['products'][name])
+                     for name in COMPARED}
+    run['ok'] = all(not np.isnan(err) and err <= bound for err in run['errors'].values())
+  for run in runs[runs.index(reference):]:
+    if run['failed'] or not run['ok']:
+      break
+    best = run
+  return best, reference
+
+def print_table(runs, bound):
+  def fmt(value, spec):
+    return format(value, spec) if value is not None and not np.isnan(value) else '-'
+  header = f"{'epscg':>8s} {'PFSS it':>9s} {'PFSS s':>8s} {'CS it':>9s} {'CS s':>8s}" + \
+           ''.join(f' {name:>9s}' for name in COMPARED)
+  print(header)
+  for run in runs:
+    if run['failed']:
+      print(f"{run['epscg']:8.0e}   (failed)")
+      continue
+    line = (f"{run['epscg']:8.0e} {fmt(run['pfss_iterations'], '9d'):>9s} {fmt(run['pfss_time'], '8.1f'):>8s}"
+            f" {fmt(run['cs_iterations'], '9d'):>9s} {fmt(run['cs_time'], '8.1f'):>8s}")
+    line += ''.join(f" {fmt(run['errors'][name], '9.2e'):>9s}" for name in COMPARED)
+    print(line + ('' if run['ok'] else f'   > {bound:g}'))
+
+def run(args):
+  ladder = sorted(float(e) for e in args.epscg.split(','))
+  check_error_code(len(ladder) < 2, 'ERROR: -epscg needs at least two values.')
+  args.input_map = Path(args.input_map).resolve()
+  args.outdir = Path(args.outdir or f'{args.input_map.stem}_epscg_study').resolve()
+  args.outdir.mkdir(parents=True, exist_ok=True)
+
+  runs = run_study(args, ladder)
+  check_error_code(all(run['failed'] for run in runs), 'ERROR: all runs of the study failed.')
+  best, reference = recommend(runs, args.bound)
+
+  print(' ')
+  print(f"=> Relative L2 differences from the reference run (epscg={reference['epscg']:.0e}):")
+  print_table(runs, args.bound)
+  print(' ')
+  speedup = (reference['pfss_time'] + reference['cs_time'])/max(best['pfss_time'] + best['cs_time'], 1e-9)
+  print(f"=> Recommended: epscg={best['epscg']:.0e} (all products within {args.bound:g}, "
+        f"PFSS+CS solves {speedup:.1f}x faster than epscg={reference['epscg']:.0e})")
+
+  if args.apply:
+    rsrcdir = Path(sys.path[0]).parent / 'rsrc'
+    for template in ('pot3d_pfss.dat', 'pot3d_cs.dat'):
+      namelist_io.customize(str(rsrcdir / template), str(rsrcdir / template), {'epscg': best['epscg']})
+      print(f"=> Set epscg={best['epscg']:.0e} in {rsrcdir / template}")
+
+def check_error_code(ierr,message):
+  if ierr > 0:
+    print(' ')
+    print(message)
+    print('Error code of fail : '+str(ierr))
+    sys.exit(1)
+
+def check_error_code_non_crash(ierr,message):
+  if ierr > 0:
+    print(' ')
+    print(message)
+    print('Error code of fail : '+str(ierr))
+
+def main():
+  args = argParsing()
+  run(args)
+
+if __name__ == '__main__':
+  main()
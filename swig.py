@@ -8,8 +8,22 @@ from pathlib import Path
 import shutil
 import re
 import h5py as h5
-
-import bin.psi_io as ps
+import time
+import hashlib
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+# The modules of bin/ import each other by name, as when run as scripts.
+# (sys.path[0] is kept: it is the SWiG directory.)
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bin'))
+import psi_io as ps
+import swig_stages as stages
+import swig_scheduler as scheduler
+import plot_maps
+import remesh_map
+import swig_planner as planner
+import solver_logs
+import solver_watchdog as watchdog
 
 ########################################################################
 # SWiG:  Solar Wind Generator
@@ -60,12 +74,18 @@ def argParsing():
     type=str)
 
   parser.add_argument('-np',
-    help='Number of MPI processes (ranks)',
+    help='Number of MPI processes (ranks), or auto to use the -np recommended by swig_planner.py from the timing history of previous runs.',
     dest='np',
-    type=int,
+    type=np_arg,
     default=1,
     required=False)
 
+  parser.add_argument('-deadline',
+    help='With -np auto, the wallclock deadline in seconds for one map: the smallest -np predicted to meet it is used (default: the -np with the best throughput).',
+    dest='deadline',
+    type=float,
+    required=False)
+
   parser.add_argument('-sw_model',
     help='Select solar wind model.',
     dest='sw_model',
@@ -92,10 +112,10 @@ def argParsing():
     required=False)
 
   parser.add_argument('-r1',
-    help='Set outer radius (default 21.5 Rs).',
+    help='Set outer radius (default 21.5 Rs).  A comma-separated list (e.g. 21.5,30) solves the CS model once to the largest radius and writes the br,vr,rho,t products at each radius (as <product>_r1_<r1>.h5).',
     dest='r1',
-    type=float,
-    default=21.5,
+    type=str,
+    default='21.5',
     required=False)
     
   parser.add_argument('-r0_trace',
@@ -112,12 +132,193 @@ def argParsing():
     default=True,
     required=False)
 
+  parser.add_argument('-products',
+    help='Comma-separated list of products to compute (default: all): br,vr,rho,t (at r1), br_r0,ofm_r0,slogq_r0,slogq_rss.  Stages, traces, Q maps, and plots that none of them need are skipped.',
+    dest='products',
+    type=str,
+    default=','.join(stages.PRODUCTS),
+    required=False)
+
+  parser.add_argument('-remesh',
+    help='Remesh the input map (flux-conserving) before running, to the resolution NPxNT (phi x theta points, e.g. 361x181) or to the grid of the given h5 map.  The POT3D and MAPFL grids are sized from the remeshed map.',
+    dest='remesh',
+    type=str,
+    required=False)
+
+  parser.add_argument('-preview',
+    help='First run the whole pipeline on the input map coarsened (flux-conserving) by this factor and publish those results, then run at full resolution and replace them.',
+    dest='preview',
+    type=int,
+    required=False)
+
+  parser.add_argument('-preview_only',
+    help='With -preview, stop after publishing the coarse preview results.',
+    dest='preview_only',
+    action='store_true',
+    default=False,
+    required=False)
+
+  parser.add_argument('-cores',
+    help='Core budget for running independent stages concurrently (default: all cores).  A POT3D stage uses -np cores, the other stages one each.  Set to -np to run the stages one at a time.',
+    dest='cores',
+    type=int,
+    default=os.cpu_count() or 1,
+    required=False)
+
+  parser.add_argument('-pipeline',
+    help='For 3D (ensemble) input maps, pipeline the realizations with up to this many in flight: the solves of the next realization run while the current one is traced and analyzed (one job at a time per class of stage: MPI solver, tracer, Python analysis).',
+    dest='pipeline',
+    type=int,
+    required=False)
+
+  parser.add_argument('-plot_workers',
+    help='Number of parallel processes used to render the result plots, shared by all the runs (default: the CPU count).',
+    dest='plot_workers',
+    type=int,
+    required=False)
+
+  parser.add_argument('-scratch',
+    help='Run the solver and tracing stages in a fresh directory under this (fast, local) scratch location, e.g. /dev/shm, and copy back only the final results.',
+    dest='scratch',
+    type=str,
+    required=False)
+
+  parser.add_argument('-retain',
+    help='Retention policy for intermediate files: all (default) keeps everything, minimal deletes each intermediate as soon as the last stage that reads it has completed.',
+    dest='retain',
+    type=str,
+    choices=stages.RETAIN_POLICIES,
+    default='all',
+    required=False)
+
+  parser.add_argument('-pfss_engine',
+    help='PFSS solver: pot3d (default) or spectral, a fast spherical-harmonic solution (bin/pfss_spectral.py) for quick-look and screening runs.',
+    dest='pfss_engine',
+    type=str,
+    choices=['pot3d', 'spectral'],
+    default='pot3d',
+    required=False)
+
+  parser.add_argument('-ensemble',
+    help='For 3D (ensemble) input maps: full (default) solves the PFSS model of every realization with POT3D, linear solves the ensemble-mean map once with POT3D and adds the spectral PFSS solution of each realization\'s difference from the mean (the CS model is still solved per realization, so the PFSS+CS solve time is cut by at most about 2x; -preview runs are solved in full).',
+    dest='ensemble',
+    type=str,
+    choices=['full', 'linear'],
+    default='full',
+    required=False)
+
+  parser.add_argument('-ensemble_lmax',
+    help='With -ensemble linear, maximum degree of the spectral solution of the differences from the mean (default 40).',
+    dest='ensemble_lmax',
+    type=int,
+    default=40,
+    required=False)
+
+  parser.add_argument('-ensemble_verify',
+    help='With -ensemble linear, also solve the first N realizations with POT3D and report the differences of the linear solutions from them.',
+    dest='ensemble_verify',
+    type=int,
+    default=0,
+    required=False)
+
+  parser.add_argument('-dchb_method',
+    help='How DCHB at r1 is computed: composed (default) only at the r0 footpoints of the r1 points, grid on the whole rss tracing grid and then interpolated to r1 (the previous method, for comparison).',
+    dest='dchb_method',
+    type=str,
+    choices=['composed', 'grid'],
+    default='composed',
+    required=False)
+
+  parser.add_argument('-tracer',
+    help='Field line tracer: mapfl (default) or python (bin/fieldline_tracer.py, for screening runs and machines without MAPFL; the Q maps slogq_r0,slogq_rss are not computed).',
+    dest='tracer',
+    type=str,
+    choices=['mapfl', 'python'],
+    default='mapfl',
+    required=False)
+
+  parser.add_argument('-mapfl_sectors',
+    help='Trace each solution with this many concurrent MAPFL runs over sectors (in phi) of the seed mesh, whose outputs are stitched together (default 1).  Each tracing stage then uses this many cores.',
+    dest='mapfl_sectors',
+    type=int,
+    default=1,
+    required=False)
+
+  parser.add_argument('-adaptive_trace',
+    help='Trace the PFSS solution on an adaptively refined seed mesh with this many refinement levels (default 0: every point of the doubled map mesh).  See bin/adaptive_seeds.py.',
+    dest='adaptive_trace',
+    type=int,
+    default=0,
+    required=False)
+
+  parser.add_argument('-epscg',
+    help='CG solver tolerance of the POT3D runs (default: epscg of the rsrc/pot3d_*.dat templates).  See bin/swig_tolerance_study.py.',
+    dest='epscg',
+    type=float,
+    required=False)
+
+  parser.add_argument('-time_limit',
+    help='Abort any single POT3D or MAPFL run that takes longer than this many seconds.  The reason for an aborted run is written to watchdog_failure.json in the run directory.',
+    dest='time_limit',
+    type=float,
+    required=False)
+
+  parser.add_argument('-max_iterations',
+    help='Abort a POT3D run after this many CG iterations.',
+    dest='max_iterations',
+    type=int,
+    required=False)
+
+  parser.add_argument('-resume',
+    help='Resume an interrupted run, skipping stages (and realizations) that the run manifest shows already completed with the same inputs.',
+    dest='resume',
+    action='store_true',
+    default=False,
+    required=False)
+
   return parser.parse_args()
 
+def np_arg(value):
+  return value if value == 'auto' else int(value)
+
 def run(args):
+  args.products = stages.parse_products(args.products)
+  check_error_code(args.products is None, 'Invalid -products (choose from '+','.join(stages.PRODUCTS)+').')
+  check_error_code(args.preview is not None and args.preview < 2, 'Invalid -preview (the coarsening factor must be at least 2).')
+  check_error_code(args.pipeline is not None and args.pipeline < 1, 'Invalid -pipeline (at least 1 realization must be in flight).')
+  check_error_code(args.ensemble == 'linear' and args.pfss_engine != 'pot3d', 'Invalid -ensemble linear with -pfss_engine '+args.pfss_engine+'.')
+  args.pfss_mean = None
+  args.pfss_verify = False
+  # Scratch directories of the runs (-scratch): {workdir: rundir}.
+  args.scratch_dirs = {}
+  # The plots of every run share one pool of workers, started before the
+  # scheduler's threads (see plot_maps.start_pool).
+  args.plot_pool = plot_maps.start_pool(args.plot_workers) if args.plot_results else None
+  check_error_code(args.adaptive_trace > 0 and args.tracer != 'mapfl', 'Invalid -adaptive_trace with -tracer '+args.tracer+'.')
+  if args.tracer == 'python':
+    qmaps = [p for p in args.products if p.startswith('slogq')]
+    if qmaps:
+      print('=> -tracer python does not compute the Q maps, skipping '+','.join(qmaps)+'.')
+    args.products = [p for p in args.products if not p.startswith('slogq')]
+    check_error_code(not args.products, 'Invalid -products (none can be computed with -tracer python).')
+
+  # The CS model is solved to the largest r1, the others are sliced out
+  # of that solution.
+  args.radii = sorted(set(float(r) for r in args.r1.split(',')))
+  args.r1 = args.radii[-1]
+  check_error_code(args.radii[0] <= args.rss, 'Invalid -r1 (every radius must be greater than -rss).')
+
   # Get full path of input file:
   args.input_map = Path(args.input_map).resolve()
 
+  if args.np == 'auto':
+    result = planner.plan(str(args.input_map), cores=args.cores, deadline=args.deadline)
+    args.np = result['np'] or 1
+    if result['np']:
+      print(f"=> Using -np {args.np} (predicted {result['time']:.1f} s, {result['memory']/1e9:.2f} GB per map)")
+    else:
+      print('=> No timing history for -np auto yet, using -np 1')
+
   # Make rundir and go there
   args.rundir = Path(args.rundir or f'{args.input_map.stem}_swig_run').resolve()
 
@@ -130,19 +331,20 @@ def run(args):
 
   # Check if the hdf is 3D or 2D
   if is_3D_hdf(args.input_map):
-    # If 3D extact realizations and process individually
-    temp_dir = args.rundir / "temp_extract"
-    print(temp_dir)
-    temp_dir.mkdir(exist_ok=True)
-    temp_file = temp_dir / args.input_map.name
-    shutil.copy(args.input_map, temp_file)
-    for file in extract_realization(temp_file):
-      match = re.search(r'r(\d{6})', file)
-      rundir = args.rundir / f'r{match.group(1)}' if match else args.rundir
-      rundir.mkdir(exist_ok=True)
-      process_map(args, file, rundir)
-
-    shutil.rmtree(temp_dir)
+    # If 3D, stream the realizations straight from the input file and
+    # process them individually.  Only the current realization's slice
+    # is written (as the 2D input map in its own run directory); with
+    # -pipeline, only the -pipeline realizations in flight.
+    if args.ensemble == 'linear':
+      args.pfss_mean = solve_ensemble_mean(args)
+    realizations = enumerate(iter_realizations(args.input_map))
+    if args.pipeline:
+      run_pipeline(args, realizations)
+    else:
+      for k, realization in realizations:
+        process_map(args, *write_realization(args, k, *realization))
+    if args.pfss_mean:
+      report_ensemble(args)
   else:
     # Process 2D file
     match = re.search(r'r(\d{6})', str(args.input_map))
@@ -150,63 +352,369 @@ def run(args):
       args.rnum = int(match.group(1))
     rundir = args.rundir / f'r{match.group(1)}' if match else args.rundir
     rundir.mkdir(exist_ok=True)
-    process_map(args, str(args.input_map), rundir)
+    input_map = str(args.input_map)
+    if args.remesh:
+      input_map = str(rundir / f'{args.input_map.stem}_remeshed.h5')
+      xvec, yvec, data = ps.rdhdf_2d(str(args.input_map))
+      ps.wrhdf_2d(input_map, *remesh(args, xvec, yvec, data))
+    process_map(args, input_map, rundir)
+  if args.plot_pool:
+    args.plot_pool.shutdown()
+
+def remesh(args, xvec, yvec, data):
+  # Flux-conserving remesh of the input map (either layout) to -remesh.
+  remeshed = remesh_map.remesh_xy(xvec, yvec, data, args.remesh)
+  check_error_code(remeshed is None, 'Invalid -remesh '+args.remesh+' (NPxNT or an h5 map).')
+  print(f'=> Input map remeshed from {np.shape(data)} to {remeshed[2].shape}')
+  return remeshed
 
 def process_map(args, input_map: str, rundir: Path):
-  # Change to run directory
-  os.chdir(rundir)
+  # Run the PFSS+CS models, the tracing analysis, and the solar wind
+  # model as a graph of stages.  Stages whose inputs are ready run
+  # concurrently within the core budget (e.g. the PFSS tracing runs
+  # alongside the CS solve).
+  print(f'=> Running PFSS+CS model, magnetic tracing analysis, and emperical solar wind model ({args.cores} cores):')
+  failed = scheduler.run_jobs(map_jobs(args, input_map, rundir), args.cores)
+  if failed:
+    copy_reports(args)
+  check_error_code(len(failed), 'Failed stage(s): '+' '.join(failed))
+
+def write_realization(args, k, rnum, pvec, tvec, data):
+  # Write realization rnum (the k-th) as the 2D input map of its run
+  # directory.  Returns (input map, run directory).
+  args.pfss_verify = k < args.ensemble_verify
+  rundir = args.rundir / f'r{rnum:06d}'
+  rundir.mkdir(exist_ok=True)
+  file = str(rundir / f'{args.input_map.stem}_r{rnum:06d}.h5')
+  if args.remesh:
+    # The weights are computed for the first realization only.
+    pvec, tvec, data = remesh(args, pvec, tvec, data)
+  ps.wrhdf_2d(file, pvec, tvec, data)
+  return file, rundir
+
+def run_pipeline(args, realizations):
+  # Run all realizations as one graph.  Each class of stage (MPI solver,
+  # tracer, Python analysis) has its own slot, so the solves of the next
+  # realization run while the current one is traced and analyzed.  The
+  # realizations are fed to the scheduler as it goes: at most
+  # args.pipeline of them are written (with their previews) and in
+  # flight at a time.
+  def feed():
+    for k, realization in realizations:
+      rnum = realization[0]
+      jobs = map_jobs(args, *write_realization(args, k, *realization), prefix=f'r{rnum:06d}:')
+      for job in jobs:
+        # Earlier realizations (and their previews) are started first.
+        job['group'] = 2*k + job.get('group', 0)
+      yield jobs
+  print(f'=> Running the realizations pipelined ({args.pipeline} in flight, {args.cores} cores):')
+  failed = scheduler.run_jobs([], args.cores, stages.RESOURCE_SLOTS, feed=feed(), window=args.pipeline)
+  if failed:
+    copy_reports(args)
+  check_error_code(len(failed), 'Failed stage(s): '+' '.join(failed))
+
+def map_jobs(args, input_map: str, rundir: Path, prefix=''):
+  # All jobs of one map: the optional preview run, then the full run.
+  jobs = []
+  if args.preview:
+    if args.resume and results_complete(args, input_map, rundir):
+      print(f'=> Full-resolution results in {rundir} already complete (resume), skipping preview.')
+    else:
+      # Run the pipeline on a coarsened copy of the input map in the
+      # preview subdirectory and publish its results in the run's results
+      # directory (where the full-resolution run will later replace them).
+      previewdir = rundir / 'preview'
+      previewdir.mkdir(exist_ok=True)
+      preview_input = previewdir / f'{Path(input_map).stem}_preview_x{args.preview}.h5'
+      shape, shape_new = remesh_map.coarsen_map(input_map, preview_input, args.preview)
+      print(f'=> Preview: input map coarsened by {args.preview} from {shape} to {shape_new}')
+      jobs = map_run_jobs(args, str(preview_input), previewdir, {'level': 'preview', 'factor': args.preview},
+                          prefix+'preview:', publish_dir=rundir / 'results')
+      # The preview is scheduled ahead of the full-resolution run.
+      for job in jobs:
+        job['group'] = -1
+    if args.preview_only:
+      return jobs
+  full = map_run_jobs(args, input_map, rundir, {'level': 'full', 'factor': 1}, prefix)
+  if jobs and full:
+    # The full-resolution results must replace the preview, not the reverse.
+    full[-1]['after'].append(jobs[-1]['name'])
+  return jobs + full
+
+def results_stage(args, input_map):
+  params = {'input_map': stages.file_checksum(input_map),
+            'rss': args.rss, 'r1': args.r1 if len(args.radii) == 1 else args.radii, 'r0_trace': args.r0_trace,
+            'sw_model': args.sw_model, 'sw_model_params': args.sw_model_params}
+  # Several maps may share one run directory (distinguished by -oidx),
+  # so the results stage is recorded per output index.
+  stage = 'results' + (f"_idx{args.oidx:06d}" if args.oidx is not None else "")
+  outputs = [f'results/{name}.h5' for name in result_names(args)]
+  return stage, params, outputs
+
+def results_complete(args, input_map, rundir):
+  stage, params, outputs = results_stage(args, input_map)
+  return stages.stage_complete(rundir, stage, params, [], outputs)
+
+def map_run_jobs(args, input_map: str, rundir: Path, resolution, prefix='', publish_dir=None):
+  # The stage jobs of one run of one map, followed by a job that collects
+  # (and plots) the results.  All paths are explicit, as the jobs of
+  # several maps may run at the same time.
   # Get path of the SWiG directory
   swigdir = Path(sys.path[0])
 
+  # With several r1 radii the CS solution is read by the traces of every
+  # radius, so the intermediates are released once all have finished.
+  retain = args.retain if len(args.radii) == 1 else 'all'
+  stage_flags = f" -retain {retain} -products {','.join(args.products)}" + (' -resume' if args.resume else '')
+  if args.mapfl_sectors > 1:
+    stage_flags += f" -sectors {args.mapfl_sectors}"
+  if args.adaptive_trace:
+    stage_flags += f" -adaptive {args.adaptive_trace}"
+  if args.mapfl_sectors > 1 or args.adaptive_trace:
+    # The MAPFL runs of a trace share the cores the scheduler gives it.
+    stage_flags += f" -cores {max(args.mapfl_sectors, 1)}"
+  results_name, results_params, results_outputs = results_stage(args, input_map)
+  if args.resume and results_complete(args, input_map, rundir):
+    print(f'=> Results in {rundir} already complete (resume), skipping.')
+    return []
+
+  # Run the stages in the scratch directory if requested.
+  workdir = scratch_workdir(args, rundir) if args.scratch else rundir
+  if args.scratch:
+    print(f'=> Running stages of {rundir} in scratch directory: {workdir}')
+    args.scratch_dirs[workdir] = rundir
+
   # [][RC][]: ADD RESOLUTION CHECK HERE, STORE FOR USE IN PFSS/CS/MAPFL/EMP-PARAM-C3
 
-  # Run PF model.
-  print('=> Running PFSS+CS model with POT3D:')
-  Command=f"{swigdir / 'bin' / 'cor_pfss_cs_pot3d.py'} {input_map} -np {args.np} -rss {args.rss} -r1 {args.r1}"
-  run_command(Command)
+  # The ensemble mean is solved at full resolution, so the coarsened
+  # previews are solved in full.
+  pfss_mean = args.pfss_mean if resolution['level'] == 'full' else None
+  jobs = stage_jobs(args, swigdir, input_map, workdir, stage_flags, retain, pfss_mean)
+  for r1 in args.radii[:-1]:
+    jobs += radius_jobs(args, swigdir, workdir, r1, stage_flags, retain)
+
+  def finish():
+    # Collect results and plot everything if selected.
+    print(f'=> Collecting results of {rundir}...')
+    result_dir = collect_results(args, workdir, rundir)
+    mark_resolution(args, result_dir, resolution)
+    idxstr = f"_idx{args.oidx:06d}" if args.oidx is not None else ""
+    solver_logs.write_metrics(workdir, result_dir / f"solver_metrics{idxstr}.json",
+                              {'input_map': str(input_map), 'resolution': resolution['level']})
+    if args.retain == 'minimal':
+      skipped = set(stages.STAGES) - set(stages.required_stages(args.products))
+      stages.release_intermediates(workdir, done=['results', *skipped])
+      for r1 in args.radii[:-1]:
+        stages.release_intermediates(radius_workdir(args, workdir, r1), done=list(stages.STAGES))
+    if args.scratch:
+      shutil.rmtree(workdir)
+
+    if args.plot_results:
+      plot_results(args, swigdir, result_dir)
+
+    stages.record_stage(rundir, results_name, results_params, [], results_outputs)
+    if publish_dir is not None:
+      publish_results(args, result_dir, publish_dir)
+
+    print('=> SWiG complete!')
+    print('=> Results can be found here:  ')
+    print(f'   {publish_dir or result_dir}')
+
+  jobs.append({'name': 'results', 'func': finish, 'cores': 1, 'after': [job['name'] for job in jobs],
+               'weight': stages.STAGES['results']['weight'], 'resource': stages.STAGES['results']['resource']})
+  for job in jobs:
+    job['name'] = prefix + job['name']
+    job['after'] = [prefix + name for name in job['after']]
+  return jobs
+
+
+def stage_jobs(args, swigdir, input_map, workdir, stage_flags, retain, pfss_mean=None):
+  if args.time_limit:
+    stage_flags += f" -time_limit {args.time_limit}"
+  radii = ','.join(f'{r:g}' for r in args.radii)
+  cor = f"{swigdir / 'bin' / 'cor_pfss_cs_pot3d.py'} {input_map} -np {args.np} -rss {args.rss} -r1 {radii}{stage_flags}"
+  if args.max_iterations:
+    cor += f" -max_iterations {args.max_iterations}"
+  if args.epscg:
+    cor += f" -epscg {args.epscg}"
+  if args.pfss_engine != 'pot3d':
+    cor += f" -pfss_engine {args.pfss_engine}"
+  if pfss_mean:
+    cor += f" -pfss_engine linear -pfss_mean {pfss_mean} -lmax {args.ensemble_lmax}" + (' -verify' if args.pfss_verify else '')
+  mag = f"{swigdir / 'bin' / 'mag_trace_analysis.py'} -r0_trace {args.r0_trace} -dchb_method {args.dchb_method} -tracer {args.tracer}{stage_flags}"
+  # Only the stages the requested products need are run.
+  required = stages.required_stages(args.products)
+  jobs = [{'name': stage, 'command': f"{cor} -stages {stage}",
+           'cores': 1 if stage == 'pfss' and (args.pfss_engine == 'spectral' or pfss_mean and not args.pfss_verify) else args.np}
+          for stage in ('pfss', 'cs') if stage in required]
+  jobs += [{'name': stage, 'command': f"{mag} -stages {stage} .", 'cores': stage_cores(args, stage)}
+           for stage in ('pfss_trace', 'cs_trace', 'expfac', 'dchb', 'br_r1') if stage in required]
+  if 'eswim' in required:
+    jobs.append(eswim_job(args, swigdir, workdir, retain))
+
+  for job in jobs:
+    job['cwd'] = str(workdir)
+    job['after'] = stages.dependencies(job['name'])
+    job['weight'] = stages.STAGES[job['name']]['weight']
+    job['resource'] = stages.STAGES[job['name']]['resource']
+  return jobs
+
+
+def stage_cores(args, stage):
+  # MAPFL traces with -mapfl_sectors run that many processes.
+  if stage in ('pfss_trace', 'cs_trace') and args.tracer == 'mapfl':
+    return max(args.mapfl_sectors, 1)
+  return 1
+
+def eswim_job(args, swigdir, workdir, retain):
+  # The solar wind model is run (and recorded) from here.  The resume
+  # check happens when the job starts, after its inputs are final.
+  eswim_params = {'sw_model': args.sw_model, 'sw_model_params': args.sw_model_params}
+  def run_eswim():
+    if args.resume and stages.stage_complete(workdir, 'eswim', eswim_params):
+      print('=> Emperical solar wind model already complete (resume), skipping.')
+      return
+    tstart = time.time()
+    Command=f"{swigdir / 'bin' / 'eswim.py'} -dchb dchb_at_r1.h5 -expfac expfac_rss_at_r1.h5 -model {args.sw_model}  {args.sw_model_params}"
+    run_command(Command, cwd=workdir)
+    stages.record_stage(workdir, 'eswim', eswim_params, elapsed=time.time()-tstart)
+    if retain == 'minimal':
+      stages.release_intermediates(workdir)
+  return {'name': 'eswim', 'func': run_eswim, 'cores': 1}
+
+
+def radius_workdir(args, workdir, r1):
+  # The products at the largest r1 are made in workdir, the others each
+  # in their own subdirectory.
+  return workdir if r1 == args.r1 else workdir / f'r1_{r1:g}'
+
+
+def radius_jobs(args, swigdir, workdir, r1, stage_flags, retain):
+  # Jobs making the r1 products at a radius below the outer boundary of
+  # the CS solution in their own directory.  The PFSS and CS files these
+  # stages read are linked from workdir, with the CS Br slice at r1 (see
+  # cor_pfss_cs_pot3d.py) in place of the outer slice, and the CS field
+  # lines are traced back from r1.
+  radiusdir = radius_workdir(args, workdir, r1)
+  required = stages.required_stages(args.products)
+  for file in stages.r1_inputs():
+    target = workdir / (f'cs/br_r1_cs_{r1:g}.h5' if file == 'cs/br_r1_cs.h5' else file)
+    link = radiusdir / file
+    link.parent.mkdir(parents=True, exist_ok=True)
+    if link.is_symlink():
+      link.unlink()
+    link.symlink_to(os.path.relpath(target, link.parent))
+
+  if args.time_limit:
+    stage_flags += f" -time_limit {args.time_limit}"
+  mag = f"{swigdir / 'bin' / 'mag_trace_analysis.py'} -r0_trace {args.r0_trace} -r1 {r1:g} -dchb_method {args.dchb_method} -tracer {args.tracer}{stage_flags}"
+  jobs = [{'name': stage, 'command': f"{mag} -stages {stage} .", 'cores': stage_cores(args, stage)}
+          for stage in stages.R1_STAGES if stage in required and stage != 'eswim']
+  if 'eswim' in required:
+    jobs.append(eswim_job(args, swigdir, radiusdir, retain))
+
+  prefix = f'r1_{r1:g}:'
+  for job in jobs:
+    job['cwd'] = str(radiusdir)
+    job['after'] = [prefix + dep if dep in stages.R1_STAGES else dep for dep in stages.dependencies(job['name'])]
+    job['weight'] = stages.STAGES[job['name']]['weight']
+    job['resource'] = stages.STAGES[job['name']]['resource']
+    job['name'] = prefix + job['name']
+  return jobs
+
+
+def scratch_workdir(args, rundir):
+  # Name the scratch directory after the run directory so that a resumed
+  # run on the same node finds its earlier stages.
+  tag = hashlib.sha1(str(rundir).encode()).hexdigest()[:12]
+  workdir = Path(args.scratch).resolve() / f'swig_{rundir.name}_{tag}'
+  workdir.mkdir(parents=True, exist_ok=True)
+  return workdir
+
+
+def copy_reports(args):
+  # Copy the watchdog failure reports of the runs in scratch directories
+  # (left there on failure) to the same place in their run directories,
+  # keeping their times, for swig_run_multiple_maps.py.
+  for workdir, rundir in args.scratch_dirs.items():
+    for root, _, files in os.walk(workdir):
+      if watchdog.REPORT_NAME in files:
+        target = rundir / Path(root).relative_to(workdir) / watchdog.REPORT_NAME
+        target.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copy2(Path(root) / watchdog.REPORT_NAME, target)
+        print(f'=> Watchdog report copied from the scratch directory to {target}')
+
+
+def run_command(Command, cwd=None):
+  print('   Command:  '+Command)
+  ierr = subprocess.run(["bash","-c",Command], cwd=cwd)
+  check_error_code(ierr.returncode,'Failed : '+Command)
 
-  # Analyze and compute required quantities from model.
-  print('=> Running magnetic tracing analysis:')
+FILES_TO_MOVE = ["br_r1.h5", "vr_r1.h5", "t_r1.h5", "rho_r1.h5"]
+FILES_TO_COPY = {"pfss/ofm_r0.h5": "ofm_r0", "pfss/slogq_r0.h5": "slogq_r0", "pfss/br_r0_pfss.h5": "br_r0", "pfss/slogq_rss.h5": "slogq_rss"}
 
-  Command=f"{swigdir / 'bin' / 'mag_trace_analysis.py'} -r0_trace {args.r0_trace} ."
-  run_command(Command)
 
-  # Generate solar wind model.
-  print('=> Running emperical solar wind model:')
-  Command=f"{swigdir / 'bin' / 'eswim.py'} -dchb dchb_at_r1.h5 -expfac expfac_rss_at_r1.h5 -model {args.sw_model}  {args.sw_model_params}"
-  run_command(Command)
+def result_files(args):
+  # Files to move and to copy into the results for the requested products.
+  wanted = [stages.PRODUCTS[p] for p in args.products]
+  return [file for file in FILES_TO_MOVE if file in wanted], \
+         {src: dest for src, dest in FILES_TO_COPY.items() if src in wanted}
 
-  # Collect results and plot everything if selected.
-  print('=> Collecting results...')
-  result_dir = collect_results(args, rundir)
-    
-  if args.plot_results:
-    plot_results(args, swigdir, result_dir)
 
-  print('=> SWiG complete!')
-  print('=> Results can be found here:  ')
-  print(f'   {result_dir}')
+def radius_tag(args, r1):
+  # The r1 products are named by radius when there are several.
+  return f"_{r1:g}" if len(args.radii) > 1 else ""
 
 
-def run_command(Command):
-  print('   Command:  '+Command)
-  ierr = subprocess.run(["bash","-c",Command])
-  check_error_code(ierr.returncode,'Failed : '+Command)
+def result_names(args):
+  idxstr = f"_idx{args.oidx:06d}" if args.oidx is not None else ""
+  files_to_move, files_to_copy = result_files(args)
+  return [f"{Path(file).stem}{radius_tag(args, r1)}{idxstr}" for r1 in args.radii for file in files_to_move] + \
+         [f"{dest}{idxstr}" for dest in files_to_copy.values()]
 
-def collect_results(args, rundir):
+
+def collect_results(args, workdir, rundir):
   result_dir = rundir / 'results'
   result_dir.mkdir(exist_ok=True)
   idxstr = f"_idx{args.oidx:06d}" if args.oidx is not None else ""
-  files_to_move = ["br_r1.h5", "vr_r1.h5", "t_r1.h5", "rho_r1.h5"]
-  files_to_copy = {"pfss/ofm_r0.h5": "ofm_r0", "pfss/slogq_r0.h5": "slogq_r0", "pfss/br_r0_pfss.h5": "br_r0", "pfss/slogq_rss.h5": "slogq_rss"}
+  files_to_move, files_to_copy = result_files(args)
 
-  for file in files_to_move:
-    move_file(file, result_dir / f"{Path(file).stem}{idxstr}.h5")
+  for r1 in args.radii:
+    for file in files_to_move:
+      move_file(radius_workdir(args, workdir, r1) / file,
+                result_dir / f"{Path(file).stem}{radius_tag(args, r1)}{idxstr}.h5")
   for src, dest in files_to_copy.items():
-    copy_file(src, result_dir / f"{dest}{idxstr}.h5")
+    copy_file(workdir / src, result_dir / f"{dest}{idxstr}.h5")
   return result_dir
 
 
+def mark_resolution(args, result_dir, resolution):
+  # Tag each result file (HDF5 attributes) and the result set (JSON) with
+  # the resolution level it was computed at.
+  idxstr = f"_idx{args.oidx:06d}" if args.oidx is not None else ""
+  names = result_names(args)
+  for name in names:
+    with h5.File(result_dir / f"{name}.h5", 'r+') as h5file:
+      h5file.attrs['swig_resolution'] = resolution['level']
+      h5file.attrs['swig_coarsening_factor'] = resolution['factor']
+  with open(result_dir / f"resolution{idxstr}.json", 'w') as f:
+    json.dump({**resolution, 'results': names}, f, indent=2)
+
+
+def publish_results(args, src_dir, dest_dir):
+  # Copy a result set (data, plots, and resolution tag) into dest_dir,
+  # replacing each file atomically.
+  dest_dir.mkdir(exist_ok=True)
+  idxstr = f"_idx{args.oidx:06d}" if args.oidx is not None else ""
+  files = [f"{name}{ext}" for name in result_names(args) for ext in ('.h5', '.png')]
+  files.append(f"resolution{idxstr}.json")
+  for file in files:
+    if (src_dir / file).exists():
+      shutil.copyfile(src_dir / file, dest_dir / f".{file}.tmp")
+      os.replace(dest_dir / f".{file}.tmp", dest_dir / file)
+  print(f'=> Published results ({src_dir.parent.name}) in {dest_dir}')
+
+
 def move_file(src, dest):
     ierr = os.system(f"mv {src} {dest}")
     check_error_code(ierr, f"Failed to move {src} to {dest}")
@@ -217,35 +725,109 @@ def copy_file(src, dest):
     check_error_code(ierr, f"Failed to copy {src} to {dest}")
 
 
+PLOTS = [
+    ('br_r0',     'Gauss',   -20,    20,      'finegrid', 'psi_red_blue'),
+    ('slogq_r0',  '"slogQ"', -7,     7,       'finegrid', 'RdBu_r'),
+    ('slogq_rss', '"slogQ"', -7,     7,       'finegrid', 'RdBu_r'),
+    ('ofm_r0',    None,      -1,     1,       'finegrid', 'psi_red_blue'),
+    ('t_r1',      'K',       200000, 2000000, 'finegrid', 'hot'),
+    ('rho_r1',    'g/cm^3',  100,    800,     'finegrid', 'gnuplot2_r'),
+    ('vr_r1',     'km/s',    200,    800,     'finegrid', 'rainbow'),
+    ('br_r1',     'Gauss',   -0.002, 0.002,   'finegrid', 'psi_red_blue')
+]
+
+
 def plot_results(args, swigdir, result_dir):
-    os.chdir(result_dir)
     print("=> Plotting results...")
     idxstr = f"_idx{args.oidx:06d}" if args.oidx is not None else ""
-    plots = [
-        ('br_r0',     'Gauss',   -20,    20,      'finegrid', 'psi_red_blue'),
-        ('slogq_r0',  '"slogQ"', -7,     7,       'finegrid', 'RdBu_r'),
-        ('slogq_rss', '"slogQ"', -7,     7,       'finegrid', 'RdBu_r'),
-        ('ofm_r0',    None,      -1,     1,       'finegrid', 'psi_red_blue'),
-        ('t_r1',      'K',       200000, 2000000, 'finegrid', 'hot'),
-        ('rho_r1',    'g/cm^3',  100,    800,     'finegrid', 'gnuplot2_r'),
-        ('vr_r1',     'km/s',    200,    800,     'finegrid', 'rainbow'),
-        ('br_r1',     'Gauss',   -0.002, 0.002,   'finegrid', 'psi_red_blue')
-    ]
-
-    for name, label, cmin, cmax, grid, cmap in plots:
-      cmd = (f"{swigdir / 'pot3d' / 'bin' / 'psi_plot2d'} -tp {'-unit_label ' + label if label else ''} -cmin {cmin} -cmax {cmax} -ll -{grid} {name}{idxstr}.h5 {'-cmap ' + cmap if cmap else ''} -o {name}{idxstr}.png")
-      ierr = os.system(cmd)
+    names = result_names(args)
+    # Each r1 product is plotted at every radius.
+    tags = {radius_tag(args, r1) for r1 in args.radii}
+    plots = [(name+tag, *spec) for name, *spec in PLOTS for tag in sorted(tags | {''})
+             if f"{name}{tag}{idxstr}" in names]
+
+    specs = []
+    if plot_maps.have_matplotlib():
+      # Render the plots with the pool of plotting workers, except those
+      # with the psi_plot2d colormaps.
+      specs = [{'data': result_dir / f"{name}{idxstr}.h5", 'output': result_dir / f"{name}{idxstr}.png", 'unit_label': label,
+                'cmin': cmin, 'cmax': cmax, 'cmap': cmap} for name, label, cmin, cmax, grid, cmap in plots]
+      plots = [plot for plot, spec in zip(plots, specs) if not plot_maps.renders(spec)]
+      specs = [spec for spec in specs if plot_maps.renders(spec)]
+
+    # The psi_plot2d plots run in the same pool.
+    commands = [f"cd {result_dir} && {swigdir / 'pot3d' / 'bin' / 'psi_plot2d'} -tp {'-unit_label ' + label if label else ''} -cmin {cmin} -cmax {cmax} -ll -{grid} {name}{idxstr}.h5 {'-cmap ' + cmap if cmap else ''} -o {name}{idxstr}.png"
+                for name, label, cmin, cmax, grid, cmap in plots]
+    ierrs = plot_maps.render_plots(specs, args.plot_workers, args.plot_pool, commands)
+    for (name, *_), ierr in zip(plots, ierrs):
       check_error_code(ierr, f"Failed to plot {name}{idxstr}.h5")
 
 
-def extract_realization(file):
-  pvec, tvec, rvec, data = ps.rdhdf_3d(file)
-  created_files = []
-  for i in map(int, rvec):
-    fname = f"{file.with_suffix('')}_r{i:06d}.h5"
-    created_files.append(fname)
-    ps.wrhdf_2d(fname, pvec, tvec, data[i - 1, :, :])
-  return created_files
+def solve_ensemble_mean(args):
+  # Solve the PFSS model of the ensemble-mean map with POT3D, for the
+  # linear solutions of the realizations.  Returns its pfss directory.
+  mean_dir = args.rundir / 'ensemble_mean'
+  mean_dir.mkdir(exist_ok=True)
+  total, count = None, 0
+  for rnum, pvec, tvec, data in iter_realizations(args.input_map):
+    total = np.array(data, dtype=np.float64) if total is None else total + data
+    count += 1
+  mean_map = mean_dir / f'{args.input_map.stem}_mean.h5'
+  if args.remesh:
+    # The remesh is linear, so this is the mean of the remeshed realizations.
+    pvec, tvec, total = remesh(args, pvec, tvec, total)
+  ps.wrhdf_2d(str(mean_map), pvec, tvec, total/count)
+
+  cor = f"{Path(sys.path[0]) / 'bin' / 'cor_pfss_cs_pot3d.py'} {mean_map} -np {args.np} -rss {args.rss} -r1 {args.r1}" \
+        f" -stages pfss -retain all -products {','.join(args.products)}" + (' -resume' if args.resume else '')
+  if args.epscg:
+    cor += f" -epscg {args.epscg}"
+  print(f'=> Solving the PFSS model of the ensemble mean of {count} realizations in {mean_dir}')
+  failed = scheduler.run_jobs([{'name': 'ensemble_mean:pfss', 'command': cor, 'cwd': str(mean_dir), 'cores': args.np}], args.cores)
+  check_error_code(len(failed), 'Failed to solve the PFSS model of the ensemble mean.')
+  return mean_dir / 'pfss'
+
+
+def report_ensemble(args):
+  # Accuracy and cost of the linear PFSS solutions of the realizations.
+  mean_time = stages.load_manifest(args.pfss_mean.parent)['stages'].get('pfss', {}).get('elapsed')
+  print('=> Linear ensemble PFSS solutions (relative to |Br| at r0; POT3D differences of verified realizations):')
+  times, cs_times = [], []
+  for report_file in sorted(args.rundir.glob('r*/pfss/linear_pfss.json')):
+    with open(report_file) as f:
+      report = json.load(f)
+    rundir = report_file.parent.parent
+    manifest = stages.load_manifest(rundir)['stages']
+    elapsed = manifest.get('pfss', {}).get('elapsed')
+    if elapsed is not None and 'versus_pot3d' not in report:
+      times.append(elapsed)
+      cs_times.append(manifest.get('cs', {}).get('elapsed') or 0.0)
+    line = f"   {rundir.name}: difference {report['perturbation']:.2e}, truncation error {report['truncation_error']:.2e}"
+    if 'versus_pot3d' in report:
+      line += ', vs POT3D ' + ', '.join(f"{name} {diff['rel_l2']:.2e}" for name, diff in report['versus_pot3d'].items())
+    print(line)
+  if mean_time and times:
+    print(f'=> PFSS cost: {mean_time:.1f} s (mean, POT3D) + {sum(times):.1f} s ({len(times)} realizations), '
+          f'versus about {mean_time*len(times):.1f} s for {len(times)} POT3D solves')
+    # The CS model is still solved for every realization.
+    linear, full = mean_time + sum(times) + sum(cs_times), mean_time*len(times) + sum(cs_times)
+    print(f'=> PFSS+CS cost: {linear:.1f} s, versus about {full:.1f} s without -ensemble linear '
+          f'({full/max(linear, 1e-9):.1f}x; the CS solves, {sum(cs_times):.1f} s, are not reduced)')
+
+
+def iter_realizations(file):
+  # Yield (rnum, pvec, tvec, data) for each realization of a 3D map,
+  # reading one slice at a time.  The next slice is read in the
+  # background while the caller processes the current one.
+  pvec, tvec, rvec = ps.rdhdf_scales(file)
+  rnums = list(map(int, rvec))
+  with ThreadPoolExecutor(max_workers=1) as reader:
+    pending = reader.submit(ps.rdhdf_3d_slice, file, rnums[0] - 1) if rnums else None
+    for k, rnum in enumerate(rnums):
+      data = pending.result()
+      if k + 1 < len(rnums):
+        pending = reader.submit(ps.rdhdf_3d_slice, file, rnums[k + 1] - 1)
+      yield rnum, pvec, tvec, data
 
 
 def is_3D_hdf(file):
@@ -300,4 +882,59 @@ if __name__ == '__main__':
 #       - Added -sw_model_params to pass solar wind parameters to 
 #         solar wind generator script eswim.py.
 #
+# ### Version 1.5.0, 10/19/2026:
+#       - Added -resume to continue interrupted runs using the
+#         stage-completion manifest (swig_manifest.json) in each run
+#         directory.
+#       - Added -scratch to run stages in a local scratch directory and
+#         -retain to delete intermediates as soon as they are no longer
+#         needed.
+#       - Plots are now rendered in-process and in parallel with
+#         plot_maps.py (psi_plot2d is still used for the plots with
+#         its psi_red_blue colormap, and if matplotlib is
+#         unavailable).  Added -plot_workers.
+#       - Realizations of 3D input maps are now streamed one slice at a
+#         time from the input file (no temporary copy of the cube).
+#       - The model, tracing, and solar wind stages now run as a
+#         dependency graph (bin/swig_scheduler.py) so that independent
+#         stages run concurrently.  Added -cores to set the core budget.
+#       - Added -products to compute (trace, copy, and plot) only the
+#         requested products.
+#       - Added -preview (and -preview_only) to first run and publish the
+#         pipeline on a flux-conserving coarsened map (bin/remesh_map.py).
+#         Results are tagged with their resolution level.
+#       - Added -pipeline to overlap the stages of successive realizations
+#         of 3D input maps, with one slot per class of stage.
+#       - Added -np auto (and -deadline) to choose -np from the timing
+#         history of previous runs (bin/swig_planner.py).
+#       - POT3D and MAPFL now run under a watchdog (bin/solver_watchdog.py)
+#         that aborts them early on errors or stalled solves.  Added
+#         -time_limit and -max_iterations.
+#       - Added -epscg to set the POT3D CG tolerance (see
+#         bin/swig_tolerance_study.py).
+#       - The POT3D/MAPFL metrics of each run (CG iterations, residuals,
+#         stage times) are written to results/solver_metrics*.json
+#         (bin/solver_logs.py).
+#       - Added -pfss_engine spectral to compute the PFSS solution with a
+#         spherical-harmonic solver (bin/pfss_spectral.py) instead of POT3D.
+#       - Added -ensemble linear (with -ensemble_lmax and -ensemble_verify)
+#         to solve the PFSS model of an ensemble once for its mean map with
+#         POT3D and obtain each realization by adding the spectral solution
+#         of its difference from the mean (the -preview runs are solved
+#         in full).
+#       - -r1 accepts a comma-separated list of radii: the CS model is
+#         solved once to the largest and the br,vr,rho,t products are
+#         written at each radius.
+#       - Added -remesh to remesh the input map (flux-conserving, with
+#         cached weights) to a target resolution or grid before running.
+#       - DCHB at r1 is computed only at the r0 footpoints of the r1
+#         points by default.  Added -dchb_method grid for the previous
+#         method.
+#       - Added -tracer python to trace the field lines in Python
+#         (bin/fieldline_tracer.py) instead of with MAPFL.
+#       - Added -mapfl_sectors to trace each solution with concurrent
+#         MAPFL runs over sectors of the seed mesh (bin/mapfl_sectors.py).
+#       - Added -adaptive_trace to trace the PFSS solution on an
+#         adaptively refined seed mesh (bin/adaptive_seeds.py).
+#
 ########################################################################
@@ -0,0 +1,76 @@
+import os
+import sys
+import shutil
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'bin'))
+
+import psi_io as ps
+import backmap
+
+########################################################################
+#  Tests of bin/backmap.py on a run directory with the file layouts of
+#  example/run_reference: ofm_r0.h5 (pt, 721x361) and dchb_at_r1.h5
+#  (pt, 361x181) from the reference run, and identity tracings (tp, as
+#  MAPFL writes them), so that every point maps to itself.
+########################################################################
+
+REFERENCE = os.path.join(ROOT, 'example', 'run_reference')
+
+def identity(file, nt, np_):
+  t, p = np.linspace(0, np.pi, nt), np.linspace(0, 2*np.pi, np_)
+  T, P = np.meshgrid(t, p)
+  ps.wrhdf_2d(str(file), t, p, T if file.name.endswith('_t.h5') else P)
+
+@pytest.fixture
+def rundir(tmp_path):
+  (tmp_path / 'cs').mkdir()
+  (tmp_path / 'pfss').mkdir()
+  shutil.copy(os.path.join(REFERENCE, 'results', 'ofm_r0.h5'), tmp_path / 'pfss' / 'ofm_r0.h5')
+  shutil.copy(os.path.join(REFERENCE, 'dchb_at_r1.h5'), tmp_path / 'dchb_at_r1.h5')
+  for name in ('r1_rss_t.h5', 'r1_rss_p.h5'):
+    identity(tmp_path / 'cs' / name, 181, 361)
+  for name in ('rss_r0_t.h5', 'rss_r0_p.h5'):
+    identity(tmp_path / 'pfss' / name, 361, 721)
+  t, p = np.linspace(0, np.pi, 361), np.linspace(0, 2*np.pi, 721)
+  ps.wrhdf_2d(str(tmp_path / 'pfss' / 'expfac_rss_r0.h5'), t, p, 1 + np.meshgrid(t, p)[0])
+  return tmp_path
+
+def test_query_on_reference_layout(rundir):
+  p_ofm, t_ofm, ofm = (np.asarray(a) for a in ps.rdhdf_2d(os.path.join(REFERENCE, 'results', 'ofm_r0.h5')))
+  assert np.max(p_ofm) > 3.5 and ofm.shape == (len(t_ofm), len(p_ofm))
+
+  index = backmap.load_index(str(rundir), r1=21.5)
+  rng = np.random.default_rng(1)
+  it = rng.integers(2, len(t_ofm) - 2, 400)
+  ip = rng.integers(0, len(p_ofm) - 1, 400)
+  t, p = t_ofm[it], p_ofm[ip]
+  result = backmap.query(index, np.full(t.shape, 30.0), t, p)
+
+  assert np.all(result['r1'] == 21.5)
+  np.testing.assert_allclose(result['r0_t'], t, atol=1e-4)
+  np.testing.assert_allclose(np.angle(np.exp(1j*(result['r0_p'] - p))), 0, atol=1e-4)
+  np.testing.assert_array_equal(result['polarity'], ofm[it, ip])
+  np.testing.assert_allclose(result['expfac'], 1 + t, rtol=1e-3)
+
+def test_dchb_on_reference_grid(rundir):
+  p_d, t_d, dchb = (np.asarray(a) for a in ps.rdhdf_2d(os.path.join(REFERENCE, 'dchb_at_r1.h5')))
+  index = backmap.load_index(str(rundir), r1=21.5)
+  it, ip = np.meshgrid(np.arange(5, len(t_d) - 5, 7), np.arange(0, len(p_d) - 1, 11))
+  result = backmap.query(index, np.full(it.size, 21.5), t_d[it.ravel()], p_d[ip.ravel()])
+  np.testing.assert_allclose(result['dchb'], dchb[it.ravel(), ip.ravel()], atol=1e-6)
+
+def test_points_below_r1_are_nan(rundir):
+  index = backmap.load_index(str(rundir), r1=21.5)
+  result = backmap.query(index, [10.0], [1.0], [1.0])
+  assert all(np.isnan(result[name][0]) for name in backmap.OUTPUTS)
+
+def test_stale_cache_is_rebuilt(rundir):
+  index = backmap.load_index(str(rundir), r1=21.5)
+  cache = rundir / backmap.INDEX_NAME
+  flat = {f'0_{key}': value for key, value in index[0].items() if not key.startswith('grid_')}
+  flat['0_ofm'] = np.transpose(flat['0_ofm'])
+  np.savez(cache, levels=1, **flat)
+  assert backmap.load_index(str(rundir), r1=21.5)[0]['ofm'].shape == index[0]['ofm'].shape
@@ -0,0 +1,36 @@
+import os
+import sys
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'bin'))
+
+import psi_io as ps
+import pfss_spectral
+import fieldline_tracer
+
+########################################################################
+#  Tests of bin/fieldline_tracer.py on the PFSS solution of a dipole:
+#  the outputs are in the layouts MAPFL writes them in.
+########################################################################
+
+def test_pfss_outputs_in_mapfl_layouts(tmp_path):
+  tvec, pvec = np.linspace(0, np.pi, 37), np.linspace(0, 2*np.pi, 73)
+  br = np.cos(tvec)[:, None]*np.ones(len(pvec))[None, :]
+  pfss_spectral.write_solution(pfss_spectral.solve(tvec, pvec, br, 2.5, 16, lmax=4), str(tmp_path))
+  ntss, npss = 19, 9
+  fieldline_tracer.trace_pfss(str(tmp_path), ntss, npss, step=0.25)
+
+  # ofm_r0.h5 is pt, (ntss, npss): open (+1 north, -1 south) at the poles,
+  # closed at the equator.
+  p, t, ofm = (np.asarray(a) for a in ps.rdhdf_2d(str(tmp_path / 'ofm_r0.h5')))
+  np.testing.assert_allclose(p, np.linspace(0, 2*np.pi, npss))
+  np.testing.assert_allclose(t, np.linspace(0, np.pi, ntss))
+  assert ofm.shape == (ntss, npss)
+  assert np.all(ofm[1] == 1) and np.all(ofm[-2] == -1) and np.all(ofm[ntss//2] == 0)
+
+  # The other outputs are tp, (npss, ntss).
+  t, p, t_r0 = (np.asarray(a) for a in ps.rdhdf_2d(str(tmp_path / 'rss_r0_t.h5')))
+  assert len(t) == ntss and len(p) == npss and t_r0.shape == (npss, ntss)
+  # Open footpoints of a dipole are closer to the poles than their rss points.
+  assert np.all(t_r0[:, 2] < t[2]) and np.all(t_r0[:, -3] > t[-3])
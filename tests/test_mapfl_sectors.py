@@ -0,0 +1,85 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'bin'))
+
+import psi_io as ps
+import namelist_io
+import mapfl_sectors
+
+########################################################################
+#  Tests of bin/mapfl_sectors.py: the stitched outputs of a run split
+#  into sectors against those of a one-sector run.
+########################################################################
+
+# Stand-in for MAPFL writing its outputs in the layouts MAPFL uses:
+# ofm_r0.h5 pt on the seed points, the slogq maps tp on the cell
+# centres, and the other maps tp on the seed points.
+FAKE_MAPFL = """
+import sys
+import numpy as np
+sys.path.insert(0, {bindir!r})
+import psi_io as ps
+import namelist_io
+nml = namelist_io.read_namelist('mapfl.in')
+t = np.asarray(ps.rdhdf_1d(namelist_io.get_value(nml, 'mesh_file_t'))[1])
+p = np.asarray(ps.rdhdf_1d(namelist_io.get_value(nml, 'mesh_file_p'))[1])
+tc, pc = 0.5*(t[1:] + t[:-1]), 0.5*(p[1:] + p[:-1])
+T, P = np.meshgrid(t, p)
+TC, PC = np.meshgrid(tc, pc)
+ps.wrhdf_2d('ofm_r0.h5', p, t, np.transpose(np.sign(np.cos(T))*(np.sin(3*P) > 0)))
+ps.wrhdf_2d('slogq_r0.h5', tc, pc, np.sin(2*TC)*np.cos(PC))
+ps.wrhdf_2d('slogq_rss.h5', tc, pc, np.cos(TC)*np.sin(2*PC))
+ps.wrhdf_2d('rss_r0_t.h5', t, p, 0.9*T + 0.01*P)
+ps.wrhdf_2d('rss_r0_p.h5', t, p, np.mod(P + 0.1*np.sin(T), 2*np.pi))
+ps.wrhdf_2d('expfac_rss_r0.h5', t, p, 1 + T*P)
+print('done')
+"""
+
+FILES = ['ofm_r0.h5', 'slogq_r0.h5', 'slogq_rss.h5', 'rss_r0_t.h5', 'rss_r0_p.h5', 'expfac_rss_r0.h5']
+
+@pytest.fixture
+def command(tmp_path):
+  fake = tmp_path / 'fake_mapfl.py'
+  fake.write_text(FAKE_MAPFL.format(bindir=os.path.join(ROOT, 'bin')))
+  return sys.executable+' '+str(fake)+' 1>mapfl.log 2>mapfl.err'
+
+def run(tmp_path, command, name, count, axis):
+  rundir = tmp_path / name
+  rundir.mkdir()
+  cwd = os.getcwd()
+  os.chdir(rundir)
+  try:
+    namelist_io.customize(os.path.join(ROOT, 'rsrc', 'mapfl_pfss.in'), 'mapfl.in', {'ntss': 13, 'npss': 25})
+    ierr, failure = mapfl_sectors.run_sectors('mapfl.in', command, count, axis, cores=2)
+  finally:
+    os.chdir(cwd)
+  assert ierr == 0, failure
+  return rundir
+
+@pytest.mark.parametrize('axis,count', [('p', 2), ('p', 5), ('t', 3)])
+def test_stitch_matches_one_sector(tmp_path, command, axis, count):
+  single = run(tmp_path, command, 'single', 1, axis)
+  split = run(tmp_path, command, 'split', count, axis)
+  for file in FILES:
+    expected = ps.rdhdf_2d(str(single / file))
+    stitched = ps.rdhdf_2d(str(split / file))
+    for a, b in zip(expected, stitched):
+      np.testing.assert_array_equal(np.asarray(a), np.asarray(b), err_msg=file)
+  assert not any(name.startswith('mapfl_sector_') for name in os.listdir(split))
+
+def test_output_off_the_seed_mesh_is_an_error(tmp_path):
+  directory = tmp_path / 'mapfl_sector_0'
+  directory.mkdir()
+  t, p = np.linspace(0, np.pi, 7), np.linspace(0, 2*np.pi, 9)
+  ps.wrhdf_2d(str(directory / 'ofm_r0.h5'), np.linspace(0, 1, 4), t, np.zeros((7, 4)))
+  cwd = os.getcwd()
+  os.chdir(tmp_path)
+  try:
+    error = mapfl_sectors.stitch(['ofm_r0.h5'], {'t': t, 'p': p}, [('mapfl_sector_0', (0, 9, 0, 9))], 'p')
+  finally:
+    os.chdir(cwd)
+  assert error and 'ofm_r0.h5' in error
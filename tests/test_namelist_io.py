@@ -0,0 +1,129 @@
+import os
+import ast
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'bin'))
+
+import namelist_io
+
+########################################################################
+#  Tests of bin/namelist_io.py and of the keys its callers set in the
+#  rsrc/ templates (run with python -m pytest from the repository root).
+########################################################################
+
+# Callers of namelist_io: (script, functions or module-level dicts that
+# build the values) -> templates the values are set in.
+CALLERS = [
+  ('bin/cor_pfss_cs_pot3d.py',     ['run_pfss'],                    ['pot3d_pfss.dat']),
+  ('bin/cor_pfss_cs_pot3d.py',     ['run_cs'],                      ['pot3d_cs.dat']),
+  ('bin/swig_tolerance_study.py',  ['main', 'run'],                 ['pot3d_pfss.dat', 'pot3d_cs.dat']),
+  ('bin/mag_trace_analysis.py',    ['trace_pfss'],                  ['mapfl_pfss.in']),
+  ('bin/mag_trace_analysis.py',    ['trace_cs'],                    ['mapfl_cs.in']),
+  ('bin/mag_trace_analysis_cor.py', ['mesh_values', 'run', 'analyze', 'SHELL_FILES'], ['mapfl_cor.in']),
+  ('bin/mapfl_sectors.py',         ['write_runs'],                  ['mapfl_pfss.in', 'mapfl_cs.in', 'mapfl_cor.in']),
+]
+
+def is_values(node):
+  # A name of a dict of namelist values (pot3d_values, mapfl_values, values).
+  return isinstance(node, ast.Name) and node.id.endswith('values')
+
+def dict_keys(node):
+  if not isinstance(node, ast.Dict):
+    return set()
+  return {k.value for k in node.keys if isinstance(k, ast.Constant) and isinstance(k.value, str)}
+
+def assigned_keys(script, names):
+  # String keys that the functions (or module-level dicts) names of
+  # script put in namelist values: dicts assigned to *values or passed
+  # to *values.update(), customize(), or set_values(), and *values[key]
+  # assignments.
+  with open(os.path.join(ROOT, script)) as f:
+    tree = ast.parse(f.read())
+  keys = set()
+  for top in tree.body:
+    if isinstance(top, ast.Assign) and any(isinstance(t, ast.Name) and t.id in names for t in top.targets):
+      keys |= dict_keys(top.value)
+    if not (isinstance(top, ast.FunctionDef) and top.name in names):
+      continue
+    for node in ast.walk(top):
+      if isinstance(node, ast.Assign):
+        for target in node.targets:
+          if is_values(target):
+            keys |= dict_keys(node.value)
+          elif isinstance(target, ast.Subscript) and is_values(target.value) and isinstance(target.slice, ast.Constant):
+            keys.add(target.slice.value)
+      elif isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute):
+        if node.func.attr == 'update' and is_values(node.func.value):
+          keys |= dict_keys(node.args[0])
+        elif node.func.attr == 'customize' and len(node.args) == 3:
+          keys |= dict_keys(node.args[2])
+        elif node.func.attr == 'set_values' and len(node.args) == 2:
+          keys |= dict_keys(node.args[1])
+  return keys
+
+@pytest.mark.parametrize('script,names,templates', CALLERS)
+def test_templates_have_caller_keys(script, names, templates):
+  keys = assigned_keys(script, names)
+  assert keys, 'no namelist keys found in '+script+' '+str(names)
+  for template in templates:
+    nml = namelist_io.read_namelist(os.path.join(ROOT, 'rsrc', template))
+    missing = sorted(key for key in keys if key.lower() not in nml['keys'])
+    assert not missing, template+' has no '+', '.join(missing)+' (set by '+script+')'
+
+@pytest.fixture
+def template(tmp_path):
+  file = tmp_path / 'template.in'
+  file.write_text("&datum\n"
+                  "! ****** A comment:\n"
+                  "  bfile%r='br.h5'\n"
+                  "  r1 = 0\n"
+                  "  cubic=.false.\n"
+                  "  epscg=1.e-9  ! tolerance\n"
+                  "! ntss=3\n"
+                  "/\n")
+  return file
+
+def test_format_value():
+  assert namelist_io.format_value(True) == '.true.'
+  assert namelist_io.format_value(False) == '.false.'
+  assert namelist_io.format_value(361) == '361'
+  assert namelist_io.format_value(2.5) == '2.5'
+  assert namelist_io.format_value("it's") == "'it''s'"
+
+def test_get_value(template):
+  nml = namelist_io.read_namelist(str(template))
+  assert namelist_io.get_value(nml, 'BFILE%R') == 'br.h5'
+  assert namelist_io.get_value(nml, 'r1') == 0
+  assert namelist_io.get_value(nml, 'cubic') is False
+  assert namelist_io.get_value(nml, 'epscg') == 1e-9
+
+def test_customize_roundtrip(template, tmp_path):
+  out = tmp_path / 'out.in'
+  values = {'bfile%r': "/a/b's.h5", 'r1': 21.5, 'cubic': True, 'epscg': 1e-8}
+  namelist_io.customize(str(template), str(out), values)
+  nml = namelist_io.read_namelist(str(out))
+  for key, value in values.items():
+    assert namelist_io.get_value(nml, key) == value
+  # Comments and other lines are kept.
+  lines = out.read_text().splitlines()
+  assert lines[0] == '&datum' and lines[1] == '! ****** A comment:' and lines[-2:] == ['! ntss=3', '/']
+  assert len(lines) == len(template.read_text().splitlines())
+
+def test_unknown_key_is_an_error(template, tmp_path):
+  out = tmp_path / 'out.in'
+  with pytest.raises(SystemExit):
+    namelist_io.customize(str(template), str(out), {'domain_r_min': 1.0})
+  # A commented-out key is not a variable either.
+  with pytest.raises(SystemExit):
+    namelist_io.customize(str(template), str(out), {'ntss': 3})
+  assert not out.exists()
+
+def test_template_reparsed_when_modified(template):
+  assert namelist_io.get_value(namelist_io.read_namelist(str(template)), 'r1') == 0
+  text = template.read_text().replace('r1 = 0', 'r1 = 30')
+  stat = os.stat(template)
+  template.write_text(text)
+  os.utime(template, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000))
+  assert namelist_io.get_value(namelist_io.read_namelist(str(template)), 'r1') == 30
@@ -0,0 +1,66 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'bin'))
+
+import psi_io as ps
+import pfss_spectral
+
+########################################################################
+#  Tests of bin/pfss_spectral.py: the POT3D meshes, the dipole against
+#  its analytic solution, and the example map against the POT3D Br at
+#  r0 of example/run_reference.
+########################################################################
+
+EXAMPLE = os.path.join(ROOT, 'example')
+EXAMPLE_MAP = os.path.join(EXAMPLE, 'hmi_synoptic_mr_polfil_720s_cr2218_binned_smoothed_flxbln_361x181.h5')
+POT3D_BR_R0 = os.path.join(EXAMPLE, 'run_reference', 'results', 'br_r0.h5')
+
+def test_meshes_are_pot3d_meshes():
+  # POT3D sizes of a 361x181 map: nr=55, nt=182, np=362 (the half meshes).
+  meshes = pfss_spectral.pot3d_meshes(55, 182, 362, 2.51)
+  r, th, ph = meshes['br']
+  rh, t, _ = meshes['bt']
+  _, _, p = meshes['bp']
+  assert (len(r), len(th), len(ph)) == (54, 182, 362)
+  assert (len(rh), len(t), len(p)) == (55, 181, 361)
+  assert r[0] == 1.0 and abs(r[-1] - 2.51) < 1e-12
+  assert rh[0] < r[0] and rh[-1] > r[-1]
+  np.testing.assert_allclose(np.diff(r)[-1]/np.diff(r)[0], 2.5)
+  # The POT3D Br at r0 of the reference run is on (th, ph), ghost points included.
+  t_ref, p_ref, _ = ps.rdhdf_2d(POT3D_BR_R0)
+  np.testing.assert_allclose(th, t_ref, atol=1e-12)
+  np.testing.assert_allclose(ph, p_ref, atol=1e-12)
+  assert meshes['br_r0'][1] is th and meshes['br_r0'][2] is ph
+
+def test_dipole_matches_analytic_solution():
+  rss = 2.5
+  tvec, pvec = np.linspace(0, np.pi, 91), np.linspace(0, 2*np.pi, 181)
+  br0 = np.cos(tvec)[:, None]*np.ones(len(pvec))[None, :]
+  fields = pfss_spectral.solve(tvec, pvec, br0, rss, 20, lmax=10)
+  # Br = cos(t) (2/r^3 + 1/s^3)/(2 + 1/s^3), Bt = sin(t) (1/r^3 - 1/s^3)/(2 + 1/s^3).
+  den = 2 + rss**-3
+  r, t, p, br = fields['br']
+  expected = np.cos(t)[None, :, None]*((2*r**-3 + rss**-3)/den)[None, None, :]
+  np.testing.assert_allclose(br, np.broadcast_to(expected, br.shape), atol=5e-4)
+  r, t, p, bt = fields['bt']
+  expected = np.sin(t)[None, :, None]*((r**-3 - rss**-3)/den)[None, None, :]
+  np.testing.assert_allclose(bt, np.broadcast_to(expected, bt.shape), atol=5e-4)
+  assert np.max(np.abs(fields['bp'][3])) < 1e-10
+  # Br is radial at the source surface.
+  assert np.max(np.abs(bt[:, :, -2])) < 0.05*np.max(np.abs(bt[:, :, 1]))
+
+def test_example_against_pot3d(tmp_path):
+  tvec, pvec, br = pfss_spectral.read_map_tp(EXAMPLE_MAP)
+  fields = pfss_spectral.solve(tvec, pvec, br, 2.51, 55)
+  pfss_spectral.write_solution(fields, str(tmp_path))
+  t, p, f = (np.asarray(a) for a in ps.rdhdf_2d(str(tmp_path / 'br_r0_pfss.h5')))
+  t_ref, p_ref, f_ref = (np.asarray(a) for a in ps.rdhdf_2d(POT3D_BR_R0))
+  assert f.shape == f_ref.shape
+  # About 1% (the harmonic expansion against POT3D's grid solution).
+  assert np.linalg.norm(f - f_ref)/np.linalg.norm(f_ref) < 0.015
+  r, t, p, f = ps.rdhdf_3d(str(tmp_path / 'br_pfss.h5'))
+  assert np.asarray(f).shape == (362, 182, 54)
@@ -0,0 +1,43 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'bin'))
+
+import psi_io as ps
+import plot_maps
+import swig_scheduler as scheduler
+
+########################################################################
+#  Tests of bin/plot_maps.py: plots and shell commands rendered with a
+#  shared pool from the scheduler's threads, as in swig.py.
+########################################################################
+
+pytestmark = pytest.mark.skipif(not plot_maps.have_matplotlib(), reason='matplotlib is not installed')
+
+def write_map(file):
+  t, p = np.linspace(0, np.pi, 19), np.linspace(0, 2*np.pi, 37)
+  T, P = np.meshgrid(t, p)
+  ps.wrhdf_2d(str(file), t, p, np.cos(T)*np.sin(P))
+
+def test_pool_from_scheduler_threads(tmp_path, monkeypatch):
+  for k in range(2):
+    write_map(tmp_path / f'map{k}.h5')
+  monkeypatch.chdir(tmp_path)
+  pool = plot_maps.start_pool(2)
+  ierrs = {}
+  def plot(k):
+    # Relative names, as in mag_trace_analysis_cor.py.
+    specs = [{'data': f'map{k}.h5', 'output': f'map{k}.png', 'cmap': 'RdBu'}]
+    ierrs[k] = plot_maps.render_plots(specs, pool=pool, commands=[f'echo {k} > done{k}', 'exit 3'])
+  jobs = [{'name': f'plot{k}', 'func': lambda k=k: plot(k), 'after': []} for k in range(2)]
+  try:
+    assert scheduler.run_jobs(jobs, 2) == []
+  finally:
+    pool.shutdown()
+  for k in range(2):
+    assert (tmp_path / f'map{k}.png').stat().st_size > 0
+    assert (tmp_path / f'done{k}').read_text().strip() == str(k)
+    assert ierrs[k][0] == 0 and ierrs[k][1] != 0
@@ -0,0 +1,58 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'bin'))
+
+import psi_io as ps
+import remesh_map
+
+########################################################################
+#  Tests of bin/remesh_map.py: the remeshed maps keep the total (and
+#  the unsigned) flux of the example map, in either layout.
+########################################################################
+
+EXAMPLE_MAP = os.path.join(ROOT, 'example', 'hmi_synoptic_mr_polfil_720s_cr2218_binned_smoothed_flxbln_361x181.h5')
+
+@pytest.fixture(autouse=True)
+def cache(tmp_path, monkeypatch):
+  monkeypatch.setenv('SWIG_REMESH_CACHE', str(tmp_path / 'cache'))
+  remesh_map._weights.clear()
+
+def fluxes(tvec, pvec, f):
+  # Signed and unsigned flux of a map (nt, np) over the cells of its
+  # points (the duplicate phi point excluded).
+  if remesh_map.is_periodic_dup(pvec):
+    pvec, f = pvec[:-1], f[:, :-1]
+  area = np.outer(np.diff(-np.cos(remesh_map.t_edges(tvec))), np.diff(remesh_map.p_edges(pvec)))
+  return np.sum(area*f), np.sum(area*np.abs(f))
+
+@pytest.mark.parametrize('target', ['91x46', '721x361', '200x77'])
+def test_remesh_conserves_flux(target):
+  tvec, pvec, f, pt = remesh_map.read_map(EXAMPLE_MAP)
+  xvec, yvec, data = ps.rdhdf_2d(EXAMPLE_MAP)
+  x_new, y_new, f_new = remesh_map.remesh_xy(xvec, yvec, data, target)
+  # Same layout as the input, on the target mesh.
+  npp, nt = (int(n) for n in target.split('x'))
+  assert (len(x_new), len(y_new)) == ((npp, nt) if pt else (nt, npp))
+  t_new, p_new, f_new = (y_new, x_new, f_new) if pt else (x_new, y_new, np.transpose(f_new))
+  flux, unsigned = fluxes(tvec, pvec, f)
+  flux_new, unsigned_new = fluxes(t_new, p_new, f_new)
+  np.testing.assert_allclose(flux_new, flux, rtol=1e-10, atol=1e-10*unsigned)
+  # Averaging can only cancel flux of opposite signs.
+  assert unsigned_new <= unsigned*(1 + 1e-12)
+
+def test_constant_map_stays_constant():
+  tvec, pvec = np.linspace(0, np.pi, 37), np.linspace(0, 2*np.pi, 73)
+  f_new = remesh_map.remesh_tp(tvec, pvec, np.full((37, 73), 3.0), np.linspace(0, np.pi, 11), np.linspace(0, 2*np.pi, 20))
+  np.testing.assert_allclose(f_new, 3.0, rtol=1e-12)
+
+def test_cached_weights_are_reused(tmp_path):
+  tvec, pvec, f, _ = remesh_map.read_map(EXAMPLE_MAP)
+  t_new, p_new = remesh_map.coarse_mesh(tvec, pvec, 4)
+  first = remesh_map.remesh_tp(tvec, pvec, f, t_new, p_new)
+  assert len(os.listdir(tmp_path / 'cache')) == 1
+  remesh_map._weights.clear()
+  np.testing.assert_array_equal(remesh_map.remesh_tp(tvec, pvec, f, t_new, p_new), first)
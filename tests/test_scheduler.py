@@ -0,0 +1,83 @@
+import os
+import sys
+import time
+import threading
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'bin'))
+
+import swig_scheduler as scheduler
+
+########################################################################
+#  Tests of bin/swig_scheduler.py: dependency order, the core budget,
+#  failures of command and func jobs and what they stop.
+########################################################################
+
+def recorder():
+  # Jobs that record when they start and finish.
+  events, lock = [], threading.Lock()
+  def job(name, after=(), cores=1, delay=0.05, fail=False):
+    def func():
+      with lock:
+        events.append(('start', name))
+      time.sleep(delay)
+      with lock:
+        events.append(('end', name))
+      if fail:
+        raise SystemExit(2)
+    return {'name': name, 'func': func, 'after': list(after), 'cores': cores}
+  return events, job
+
+def test_dependency_order():
+  events, job = recorder()
+  #   a -> b -> d
+  #   a -> c -> d
+  jobs = [job('d', ['b', 'c']), job('c', ['a']), job('b', ['a']), job('a')]
+  assert scheduler.run_jobs(jobs, 4) == []
+  order = {event: k for k, event in enumerate(events)}
+  assert order[('end', 'a')] < order[('start', 'b')] and order[('end', 'a')] < order[('start', 'c')]
+  assert order[('end', 'b')] < order[('start', 'd')] and order[('end', 'c')] < order[('start', 'd')]
+  # b and c run at the same time.
+  assert order[('start', 'c')] < order[('end', 'b')] and order[('start', 'b')] < order[('end', 'c')]
+
+def test_core_budget():
+  events, job = recorder()
+  running, peak = 0, 0
+  jobs = [job(f'j{k}', cores=2) for k in range(4)]
+  assert scheduler.run_jobs(jobs, 4) == []
+  for kind, _ in events:
+    running += 2 if kind == 'start' else -2
+    peak = max(peak, running)
+  assert peak == 4
+
+def test_failure_skips_dependents():
+  events, job = recorder()
+  # b fails; c depends on it and is never started, nor is e (waiting
+  # for d when b fails).  d, already running, finishes.
+  jobs = [job('a'), job('b', ['a'], fail=True), job('c', ['b']),
+          job('d', ['a'], delay=0.5), job('e', ['d'])]
+  assert scheduler.run_jobs(jobs, 4) == ['b']
+  started = {name for kind, name in events if kind == 'start'}
+  assert started == {'a', 'b', 'd'}
+
+def test_func_exception_fails_the_job(capsys):
+  ran = []
+  def broken():
+    raise ValueError('broken stage')
+  jobs = [{'name': 'a', 'func': broken, 'after': []},
+          {'name': 'b', 'func': lambda: ran.append('b'), 'after': ['a']}]
+  assert scheduler.run_jobs(jobs, 2) == ['a']
+  assert ran == []
+  assert 'ValueError: broken stage' in capsys.readouterr().err
+
+def test_failure_terminates_running_commands(tmp_path):
+  # The sleeping command and the child it starts are both terminated.
+  jobs = [{'name': 'slow', 'command': 'sleep 30 & echo $! > child; wait', 'cwd': str(tmp_path), 'after': []},
+          {'name': 'bad', 'command': 'sleep 0.5; exit 3', 'after': []}]
+  start = time.time()
+  assert scheduler.run_jobs(jobs, 2) == ['bad']
+  assert time.time() - start < 10
+  child = int((tmp_path / 'child').read_text())
+  with pytest.raises(ProcessLookupError):
+    os.kill(child, 0)
@@ -0,0 +1,88 @@
+import os
+import sys
+import subprocess
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'bin'))
+
+import psi_io as ps
+import swig_stages as stages
+
+########################################################################
+#  Tests of the stage-completion manifest of bin/swig_stages.py: which
+#  changes invalidate a completed stage, and -resume skipping the stages
+#  that are still complete.
+########################################################################
+
+def write_files(rundir, files, value=1.0):
+  for f in files:
+    (rundir / f).parent.mkdir(parents=True, exist_ok=True)
+    (rundir / f).write_bytes(np.full(4, value).tobytes())
+
+@pytest.fixture
+def rundir(tmp_path):
+  write_files(tmp_path, stages.STAGES['cs']['inputs'] + stages.STAGES['cs']['outputs'])
+  stages.record_stage(tmp_path, 'cs', {'epscg': 1e-9})
+  return tmp_path
+
+def test_recorded_stage_is_complete(rundir):
+  assert stages.stage_complete(rundir, 'cs', {'epscg': 1e-9})
+  assert not stages.stage_complete(rundir, 'cs_trace')
+
+@pytest.mark.parametrize('change', ['params', 'input', 'output', 'missing_output', 'outputs'])
+def test_changes_invalidate_stage(rundir, change):
+  params, outputs = {'epscg': 1e-9}, None
+  if change == 'params':
+    params = {'epscg': 1e-6}
+  elif change == 'input':
+    write_files(rundir, ['pfss/br_rss.h5'], 2.0)
+  elif change == 'output':
+    write_files(rundir, ['cs/br_cs.h5'], 2.0)
+  elif change == 'missing_output':
+    (rundir / 'cs' / 'br_cs.h5').unlink()
+  else:
+    outputs = stages.STAGES['cs']['outputs'][:-1]
+  assert not stages.stage_complete(rundir, 'cs', params, outputs=outputs)
+
+def test_rerun_invalidates_downstream_stages(rundir):
+  write_files(rundir, stages.STAGES['cs_trace']['inputs'] + stages.STAGES['cs_trace']['outputs'])
+  stages.record_stage(rundir, 'cs_trace')
+  write_files(rundir, stages.STAGES['pfss']['outputs'])
+  stages.record_stage(rundir, 'pfss')
+  recorded = stages.load_manifest(rundir)['stages']
+  # cs and cs_trace read (directly or not) the outputs of pfss.
+  assert set(recorded) == {'pfss'}
+
+def test_released_intermediates_satisfy_resume(rundir):
+  write_files(rundir, stages.STAGES['cs_trace']['inputs'] + stages.STAGES['cs_trace']['outputs'])
+  stages.record_stage(rundir, 'cs_trace')
+  released = stages.release_intermediates(rundir, done=list(stages.STAGES))
+  assert 'cs/br_cs.h5' in released and not (rundir / 'cs' / 'br_cs.h5').exists()
+  assert stages.stage_complete(rundir, 'cs', {'epscg': 1e-9})
+  assert stages.stage_complete(rundir, 'cs_trace')
+
+def test_resume_skips_complete_stage(tmp_path):
+  # The expfac stage of mag_trace_analysis.py, on identity r1->rss tracings.
+  (tmp_path / 'cs').mkdir()
+  (tmp_path / 'pfss').mkdir()
+  t, p = np.linspace(0, np.pi, 19), np.linspace(0, 2*np.pi, 37)
+  T, P = np.meshgrid(t, p)
+  ps.wrhdf_2d(str(tmp_path / 'cs' / 'r1_rss_t.h5'), t, p, T)
+  ps.wrhdf_2d(str(tmp_path / 'cs' / 'r1_rss_p.h5'), t, p, P)
+  ps.wrhdf_2d(str(tmp_path / 'pfss' / 'expfac_rss_r0.h5'), t, p, 1 + T)
+  def run():
+    command = [sys.executable, os.path.join(ROOT, 'bin', 'mag_trace_analysis.py'), '-stages', 'expfac', '-resume', str(tmp_path)]
+    result = subprocess.run(command, capture_output=True, text=True)
+    assert result.returncode == 0, result.stdout + result.stderr
+    return 'already complete' in result.stdout
+
+  assert not run()
+  assert run()
+  # A changed input is traced again.
+  ps.wrhdf_2d(str(tmp_path / 'pfss' / 'expfac_rss_r0.h5'), t, p, 2 + T)
+  assert not run()
+  p1, t1, expfac = (np.asarray(a) for a in ps.rdhdf_2d(str(tmp_path / 'expfac_rss_at_r1.h5')))
+  np.testing.assert_allclose(expfac, 2 + t1[:, None]*np.ones(len(p1)), atol=1e-12)
+  assert run()